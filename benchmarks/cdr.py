@@ -0,0 +1,107 @@
+"""
+Synthetic call detail records.
+
+Generates calls of a number of subscribers with call lengths drawn from a
+configurable distribution, as the records accepted by the call-log
+endpoints and the import_cdrs command.
+
+    python -m benchmarks.cdr --calls 1000000 --distribution lognormal \
+        --output cdrs.ndjson.gz
+"""
+import argparse
+import csv
+import gzip
+import json
+import math
+import random
+from datetime import datetime, timedelta
+from benchmarks.invoice_lookup import phone_number
+
+DISTRIBUTIONS = {
+    'exponential': lambda rng, mean: rng.expovariate(1 / mean),
+    # mean of exp(mu + sigma ** 2 / 2) with sigma 1
+    'lognormal': lambda rng, mean: rng.lognormvariate(math.log(mean) - 0.5, 1),
+    'uniform': lambda rng, mean: rng.uniform(0, 2 * mean),
+    'fixed': lambda rng, mean: mean,
+}
+CSV_FIELDS = ['type', 'call_id', 'timestamp', 'source', 'destination']
+
+
+def generate_calls(calls, subscribers=1000, distribution='exponential',
+                   mean_seconds=180, first_day=datetime(2018, 1, 1),
+                   days=28, seed=42, first_call_id=1, first_subscriber=0):
+    """
+    :param distribution: name of the distribution of the call lengths
+    :param mean_seconds: mean call length
+    :return: iterator of (call id, source, destination, start, end)
+    """
+    rng = random.Random(seed)
+    duration = DISTRIBUTIONS[distribution]
+    for call_id in range(first_call_id, first_call_id + calls):
+        started_at = first_day + timedelta(
+            seconds=rng.randrange(days * 86400))
+        seconds = max(1, int(duration(rng, mean_seconds)))
+        yield (
+            call_id,
+            phone_number(first_subscriber + rng.randrange(subscribers)),
+            '11{:09d}'.format(rng.randrange(10 ** 9)),
+            started_at,
+            started_at + timedelta(seconds=seconds)
+        )
+
+
+def call_log_records(calls):
+    """
+    :param calls: iterator of (call id, source, destination, start, end)
+    :return: iterator of the start and end records of each call
+    """
+    for call_id, source, destination, started_at, ended_at in calls:
+        yield {
+            'type': 'start',
+            'call_id': call_id,
+            'timestamp': started_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'source': source,
+            'destination': destination,
+        }
+        yield {
+            'type': 'end',
+            'call_id': call_id,
+            'timestamp': ended_at.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        }
+
+
+def write_records(records, path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt', newline='') as stream:
+        if path.endswith(('.csv', '.csv.gz')):
+            writer = csv.DictWriter(stream, CSV_FIELDS)
+            writer.writeheader()
+            writer.writerows(records)
+        else:
+            for record in records:
+                stream.write(json.dumps(record) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calls', type=int, default=100000)
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument(
+        '--distribution', choices=sorted(DISTRIBUTIONS),
+        default='exponential')
+    parser.add_argument('--mean-seconds', type=float, default=180)
+    parser.add_argument('--days', type=int, default=28)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument(
+        '--output', required=True,
+        help="File name ending in .csv or .ndjson, optionally with .gz")
+    options = parser.parse_args()
+
+    calls = generate_calls(
+        options.calls, options.subscribers, options.distribution,
+        options.mean_seconds, days=options.days, seed=options.seed)
+    write_records(call_log_records(calls), options.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+import os
+import statistics
+import time
+from contextlib import contextmanager
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'billcalls.settings')
+    import django
+    django.setup()
+
+
+@contextmanager
+def benchmark_database(keepdb=False):
+    """
+    Run the benchmark on a throwaway database created like the test one,
+    so the configured database is never touched.
+    """
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(
+        verbosity=0, autoclobber=True, serialize=False, keepdb=keepdb)
+    try:
+        yield connection
+    finally:
+        connection.creation.destroy_test_db(
+            old_name, verbosity=0, keepdb=keepdb)
+
+
+def measure(function, repeat):
+    """
+    :return: sorted list with the duration in seconds of each run
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return sorted(durations)
+
+
+def percentile(durations, percent):
+    index = min(len(durations) - 1, int(len(durations) * percent / 100))
+    return durations[index]
+
+
+def summary(durations):
+    return {
+        'runs': len(durations),
+        'mean_ms': statistics.mean(durations) * 1000,
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+    }
@@ -0,0 +1,118 @@
+"""
+Requests per second of concurrent invoice reads by database connection mode.
+
+Fills a throwaway database with the calls of a subscriber and reads pages
+of their invoice from several threads with a connection opened for each
+request, with persistent connections and, on PostgreSQL, with the
+connection pool.
+
+    python -m benchmarks.connections --threads 16 --requests 200
+"""
+import argparse
+import json
+import threading
+import time
+from benchmarks.cdr import call_log_records, generate_calls
+from benchmarks.common import benchmark_database, setup_django
+from benchmarks.invoice_lookup import phone_number
+
+MODES = {
+    'per_request': {'CONN_MAX_AGE': 0},
+    'persistent': {'CONN_MAX_AGE': 600},
+    'pool': {'ENGINE': 'billcalls.db.postgresql_pool', 'CONN_MAX_AGE': 0},
+}
+
+
+def populate(calls):
+    from calls.ingestion import ingest_call_logs
+    records = list(call_log_records(generate_calls(calls, 1)))
+    for position in range(0, len(records), 1000):
+        ingest_call_logs(records[position:position + 1000])
+    return phone_number(0)
+
+
+def read_invoices(url, threads, requests):
+    """
+    :return: requests per second and connections opened
+    """
+    from django.db import connections
+    from django.db.backends.signals import connection_created
+    from rest_framework.test import APIClient
+
+    opened = []
+
+    def count_connection(sender, connection, **kwargs):
+        opened.append(connection.alias)
+
+    def read():
+        client = APIClient()
+        try:
+            for _ in range(requests):
+                response = client.get(url)
+                assert response.status_code == 200, response.content
+        finally:
+            connections.close_all()
+
+    workers = [threading.Thread(target=read) for _ in range(threads)]
+    connection_created.connect(count_connection)
+    started = time.perf_counter()
+    try:
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        connection_created.disconnect(count_connection)
+    elapsed = time.perf_counter() - started
+    return threads * requests / elapsed, len(opened)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calls', type=int, default=1000)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=100,
+                        help="Requests of each thread")
+    parser.add_argument('--page-size', type=int, default=100)
+    parser.add_argument('--pool-size', type=int, default=8)
+    parser.add_argument('--keepdb', action='store_true')
+    options = parser.parse_args()
+
+    setup_django()
+    from django.conf import settings
+    from django.db import connections
+    from billcalls.db.pool import pool_stats
+
+    settings.DATABASE_POOL['MAX_SIZE'] = options.pool_size
+    results = {}
+    with benchmark_database(keepdb=options.keepdb) as connection:
+        url = '/call-invoice/{source}?date=012018&page_size={size}'.format(
+            source=populate(options.calls), size=options.page_size)
+        connection.close()
+        settings_dict = connections.databases[connection.alias]
+        original = dict(settings_dict)
+        for mode, changes in MODES.items():
+            if mode == 'pool' and connection.vendor != 'postgresql':
+                continue
+            # threads started afterwards create their connections with it
+            settings_dict.update(changes)
+            try:
+                requests_per_sec, opened = read_invoices(
+                    url, options.threads, options.requests)
+            finally:
+                settings_dict.clear()
+                settings_dict.update(original)
+            results[mode] = {
+                'requests_per_sec': requests_per_sec,
+                'connections_opened': opened,
+            }
+            if mode == 'pool':
+                stats = pool_stats()[connection.alias]
+                # every checkout sends connection_created, only these are new
+                results[mode]['connections_opened'] = stats['created']
+                results[mode]['pool'] = stats
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""
+Latency of the monthly invoice lookup of one subscriber.
+
+Fills a throwaway database with synthetic invoices and times the lookup
+with the year/month functions used before, the half-open month range on
+CallInvoice and the CallRecord scan used by the invoice endpoint.
+
+    python -m benchmarks.invoice_lookup --invoices 10000000
+"""
+import argparse
+import json
+import random
+from datetime import date, datetime, timedelta
+from benchmarks.common import benchmark_database, measure, setup_django, \
+    summary
+
+
+def phone_number(subscriber):
+    return '41{:09d}'.format(subscriber)
+
+
+def generate_rows(invoices, subscribers, months, seed):
+    rng = random.Random(seed)
+    first_day = date(2018, 1, 1)
+    days = months * 30
+    for call_id in range(1, invoices + 1):
+        ended_at = datetime.combine(
+            first_day + timedelta(days=rng.randrange(days)),
+            datetime.min.time()
+        ) + timedelta(seconds=rng.randrange(86400))
+        duration = rng.randrange(1, 3600)
+        yield (
+            call_id,
+            phone_number(rng.randrange(subscribers)),
+            ended_at - timedelta(seconds=duration),
+            ended_at,
+            duration
+        )
+
+
+def populate(connection, options):
+    from calls.models import billing_month
+    rows = generate_rows(
+        options.invoices, options.subscribers, options.months, options.seed)
+    chunk = []
+    with connection.cursor() as cursor:
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) == options.chunk_size:
+                insert(cursor, chunk, billing_month)
+                chunk = []
+        if chunk:
+            insert(cursor, chunk, billing_month)
+
+
+def insert(cursor, rows, billing_month):
+    cursor.executemany(
+        'INSERT INTO calls_call (id, source, destination) '
+        'VALUES (%s, %s, %s)',
+        [(call_id, source, '11999999999')
+         for call_id, source, started_at, ended_at, duration in rows]
+    )
+    cursor.executemany(
+        'INSERT INTO calls_callinvoice (id, call_id_id, timestamp_end, price) '
+        'VALUES (%s, %s, %s, %s)',
+        [(call_id, call_id, ended_at.date(), '1.00')
+         for call_id, source, started_at, ended_at, duration in rows]
+    )
+    cursor.executemany(
+        'INSERT INTO calls_callrecord (call_id_id, source, destination, '
+        'started_at, ended_at, duration_seconds, price, billing_month) '
+        'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+        [(call_id, source, '11999999999', started_at, ended_at, duration,
+          '1.00', billing_month(ended_at))
+         for call_id, source, started_at, ended_at, duration in rows]
+    )
+
+
+def lookups():
+    from calls.models import CallInvoice, CallRecord, month_range
+
+    def year_month(source, date_ref):
+        return list(CallInvoice.objects.filter(
+            call_id__source=source,
+            timestamp_end__year=date_ref.year,
+            timestamp_end__month=date_ref.month
+        ).values_list('id', 'price'))
+
+    def invoice_range(source, date_ref):
+        first_day, next_month = month_range(date_ref)
+        return list(CallInvoice.objects.filter(
+            call_id__source=source,
+            timestamp_end__gte=first_day,
+            timestamp_end__lt=next_month
+        ).values_list('id', 'price'))
+
+    def call_record(source, date_ref):
+        return list(CallRecord.objects.filter(
+            source=source,
+            billing_month=month_range(date_ref)[0]
+        ).order_by('ended_at', 'call_id').values_list('call_id', 'price'))
+
+    return [
+        ('invoice_year_month', year_month),
+        ('invoice_month_range', invoice_range),
+        ('call_record', call_record),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--invoices', type=int, default=10000000)
+    parser.add_argument('--subscribers', type=int, default=100000)
+    parser.add_argument('--months', type=int, default=12)
+    parser.add_argument('--lookups', type=int, default=200)
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keepdb', action='store_true')
+    options = parser.parse_args()
+
+    setup_django()
+    with benchmark_database(keepdb=options.keepdb) as connection:
+        populate(connection, options)
+        rng = random.Random(options.seed)
+        samples = [
+            (phone_number(rng.randrange(options.subscribers)),
+             date(2018, rng.randrange(min(options.months, 12)) + 1, 1))
+            for _ in range(options.lookups)
+        ]
+        results = {'invoices': options.invoices, 'lookups': {}}
+        for name, lookup in lookups():
+            iterator = iter(samples)
+            durations = measure(
+                lambda: lookup(*next(iterator)), len(samples))
+            results['lookups'][name] = summary(durations)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Load test of call-log ingestion over HTTP, to compare deployments.
+
+Opens many concurrent connections to a running server and posts the start
+and end records of synthetic calls on each, reporting requests per second,
+latency and the response statuses. Run it once against each deployment:
+
+    gunicorn billcalls.wsgi --workers 4
+    python -m benchmarks.load --url http://127.0.0.1:8000/call-log/ingest
+
+    uvicorn billcalls.asgi:application --workers 4
+    python -m benchmarks.load --url http://127.0.0.1:8000/call-log/ingest
+"""
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+from urllib.parse import urlsplit
+from benchmarks.cdr import DISTRIBUTIONS, call_log_records, generate_calls
+from benchmarks.common import percentile
+
+
+class Connection(object):
+    """
+    HTTP/1.1 connection reopened whenever the server closes it, as sync
+    workers do after every response.
+    """
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def post(self, path, body):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        self.writer.write((
+            'POST {path} HTTP/1.1\r\nHost: {host}\r\n'
+            'Content-Type: application/json\r\nContent-Length: {length}\r\n'
+            '\r\n'.format(path=path, host=self.host, length=len(body))
+        ).encode() + body)
+        status = int((await self.reader.readline()).split()[1])
+        headers = {}
+        while True:
+            line = (await self.reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            name, value = line.split(':', 1)
+            headers[name.lower()] = value.strip()
+        if 'content-length' in headers:
+            await self.reader.readexactly(int(headers['content-length']))
+        else:
+            await self.reader.read()
+        if headers.get('connection', '').lower() == 'close' or \
+                'content-length' not in headers:
+            self.close()
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.reader = self.writer = None
+
+
+async def run_connection(url, records, durations, statuses):
+    parts = urlsplit(url)
+    connection = Connection(parts.hostname, parts.port or 80)
+    try:
+        for record in records:
+            started = time.perf_counter()
+            status = await connection.post(
+                parts.path, json.dumps(record).encode())
+            durations.append(time.perf_counter() - started)
+            statuses[status] += 1
+    finally:
+        connection.close()
+
+
+async def run(options):
+    durations = []
+    statuses = Counter()
+    calls = options.requests // 2
+    tasks = [
+        run_connection(
+            options.url,
+            list(call_log_records(generate_calls(
+                calls, options.subscribers, options.distribution,
+                seed=options.seed + index,
+                first_call_id=options.first_call_id + index * calls))),
+            durations, statuses)
+        for index in range(options.connections)
+    ]
+    started = time.perf_counter()
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    durations.sort()
+    return {
+        'connections': options.connections,
+        'requests': len(durations),
+        'requests_per_sec': len(durations) / elapsed,
+        'p50_ms': percentile(durations, 50) * 1000,
+        'p99_ms': percentile(durations, 99) * 1000,
+        'statuses': dict(statuses),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--url', default='http://127.0.0.1:8000/call-log/ingest')
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=100,
+                        help="Requests of each connection, half of them "
+                             "starts and half ends")
+    parser.add_argument('--subscribers', type=int, default=1000)
+    parser.add_argument(
+        '--distribution', choices=sorted(DISTRIBUTIONS),
+        default='exponential')
+    parser.add_argument('--first-call-id', type=int, default=1,
+                        help="Change it between runs on the same database")
+    parser.add_argument('--seed', type=int, default=42)
+    options = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(run(options))
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+"""
+Cost of validating phone numbers.
+
+Times the regex match previously done by validate_phone_number against the
+length and isdigit check, one number at a time and a column at a time as
+done by the bulk ingestion.
+
+    python -m benchmarks.phone_validation --numbers 1000000
+"""
+import argparse
+import json
+import random
+import re
+from benchmarks.common import measure, setup_django, summary
+
+
+def generate_numbers(count, subscribers, seed):
+    rng = random.Random(seed)
+    numbers = []
+    for _ in range(count):
+        if rng.random() < 0.01:
+            numbers.append('4199abc{:04d}'.format(rng.randrange(10000)))
+        else:
+            numbers.append('41{:09d}'.format(rng.randrange(subscribers)))
+    return numbers
+
+
+def validations():
+    from calls.validators import PHONE_REGEX, check_phone_numbers, \
+        is_valid_phone_number
+
+    def regex(numbers):
+        # as validate_phone_number did before
+        return [bool(re.match(PHONE_REGEX, number)) for number in numbers]
+
+    def compiled_regex(numbers):
+        return [PHONE_REGEX.match(number) is not None for number in numbers]
+
+    def fast_check(numbers):
+        return [is_valid_phone_number(number) for number in numbers]
+
+    return [
+        ('regex', regex),
+        ('compiled_regex', compiled_regex),
+        ('fast_check', fast_check),
+        ('column_check', check_phone_numbers),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--numbers', type=int, default=1000000)
+    parser.add_argument('--subscribers', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    options = parser.parse_args()
+
+    setup_django()
+    numbers = generate_numbers(
+        options.numbers, options.subscribers, options.seed)
+    results = {'numbers': options.numbers, 'validations': {}}
+    for name, validation in validations():
+        durations = measure(lambda: validation(numbers), options.repeat)
+        results['validations'][name] = summary(durations)
+    baseline = results['validations']['regex']['p50_ms']
+    for result in results['validations'].values():
+        result['speedup'] = baseline / result['p50_ms']
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
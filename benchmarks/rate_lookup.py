@@ -0,0 +1,90 @@
+"""
+Cost of matching call destinations against destination-prefix rates.
+
+Builds a PrefixIndex over synthetic prefixes and times the longest-prefix
+match of a batch of destinations one at a time and at once, against
+probing a dict with every prefix length.
+
+    python -m benchmarks.rate_lookup --prefixes 100000 --destinations 100000
+"""
+import argparse
+import json
+import random
+import time
+from benchmarks.common import measure, setup_django, summary
+
+
+def generate_prefixes(count, rng):
+    prefixes = {''}
+    while len(prefixes) < count:
+        prefixes.add('{:d}'.format(rng.randrange(11, 100)) + ''.join(
+            rng.choice('0123456789') for _ in range(rng.randrange(0, 7))))
+    return sorted(prefixes)
+
+
+def generate_destinations(count, rng):
+    return [
+        '{:d}{:09d}'.format(rng.randrange(11, 100), rng.randrange(10 ** 9))
+        for _ in range(count)
+    ]
+
+
+def lookups(prefixes):
+    from calls.tariffs import PrefixIndex
+
+    started = time.perf_counter()
+    index = PrefixIndex((prefix, prefix) for prefix in prefixes)
+    build_ms = (time.perf_counter() - started) * 1000
+    table = {prefix: prefix for prefix in prefixes}
+    lengths = sorted({len(prefix) for prefix in prefixes}, reverse=True)
+
+    def dict_probing(destinations):
+        matches = []
+        for destination in destinations:
+            for length in lengths:
+                match = table.get(destination[:length])
+                if match is not None:
+                    break
+            matches.append(match)
+        return matches
+
+    def prefix_index(destinations):
+        return [index.get(destination) for destination in destinations]
+
+    def prefix_index_batch(destinations):
+        return index.lookup_many(destinations)
+
+    return build_ms, [
+        ('dict_probing', dict_probing),
+        ('prefix_index', prefix_index),
+        ('prefix_index_batch', prefix_index_batch),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--prefixes', type=int, default=100000)
+    parser.add_argument('--destinations', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    options = parser.parse_args()
+
+    setup_django()
+    rng = random.Random(options.seed)
+    prefixes = generate_prefixes(options.prefixes, rng)
+    destinations = generate_destinations(options.destinations, rng)
+    build_ms, functions = lookups(prefixes)
+    results = {
+        'prefixes': options.prefixes,
+        'destinations': options.destinations,
+        'build_ms': build_ms,
+        'lookups': {},
+    }
+    for name, function in functions:
+        durations = measure(lambda: function(destinations), options.repeat)
+        results['lookups'][name] = summary(durations)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
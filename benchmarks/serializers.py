@@ -0,0 +1,99 @@
+"""
+Cost of serializing call logs and invoice lines.
+
+Fills a throwaway database with synthetic calls and times the DRF
+serializers on model instances against the row serializers on .values()
+rows, query included, for each number of rows.
+
+    python -m benchmarks.serializers --rows 1000 10000 100000
+"""
+import argparse
+import json
+from benchmarks.common import benchmark_database, measure, setup_django, \
+    summary
+from benchmarks.invoice_lookup import generate_rows
+
+
+def populate(connection, calls, seed):
+    from calls.models import billing_month
+    rows = list(generate_rows(calls, 1, 1, seed))
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'INSERT INTO calls_call (id, source, destination) '
+            'VALUES (%s, %s, %s)',
+            [(call_id, source, '11999999999')
+             for call_id, source, started_at, ended_at, duration in rows]
+        )
+        cursor.executemany(
+            'INSERT INTO calls_calllog (type, timestamp, call_id_id) '
+            'VALUES (%s, %s, %s)',
+            [(log_type, timestamp, call_id)
+             for call_id, source, started_at, ended_at, duration in rows
+             for log_type, timestamp in (('start', started_at),
+                                         ('end', ended_at))]
+        )
+        cursor.executemany(
+            'INSERT INTO calls_callrecord (call_id_id, source, destination, '
+            'started_at, ended_at, duration_seconds, price, billing_month) '
+            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s)',
+            [(call_id, source, '11999999999', started_at, ended_at, duration,
+              '1.00', billing_month(ended_at))
+             for call_id, source, started_at, ended_at, duration in rows]
+        )
+
+
+def serializations():
+    from calls.models import CallLog, CallRecord
+    from calls.serializers import CallLogRowSerializer, CallLogSerializer, \
+        CallRecordRowSerializer, CallRecordSerializer
+
+    logs = CallLog.objects.order_by('id')
+    records = CallRecord.objects.order_by('ended_at', 'call_id')
+
+    def call_log_serializer(count):
+        return CallLogSerializer(
+            logs.select_related('call_id')[:count], many=True).data
+
+    def call_log_rows(count):
+        return CallLogRowSerializer(
+            logs.values(*CallLogRowSerializer.fields)[:count]).data
+
+    def call_record_serializer(count):
+        return CallRecordSerializer(records[:count], many=True).data
+
+    def call_record_rows(count):
+        return CallRecordRowSerializer(
+            records.values(*CallRecordRowSerializer.fields)[:count]).data
+
+    return [
+        ('call_log_serializer', call_log_serializer),
+        ('call_log_rows', call_log_rows),
+        ('call_record_serializer', call_record_serializer),
+        ('call_record_rows', call_record_rows),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--rows', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keepdb', action='store_true')
+    options = parser.parse_args()
+
+    setup_django()
+    with benchmark_database(keepdb=options.keepdb) as connection:
+        populate(connection, max(options.rows), options.seed)
+        results = {}
+        for count in options.rows:
+            results[count] = {
+                name: summary(measure(
+                    lambda: serialization(count), options.repeat))
+                for name, serialization in serializations()
+            }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
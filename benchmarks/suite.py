@@ -0,0 +1,269 @@
+"""
+Benchmark suite of call pricing, call-log ingestion and invoice retrieval.
+
+Runs every scenario on a throwaway database with synthetic calls, writes
+the results as JSON and, given a baseline written by an earlier run,
+exits with status 1 when a metric regressed beyond the tolerance. Query
+counts are compared exactly.
+
+    python -m benchmarks.suite --output results.json \
+        --baseline benchmarks/baseline.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+from benchmarks.cdr import DISTRIBUTIONS, call_log_records, generate_calls
+from benchmarks.common import benchmark_database, measure, percentile, \
+    setup_django, summary
+from benchmarks.invoice_lookup import phone_number
+
+# call ids of the invoice subscribers start after the ingested calls
+INVOICE_CALL_IDS = 10 ** 8
+INVOICE_SUBSCRIBERS = 10 ** 6
+
+
+def metric(value, unit, better):
+    return {'value': value, 'unit': unit, 'better': better}
+
+
+def ops_per_sec(function, items, repeat):
+    durations = measure(function, repeat)
+    return len(items) / durations[len(durations) // 2]
+
+
+def compute_time_billing(start_price, start_timestamp, end_timestamp):
+    """
+    Pricing of a single call as CallInvoice.compute_time_billing did it,
+    kept as the reference of the per-call path.
+
+    :param start_price: starting price of the calculation
+    :return: price
+    """
+    from calls.pricing import MINUTE_PRICE, charged_minutes
+    minutes = charged_minutes(start_timestamp, end_timestamp)
+    return start_price + minutes * MINUTE_PRICE
+
+
+def pricing(calls, repeat):
+    """
+    :param calls: list of (call id, source, destination, start, end)
+    """
+    import numpy as np
+    from calls import tariffs
+    from calls.pricing import STANDING_PRICE, compute_prices_in_cents
+
+    index = tariffs.get_index()
+    ids, sources, destinations, starts, ends = zip(*calls)
+    start_array = np.array(starts, dtype='datetime64[us]')
+    end_array = np.array(ends, dtype='datetime64[us]')
+
+    def time_billing():
+        for start, end in zip(starts, ends):
+            compute_time_billing(STANDING_PRICE, start, end)
+
+    def tariff_index():
+        for source, destination, start, end in zip(
+                sources, destinations, starts, ends):
+            index.charge(source, destination, start, end)
+
+    def batch():
+        compute_prices_in_cents(start_array, end_array)
+
+    return {
+        'pricing.compute_time_billing.ops_per_sec': metric(
+            ops_per_sec(time_billing, calls, repeat),
+            'ops/s', 'higher'),
+        'pricing.tariff_index.ops_per_sec': metric(
+            ops_per_sec(tariff_index, calls, repeat), 'ops/s', 'higher'),
+        'pricing.batch.ops_per_sec': metric(
+            ops_per_sec(batch, calls, repeat), 'ops/s', 'higher'),
+    }
+
+
+def post_records(client, records):
+    """
+    :return: sorted durations of the requests and the mean query count
+    """
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    durations = []
+    queries = 0
+    for record in records:
+        with CaptureQueriesContext(connection) as context:
+            started = time.perf_counter()
+            response = client.post('/call-log', record, format='json')
+            durations.append(time.perf_counter() - started)
+        assert response.status_code == 201, response.content
+        queries += len(context.captured_queries)
+    return sorted(durations), queries / len(records)
+
+
+def ingestion(calls, batch_size):
+    from rest_framework.test import APIClient
+
+    client = APIClient()
+    half = len(calls) // 2
+    durations, queries = post_records(
+        client, list(call_log_records(calls[:half])))
+    records = list(call_log_records(calls[half:]))
+    started = time.perf_counter()
+    for position in range(0, len(records), batch_size):
+        response = client.post(
+            '/call-log/batch', records[position:position + batch_size],
+            format='json')
+        assert response.status_code == 201, response.content
+    batch_seconds = time.perf_counter() - started
+    return {
+        'call_log.requests_per_sec': metric(
+            len(durations) / sum(durations), 'req/s', 'higher'),
+        'call_log.p99_ms': metric(
+            percentile(durations, 99) * 1000, 'ms', 'lower'),
+        'call_log.queries_per_request': metric(
+            queries, 'queries', 'lower'),
+        'call_log.batch.records_per_sec': metric(
+            len(records) / batch_seconds, 'records/s', 'higher'),
+    }
+
+
+def populate_subscriber(size, options):
+    from calls.ingestion import ingest_call_logs
+
+    calls = generate_calls(
+        size, 1, options.distribution, options.mean_seconds,
+        seed=options.seed, first_call_id=INVOICE_CALL_IDS + size,
+        first_subscriber=INVOICE_SUBSCRIBERS + size)
+    records = list(call_log_records(calls))
+    for position in range(0, len(records), options.batch_size):
+        ingest_call_logs(records[position:position + options.batch_size])
+    return phone_number(INVOICE_SUBSCRIBERS + size)
+
+
+def get_invoice(client, url, clear):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+    from calls import invoice_cache
+
+    if clear:
+        invoice_cache.get_cache().clear()
+    with CaptureQueriesContext(connection) as context:
+        response = client.get(url)
+    assert response.status_code == 200, response.content
+    return len(context.captured_queries)
+
+
+def invoice_retrieval(size, options):
+    from rest_framework.test import APIClient
+
+    client = APIClient()
+    url = '/call-invoice/{source}?date=012018'.format(
+        source=populate_subscriber(size, options))
+    results = {}
+    for name, clear in (('uncached', True), ('cached', False)):
+        queries = get_invoice(client, url, clear)
+        durations = summary(measure(
+            lambda: get_invoice(client, url, clear), options.requests))
+        prefix = 'call_invoice.{size}.{name}.'.format(size=size, name=name)
+        results.update({
+            prefix + 'p50_ms': metric(durations['p50_ms'], 'ms', 'lower'),
+            prefix + 'p99_ms': metric(durations['p99_ms'], 'ms', 'lower'),
+            prefix + 'queries': metric(queries, 'queries', 'lower'),
+        })
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """
+    :return: list of messages of the metrics worse than the baseline
+    """
+    messages = []
+    for name, expected in sorted(baseline['metrics'].items()):
+        actual = results['metrics'].get(name)
+        if actual is None:
+            continue
+        allowed = 0 if expected['unit'] == 'queries' else tolerance
+        if expected['better'] == 'higher':
+            regressed = actual['value'] < expected['value'] * (1 - allowed)
+        else:
+            regressed = actual['value'] > expected['value'] * (1 + allowed)
+        if regressed:
+            messages.append('{name}: {actual:.2f} {unit}, baseline '
+                            '{expected:.2f} {unit}'.format(
+                                name=name, actual=actual['value'],
+                                expected=expected['value'],
+                                unit=expected['unit']))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--calls', type=int, default=10000,
+                        help="Calls priced by the pricing scenarios")
+    parser.add_argument('--ingested-calls', type=int, default=1000,
+                        help="Calls posted to the call-log endpoints")
+    parser.add_argument('--batch-size', type=int, default=500)
+    parser.add_argument('--subscriber-sizes', type=int, nargs='+',
+                        default=[10, 100, 1000],
+                        help="Calls of each subscriber whose invoice is read")
+    parser.add_argument('--requests', type=int, default=50,
+                        help="Invoice requests of each subscriber size")
+    parser.add_argument(
+        '--distribution', choices=sorted(DISTRIBUTIONS),
+        default='exponential')
+    parser.add_argument('--mean-seconds', type=float, default=180)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keepdb', action='store_true')
+    parser.add_argument('--output', help="File the results are written to")
+    parser.add_argument('--baseline', help="Results of an earlier run")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Fraction a timing may be worse than baseline")
+    options = parser.parse_args()
+
+    setup_django()
+    import django
+    from django.db import connection
+
+    metrics = {}
+    with benchmark_database(keepdb=options.keepdb):
+        calls = list(generate_calls(
+            options.calls, distribution=options.distribution,
+            mean_seconds=options.mean_seconds, seed=options.seed))
+        metrics.update(pricing(calls, options.repeat))
+        metrics.update(ingestion(
+            calls[:options.ingested_calls], options.batch_size))
+        for size in options.subscriber_sizes:
+            metrics.update(invoice_retrieval(size, options))
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+        },
+        'options': {
+            name: value for name, value in vars(options).items()
+            if name not in ('output', 'baseline', 'keepdb')
+        },
+        'metrics': metrics,
+    }
+    output = json.dumps(results, indent=2, sort_keys=True, default=str)
+    if options.output:
+        with open(options.output, 'w') as stream:
+            stream.write(output + '\n')
+    else:
+        print(output)
+
+    if options.baseline:
+        with open(options.baseline) as stream:
+            baseline = json.load(stream)
+        messages = regressions(results, baseline, options.tolerance)
+        for message in messages:
+            print(message, file=sys.stderr)
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+"""
+ASGI config for billcalls project.
+
+Django 2.2 only speaks WSGI, so the call-log records posted to
+/call-log/ingest are ingested by an asynchronous application of their own
+and every other request, POST /call-log included, is handed to the WSGI
+application in a thread pool. Run it with an ASGI server:
+
+    uvicorn billcalls.asgi:application --workers 4
+"""
+
+import os
+
+from asgiref.wsgi import WsgiToAsgi
+from django.core.wsgi import get_wsgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'billcalls.settings')
+
+wsgi_application = get_wsgi_application()
+
+from calls.async_ingestion import CallLogApplication  # noqa: E402
+
+
+class Router(object):
+
+    def __init__(self, call_log, default):
+        self.call_log = call_log
+        self.default = default
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http' and scope['method'] == 'POST' and \
+                scope['path'] == '/call-log/ingest':
+            await self.call_log(scope, receive, send)
+        else:
+            await self.default(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                # answer the records still waiting to be ingested
+                await self.call_log.batcher.drain()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+
+application = Router(CallLogApplication(), WsgiToAsgi(wsgi_application))
@@ -0,0 +1,163 @@
+"""
+Pool of the database connections of a process, shared by its threads. A
+connection idle for longer than the check interval is tested before being
+handed out again, broken ones are dropped and replaced. Pools are kept per
+process, a forked child never uses the connections of its parent.
+"""
+
+import os
+import threading
+from collections import deque
+from time import monotonic
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+
+    def __init__(self, connect, max_size=10, timeout=10, check_interval=30):
+        """
+        :param connect: function opening a new connection
+        :param max_size: maximum number of connections open at once
+        :param timeout: seconds waiting for a connection before giving up
+        :param check_interval: seconds a connection can stay idle and be
+        handed out again without a health check
+        """
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.check_interval = check_interval
+        # (connection, released at), the most recently released last
+        self.idle = deque()
+        self.size = 0
+        self.condition = threading.Condition()
+        self.counters = dict.fromkeys(
+            ('created', 'checkouts', 'waits', 'timeouts', 'discarded'), 0)
+
+    def acquire(self):
+        deadline = monotonic() + self.timeout
+        while True:
+            connection, released_at = self.reserve(deadline)
+            if connection is None:
+                try:
+                    connection = self.connect()
+                except Exception:
+                    self.forget()
+                    raise
+                with self.condition:
+                    self.counters['created'] += 1
+                return connection
+            if monotonic() - released_at < self.check_interval or \
+                    self.is_usable(connection):
+                return connection
+            self.discard(connection)
+
+    def reserve(self, deadline):
+        """
+        :return: an idle connection and when it was released, or None when
+        a new connection can be opened
+        """
+        with self.condition:
+            waited = False
+            while not self.idle and self.size >= self.max_size:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    self.counters['timeouts'] += 1
+                    raise PoolTimeout(
+                        "No database connection was released in %s seconds, "
+                        "all %d are in use." % (self.timeout, self.max_size))
+                waited = True
+                self.condition.wait(remaining)
+            self.counters['checkouts'] += 1
+            self.counters['waits'] += waited
+            if self.idle:
+                return self.idle.pop()
+            self.size += 1
+            return None, None
+
+    def release(self, connection):
+        if not self.reset(connection):
+            self.discard(connection)
+            return
+        with self.condition:
+            self.idle.append((connection, monotonic()))
+            self.condition.notify()
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self.condition:
+            self.counters['discarded'] += 1
+        self.forget()
+
+    def forget(self):
+        with self.condition:
+            self.size -= 1
+            self.condition.notify()
+
+    @staticmethod
+    def is_usable(connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            # out of autocommit the check opened a transaction, the session
+            # cannot be set up again while it is open
+            connection.rollback()
+        except Exception:
+            return False
+        return True
+
+    @staticmethod
+    def reset(connection):
+        """
+        Roll back what the last user left open and restore the session
+        defaults, so the next one finds the connection as a new one.
+        """
+        if connection.closed:
+            return False
+        try:
+            connection.rollback()
+            connection.autocommit = False
+        except Exception:
+            return False
+        return True
+
+    def stats(self):
+        with self.condition:
+            stats = dict(self.counters)
+            stats.update(
+                max_size=self.max_size, idle=len(self.idle),
+                in_use=self.size - len(self.idle))
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, connect, **options):
+    """
+    :return: the pool of the database alias in this process, created with
+    the connect function and options on first use
+    """
+    key = (os.getpid(), alias)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(connect, **options)
+    return pool
+
+
+def pool_stats():
+    """
+    :return: dict of the stats of the pool of each alias in this process
+    """
+    pid = os.getpid()
+    with _pools_lock:
+        pools = [(alias, pool) for (pool_pid, alias), pool in _pools.items()
+                 if pool_pid == pid]
+    return {alias: pool.stats() for alias, pool in pools}
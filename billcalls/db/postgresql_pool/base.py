@@ -0,0 +1,42 @@
+import functools
+from django.conf import settings
+from django.db.backends.postgresql import base
+from billcalls.db.pool import PoolTimeout, get_pool
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend taking its connections from the pool of the process
+    and giving them back when Django closes them, at the end of each request
+    with CONN_MAX_AGE 0.
+    """
+    pool = None
+
+    def get_new_connection(self, conn_params):
+        options = settings.DATABASE_POOL
+        self.pool = get_pool(
+            self.alias,
+            functools.partial(base.Database.connect, **conn_params),
+            max_size=options['MAX_SIZE'], timeout=options['TIMEOUT'],
+            check_interval=options['CHECK_INTERVAL'])
+        try:
+            connection = self.pool.acquire()
+        except PoolTimeout as e:
+            raise base.Database.OperationalError(str(e))
+
+        # as in the parent, the isolation level is read from the connection
+        # before autocommit is set
+        try:
+            self.isolation_level = self.settings_dict['OPTIONS'][
+                'isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.release(self.connection)
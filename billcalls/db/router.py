@@ -0,0 +1,113 @@
+"""
+Routing of the reads of the reporting models to the read replicas listed
+in DATABASE_REPLICAS. Reads stay on the primary database inside
+transactions, after the thread wrote anything in the current request, and
+within use_primary(). Replicas lagging more than DATABASE_REPLICA_MAX_LAG
+seconds behind are left out until they catch up.
+"""
+
+import random
+import threading
+from contextlib import contextmanager
+from time import monotonic
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+
+_state = threading.local()
+_lags = {}
+
+
+@contextmanager
+def use_primary():
+    """
+    Send every read in the block to the primary database.
+    """
+    previous = getattr(_state, 'primary', False)
+    _state.primary = True
+    try:
+        yield
+    finally:
+        _state.primary = previous
+
+
+def forget_writes(**kwargs):
+    _state.wrote = False
+
+
+request_started.connect(forget_writes)
+
+
+def replica_lag(alias):
+    """
+    :return: seconds the replica is behind the primary, None when it cannot
+    be reached
+    """
+    connection = connections[alias]
+    if connection.vendor != 'postgresql':
+        # there is no replication to lag behind, the copy is what it is
+        return 0.0
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT CASE WHEN pg_is_in_recovery() THEN COALESCE(EXTRACT('
+                'EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) '
+                'ELSE 0 END')
+            lag, = cursor.fetchone()
+    except DatabaseError:
+        return None
+    # an idle primary commits nothing to replay, the lag is not a backlog
+    return max(float(lag), 0.0)
+
+
+def known_lag(alias):
+    """
+    :return: lag of the replica, checked at most every
+    DATABASE_REPLICA_LAG_CHECK_INTERVAL seconds
+    """
+    now = monotonic()
+    checked = _lags.get(alias)
+    if checked is None or \
+            now - checked[0] >= settings.DATABASE_REPLICA_LAG_CHECK_INTERVAL:
+        checked = _lags[alias] = (now, replica_lag(alias))
+    return checked[1]
+
+
+def available_replicas():
+    return [
+        alias for alias in settings.DATABASE_REPLICAS
+        if known_lag(alias) is not None and
+        known_lag(alias) <= settings.DATABASE_REPLICA_MAX_LAG
+    ]
+
+
+class ReplicaRouter(object):
+
+    def db_for_read(self, model, **hints):
+        if not settings.DATABASE_REPLICAS or \
+                model._meta.label not in settings.DATABASE_REPLICA_MODELS:
+            return None
+        if getattr(_state, 'primary', False) or \
+                getattr(_state, 'wrote', False) or \
+                connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        replicas = available_replicas()
+        return random.choice(replicas) if replicas else None
+
+    def db_for_write(self, model, **hints):
+        # reads of the rest of the request must see what it wrote
+        _state.wrote = True
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS}.union(settings.DATABASE_REPLICAS)
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # replicas receive the schema from the primary
+        if db in settings.DATABASE_REPLICAS:
+            return False
+        return None
@@ -31,6 +31,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'calls.middleware.InstrumentationMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -95,6 +96,74 @@ USE_L10N = True
 
 USE_TZ = True
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'billcalls',
+    }
+}
+
+INVOICE_CACHE_ALIAS = 'default'
+
+INVOICE_CACHE_TIMEOUT = 60 * 60 * 24
+
+# seconds between checks of the tariffs version, a change made by another
+# process is picked up at most this long after it is committed
+TARIFF_RELOAD_INTERVAL = 5
+
+# bill ended calls in the run_billing_workers command instead of in the
+# request that logs the end of the call
+ASYNC_BILLING = False
+
+# record per-view timings and query counts, served on /metrics
+INSTRUMENTATION_ENABLED = False
+
+# queries of instrumented requests slower than this are logged, None
+# disables the log
+SLOW_QUERY_MS = None
+
+# fraction of the slow queries logged
+SLOW_QUERY_SAMPLE_RATE = 1.0
+
+# seconds a database connection is kept open for the next requests of its
+# thread, when the pool is disabled
+DATABASE_CONN_MAX_AGE = 600
+
+# share the PostgreSQL connections of each process between its threads, a
+# connection idle for CHECK_INTERVAL seconds is tested before being reused
+# and a request waits up to TIMEOUT seconds when all MAX_SIZE are in use
+DATABASE_POOL = {
+    'ENABLED': False,
+    'MAX_SIZE': 10,
+    'TIMEOUT': 10,
+    'CHECK_INTERVAL': 30,
+}
+
+POOLED_ENGINES = (
+    'django.db.backends.postgresql',
+    'django.db.backends.postgresql_psycopg2',
+)
+
+DATABASE_ROUTERS = ['billcalls.db.router.ReplicaRouter']
+
+# aliases of DATABASES holding read replicas of the default database, the
+# reads of DATABASE_REPLICA_MODELS are spread between them
+DATABASE_REPLICAS = []
+
+DATABASE_REPLICA_MODELS = [
+    'calls.CallRecord', 'calls.InvoiceSummary', 'calls.InvoiceLine'
+]
+
+# seconds a replica can lag behind the primary and still be read from
+DATABASE_REPLICA_MAX_LAG = 30
+
+# seconds between checks of the lag of each replica by a process
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = 5
+
+# seconds the bills of a subscriber are read from the primary after one of
+# their calls is billed, longer than the replicas are allowed to lag
+DATABASE_REPLICA_PIN_SECONDS = 60
+
 STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 STATIC_ROOT = os.path.join(BASE_DIR, 'staticfiles')
@@ -109,4 +178,14 @@ settings = dynaconf.DjangoDynaconf(
 )
 
 if settings.ENV != 'development':
-    DATABASES['default'] = dj_database_url.config(conn_max_age=600)
+    DATABASES['default'] = dj_database_url.config(
+        conn_max_age=settings.DATABASE_CONN_MAX_AGE)
+
+for database in DATABASES.values():
+    if settings.DATABASE_POOL['ENABLED'] and \
+            database['ENGINE'] in POOLED_ENGINES:
+        database['ENGINE'] = 'billcalls.db.postgresql_pool'
+        # connections go back to the pool at the end of each request
+        database['CONN_MAX_AGE'] = 0
+    else:
+        database.setdefault('CONN_MAX_AGE', settings.DATABASE_CONN_MAX_AGE)
@@ -18,7 +18,7 @@ from django.urls import path
 from rest_framework.schemas import get_schema_view
 from rest_framework.routers import DefaultRouter
 
-from calls.views import CallLogViewSet, CallInvoiceViewSet
+from calls.views import CallLogViewSet, CallInvoiceViewSet, metrics
 
 
 schema_view = get_schema_view(
@@ -32,6 +32,7 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('doc', schema_view, name='Doc API Call Record'),
+    path('metrics', metrics, name='metrics'),
 ]
 
 router = DefaultRouter(trailing_slash=False)
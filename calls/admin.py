@@ -1,6 +1,17 @@
 from django.contrib import admin
-from .models import CallLog, Call, CallInvoice
+from .models import BillingJob, CallLog, Call, CallInvoice, CallRecord, \
+    Holiday, InvoiceSummary, PendingCallEnd, PlanSubscription, \
+    ReducedWindow, TariffPlan, TariffRate
 
 admin.site.register(Call)
 admin.site.register(CallLog)
 admin.site.register(CallInvoice)
+admin.site.register(CallRecord)
+admin.site.register(InvoiceSummary)
+admin.site.register(BillingJob)
+admin.site.register(PendingCallEnd)
+admin.site.register(TariffPlan)
+admin.site.register(PlanSubscription)
+admin.site.register(TariffRate)
+admin.site.register(ReducedWindow)
+admin.site.register(Holiday)
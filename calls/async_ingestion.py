@@ -0,0 +1,179 @@
+"""
+Asynchronous ingestion of single call log records for the ASGI deployment.
+Requests only wait on the event loop, their records are gathered for a few
+milliseconds and ingested together by CallLogBatch in a worker thread, so
+a process keeps thousands of collector connections open with a handful of
+database round trips per batch instead of per record.
+"""
+
+import asyncio
+import json
+import logging
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http.request import split_domain_port, validate_host
+from calls.ingestion import ingest_call_logs, record_response
+
+
+logger = logging.getLogger(__name__)
+
+
+def ingest_batch(records):
+    """
+    :return: list with the result of each record, or the exception raised
+    while storing it
+    """
+    close_old_connections()
+    try:
+        try:
+            return ingest_call_logs(records)
+        except Exception as e:
+            if len(records) == 1:
+                return [e]
+            logger.exception(
+                "Ingesting %d records at once failed, ingesting them one "
+                "at a time", len(records))
+        results = []
+        for record in records:
+            try:
+                results.extend(ingest_call_logs([record]))
+            except Exception as e:
+                results.append(e)
+        return results
+    finally:
+        close_old_connections()
+
+
+class IngestionBatcher(object):
+
+    def __init__(self, max_size=500, max_delay=0.005):
+        """
+        :param max_size: number of records ingested at once
+        :param max_delay: seconds a record waits for others to be ingested
+        with
+        """
+        self.max_size = max_size
+        self.max_delay = max_delay
+        self.pending = []
+        self.timer = None
+        self.lock = None
+        self.tasks = set()
+
+    async def submit(self, record):
+        """
+        :return: result of the record, as returned by ingest_call_logs
+        """
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.pending.append((record, future))
+        if len(self.pending) >= self.max_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.flush)
+        result = await future
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            task = asyncio.ensure_future(self.ingest(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def ingest(self, batch):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        # batches are ingested one at a time, in the order they were sent
+        async with self.lock:
+            try:
+                results = await sync_to_async(
+                    ingest_batch, thread_sensitive=True
+                )([record for record, future in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+        for (record, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def drain(self):
+        self.flush()
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+def allowed_host(scope):
+    host = dict(scope['headers']).get(b'host', b'').decode('latin-1')
+    domain, port = split_domain_port(host)
+    allowed_hosts = settings.ALLOWED_HOSTS
+    if settings.DEBUG and not allowed_hosts:
+        allowed_hosts = ['.localhost', '127.0.0.1', '[::1]']
+    return bool(domain) and validate_host(domain, allowed_hosts)
+
+
+async def read_body(receive):
+    body = b''
+    more_body = True
+    while more_body:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return None
+        body += message.get('body', b'')
+        more_body = message.get('more_body', False)
+        if len(body) > settings.DATA_UPLOAD_MAX_MEMORY_SIZE:
+            raise ValueError("The request body is too large.")
+    return body
+
+
+async def send_json(send, status, data):
+    content = json.dumps(data).encode()
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(content)).encode()),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': content})
+
+
+class CallLogApplication(object):
+    """
+    ASGI application of POST /call-log/ingest, answering as the ingest
+    action of CallLogViewSet does with the result the batch endpoint gives
+    for the record.
+    """
+
+    def __init__(self, batcher=None):
+        self.batcher = batcher or IngestionBatcher()
+
+    async def __call__(self, scope, receive, send):
+        if not allowed_host(scope):
+            await send_json(send, 400, "Invalid HTTP_HOST header.")
+            return
+        try:
+            body = await read_body(receive)
+        except ValueError as e:
+            await send_json(send, 413, str(e))
+            return
+        if body is None:
+            return
+        try:
+            # an empty body is parsed as an empty record, as by DRF
+            record = json.loads(body.decode()) if body else {}
+        except ValueError as e:
+            await send_json(
+                send, 400, {'detail': "JSON parse error - %s" % e})
+            return
+        if not isinstance(record, dict):
+            await send_json(
+                send, 400, "The request body must be a call log record.")
+            return
+        result = await self.batcher.submit(record)
+        await send_json(send, *record_response(result))
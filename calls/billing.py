@@ -0,0 +1,143 @@
+"""
+Billing of ended calls, either right away or through BillingJob rows
+claimed by the run_billing_workers command when ASYNC_BILLING is enabled.
+"""
+
+import logging
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from calls import tariffs
+from calls.models import BillingJob, CallInvoice, CallLog, CallRecord, \
+    as_stored
+from calls.pricing import from_cents
+from calls.summaries import add_records
+
+
+logger = logging.getLogger(__name__)
+
+
+def bill_calls(bills):
+    """
+    Create the invoices, call records and bill lines of ended calls with
+    bulk inserts, must be called inside a transaction. The calls are priced
+    together by the vectorized tariff index.
+
+    :param bills: list of (call, start timestamp, end timestamp)
+    """
+    if not bills:
+        return
+    calls = [call for call, start, end in bills]
+    starts = [as_stored(start) for call, start, end in bills]
+    ends = [as_stored(end) for call, start, end in bills]
+    prices, minutes = tariffs.get_index().charges_in_cents(
+        [call.source for call in calls],
+        [call.destination for call in calls],
+        starts, ends)
+    invoices = []
+    records = []
+    for call, start_timestamp, end_timestamp, price, normal in zip(
+            calls, starts, ends, prices.tolist(), minutes.tolist()):
+        invoice = CallInvoice(call_id=call)
+        invoice.set_charge(
+            start_timestamp, end_timestamp, from_cents(price), normal)
+        invoices.append(invoice)
+        records.append(CallRecord.from_invoice(invoice))
+    CallInvoice.objects.bulk_create(invoices)
+    CallRecord.objects.bulk_create(records)
+    add_records(records, new=True)
+
+
+def enqueue_calls(calls):
+    BillingJob.objects.bulk_create(
+        [BillingJob(call_id=call) for call in calls])
+
+
+def submit_calls(bills):
+    """
+    Bill the calls or queue them for the billing workers, according to
+    the ASYNC_BILLING setting.
+
+    :param bills: list of (call, start timestamp, end timestamp)
+    """
+    if settings.ASYNC_BILLING:
+        enqueue_calls([call for call, start, end in bills])
+    else:
+        bill_calls(bills)
+
+
+def retry_delay(attempts):
+    return timedelta(seconds=min(2 ** attempts, 3600))
+
+
+def process_jobs(batch_size=500, max_attempts=5):
+    """
+    Claim a batch of pending jobs and bill their calls. Jobs are claimed
+    with SELECT ... FOR UPDATE SKIP LOCKED so concurrent workers never take
+    the same job.
+
+    :return: number of jobs claimed
+    """
+    with transaction.atomic():
+        jobs = list(BillingJob.objects.select_for_update(
+            skip_locked=True
+        ).filter(
+            status='pending', available_at__lte=timezone.now()
+        ).order_by('id')[:batch_size])
+        if not jobs:
+            return 0
+        try:
+            with transaction.atomic():
+                bill_jobs(jobs)
+        except Exception:
+            logger.exception(
+                "Billing a batch of %d jobs failed, retrying one by one.",
+                len(jobs))
+            for job in jobs:
+                bill_job(job, max_attempts)
+        else:
+            BillingJob.objects.filter(
+                id__in=[job.id for job in jobs]).delete()
+    return len(jobs)
+
+
+def bill_jobs(jobs):
+    call_ids = [job.call_id_id for job in jobs]
+    billed = set(CallInvoice.objects.filter(
+        call_id__in=call_ids).values_list('call_id', flat=True))
+    logs = CallLog.objects.filter(
+        call_id__in=set(call_ids) - billed
+    ).select_related('call_id')
+    timestamps = {}
+    for log in logs:
+        call_logs = timestamps.setdefault(
+            log.call_id_id, {'call': log.call_id})
+        call_logs[log.type] = log.timestamp
+    bills = []
+    for call_id in call_ids:
+        if call_id in billed:
+            continue
+        call_logs = timestamps.get(call_id, {})
+        if 'start' not in call_logs or 'end' not in call_logs:
+            raise ValueError(
+                "Call %s has no start or end record." % call_id)
+        bills.append(
+            (call_logs['call'], call_logs['start'], call_logs['end']))
+    bill_calls(bills)
+
+
+def bill_job(job, max_attempts):
+    try:
+        with transaction.atomic():
+            bill_jobs([job])
+    except Exception as exc:
+        job.attempts += 1
+        job.last_error = repr(exc)
+        job.available_at = timezone.now() + retry_delay(job.attempts)
+        if job.attempts >= max_attempts:
+            job.status = 'failed'
+        job.save()
+        logger.warning("Billing call %s failed: %r", job.call_id_id, exc)
+    else:
+        job.delete()
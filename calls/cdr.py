@@ -0,0 +1,117 @@
+"""
+Import of call detail record (CDR) files: CSV or newline delimited JSON,
+optionally gzipped, holding the same records accepted by the call-log
+endpoint. Files are read as a stream and loaded in chunks, calls and their
+logs are copied with COPY on PostgreSQL.
+"""
+
+import csv
+import gzip
+import io
+import json
+from django.db import connection
+from calls.ingestion import CallLogBatch
+
+
+CSV_FIELDS = ['type', 'call_id', 'timestamp', 'source', 'destination']
+FORMATS = ('csv', 'ndjson')
+
+
+def detect_format(path):
+    name = path.lower()
+    if name.endswith('.gz'):
+        name = name[:-len('.gz')]
+    if name.endswith('.csv'):
+        return 'csv'
+    if name.endswith(('.ndjson', '.jsonl', '.json')):
+        return 'ndjson'
+    raise ValueError("Cannot tell the format of %s, use the csv or ndjson "
+                     "extension." % path)
+
+
+def open_cdr(path):
+    with open(path, 'rb') as stream:
+        gzipped = stream.read(2) == b'\x1f\x8b'
+    if gzipped:
+        return gzip.open(path, 'rt', encoding='utf-8', newline='')
+    return open(path, 'rt', encoding='utf-8', newline='')
+
+
+def read_csv(stream):
+    reader = csv.DictReader(stream)
+    missing = set(CSV_FIELDS[:3]) - set(reader.fieldnames or [])
+    if missing:
+        raise ValueError(
+            "Missing CSV columns: %s." % ', '.join(sorted(missing)))
+    for row in reader:
+        # empty cells are left out like missing keys of a JSON record
+        yield {key: value for key, value in row.items()
+               if key in CSV_FIELDS and value != ''}
+
+
+def read_ndjson(stream):
+    for line_number, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as exc:
+            # reported as an invalid record, the import goes on
+            yield 'NDJSON parse error on line %d - %s' % (line_number, exc)
+
+
+def read_records(stream, file_format):
+    if file_format == 'csv':
+        return read_csv(stream)
+    return read_ndjson(stream)
+
+
+def copy_insert(model, objs):
+    """
+    Insert the objects with COPY, only for models whose primary key is
+    given or generated by the database.
+    """
+    fields = [
+        field for field in model._meta.concrete_fields
+        if not (field.primary_key and getattr(objs[0], field.attname) is None)
+    ]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for obj in objs:
+        row = []
+        for field in fields:
+            value = field.get_db_prep_save(
+                getattr(obj, field.attname), connection)
+            row.append(r'\N' if value is None else value)
+        writer.writerow(row)
+    buffer.seek(0)
+    sql = "COPY {table} ({columns}) FROM STDIN WITH (FORMAT csv, NULL " \
+          "'\\N')".format(
+              table=connection.ops.quote_name(model._meta.db_table),
+              columns=', '.join(
+                  connection.ops.quote_name(field.column) for field in fields)
+          )
+    with connection.cursor() as cursor:
+        cursor.copy_expert(sql, buffer)
+
+
+class CdrBatch(CallLogBatch):
+    """
+    Chunk of an imported file, validated, paired and billed like a batch
+    sent to the call-log endpoint.
+    """
+
+    def validate_records(self):
+        valid = super(CdrBatch, self).validate_records()
+        for index, record in enumerate(self.records):
+            if isinstance(record, str):
+                # lines that are not JSON are read as their parse error
+                self.results[index]['errors'] = {'non_field_errors': [record]}
+        return valid
+
+    @staticmethod
+    def insert(model, objs):
+        if connection.vendor == 'postgresql' and objs:
+            copy_insert(model, objs)
+        else:
+            CallLogBatch.insert(model, objs)
@@ -0,0 +1,223 @@
+"""
+Bulk ingestion of call log records. Records are validated one by one only
+for what does not need the database, everything else is checked with a few
+set-based queries and the valid records are stored with bulk inserts.
+End records of calls that have not started are parked until the start
+arrives.
+"""
+
+from django.db import transaction
+from calls.billing import submit_calls
+from calls.models import Call, CallLog, PendingCallEnd
+from calls.pending import match_pending_ends, pending_ends
+from calls.serializers import AbstractCallLogSerializer
+from calls.validators import check_phone_numbers, phone_number_error
+
+
+# status of the response to a record posted on its own
+STATUS_CODES = {'created': 201, 'pending': 202, 'error': 400}
+
+
+class CallLogBatch(object):
+
+    def __init__(self, records):
+        self.records = records
+        self.results = [None] * len(records)
+
+    def error(self, index, errors):
+        self.results[index] = {
+            'index': index,
+            'status': 'error',
+            'errors': errors
+        }
+
+    def created(self, index, data):
+        self.results[index] = {
+            'index': index,
+            'status': 'created',
+            'call_id': data['call_id'],
+            'type': data['type']
+        }
+
+    def pending(self, index, data):
+        self.created(index, data)
+        self.results[index]['status'] = 'pending'
+
+    def validate_records(self):
+        # validations that do not need the database
+        valid = []
+        for index, record in enumerate(self.records):
+            if not isinstance(record, dict):
+                self.error(index, {
+                    'non_field_errors': ["Each record must be an object."]
+                })
+                continue
+            serializer = AbstractCallLogSerializer(data=record)
+            if not serializer.is_valid():
+                self.error(index, serializer.errors)
+                continue
+            data = serializer.validated_data
+            if data['call_id'] is None:
+                self.error(index, {
+                    'call_id': ["This field may not be null."]
+                })
+                continue
+            valid.append((index, data))
+        return self.validate_calls(valid)
+
+    def validate_calls(self, valid):
+        # phone numbers of the starts are checked a column at a time
+        starts = [data for index, data in valid if data['type'] == 'start']
+        checks = {
+            field: iter(check_phone_numbers(
+                data[field] for data in starts))
+            for field in ('source', 'destination')
+        }
+        calls = []
+        for index, data in valid:
+            if data['type'] == 'start':
+                errors = {
+                    field: [phone_number_error(data[field])]
+                    for field, check in checks.items()
+                    if not next(check)
+                }
+                if not errors and data['source'] == data['destination']:
+                    errors['non_field_errors'] = [
+                        'Source and destination cannot contain the same '
+                        'value.'
+                    ]
+                if errors:
+                    self.error(index, errors)
+                    continue
+            calls.append((index, data))
+        return calls
+
+    def ingest(self):
+        valid = self.validate_records()
+        starts = {}
+        ends = {}
+        for index, data in valid:
+            records = starts if data['type'] == 'start' else ends
+            if data['call_id'] in records:
+                self.error(index, {
+                    'non_field_errors': [
+                        "The fields 'call_id' and 'type' must make a "
+                        "unique set."
+                    ]
+                })
+                continue
+            records[data['call_id']] = (index, data)
+
+        existing_calls = set(Call.objects.filter(
+            id__in=starts.keys()).values_list('id', flat=True))
+        for call_id in existing_calls:
+            index, data = starts.pop(call_id)
+            self.error(index, {
+                'non_field_errors': [
+                    "The fields 'call_id' must make a unique set."
+                ]
+            })
+
+        pending = pending_ends(list(starts.keys()) + list(ends.keys()))
+        parked = {}
+        stored_starts = {}
+        stored_ends = set()
+        stored_logs = CallLog.objects.filter(
+            call_id__in=ends.keys()
+        ).values_list(
+            'call_id', 'type', 'timestamp',
+            'call_id__source', 'call_id__destination'
+        )
+        for call_id, log_type, timestamp, source, destination in stored_logs:
+            if log_type == 'start':
+                stored_starts[call_id] = (timestamp, source, destination)
+            else:
+                stored_ends.add(call_id)
+        for call_id, (index, data) in list(ends.items()):
+            error = None
+            if call_id in stored_ends or call_id in pending:
+                error = "The fields 'call_id' and 'type' must make a " \
+                        "unique set."
+            elif call_id in starts:
+                start = starts[call_id][1]
+                start_timestamp = start['timestamp']
+                call = Call(id=call_id, source=start['source'],
+                            destination=start['destination'])
+            elif call_id in stored_starts:
+                start_timestamp, source, destination = stored_starts[call_id]
+                call = Call(id=call_id, source=source,
+                            destination=destination)
+            else:
+                parked[call_id] = ends.pop(call_id)
+                continue
+            if error is None and data['timestamp'].replace(tzinfo=None) \
+                    <= start_timestamp.replace(tzinfo=None):
+                error = "The call end time cannot be earlier or equal than " \
+                        "the start time."
+            if error is not None:
+                del ends[call_id]
+                self.error(index, {'non_field_errors': [error]})
+                continue
+            data['start_timestamp'] = start_timestamp
+            data['call'] = call
+
+        self.store(starts, ends, parked, pending)
+        for index, data in list(starts.values()) + list(ends.values()):
+            self.created(index, data)
+        for index, data in parked.values():
+            self.pending(index, data)
+        return self.results
+
+    @staticmethod
+    def insert(model, objs):
+        model.objects.bulk_create(objs)
+
+    def store(self, starts, ends, parked, pending):
+        calls = [
+            Call(id=call_id, source=data['source'],
+                 destination=data['destination'])
+            for call_id, (index, data) in starts.items()
+        ]
+        logs = [
+            CallLog(type=data['type'], timestamp=data['timestamp'],
+                    call_id_id=call_id)
+            for records in (starts, ends)
+            for call_id, (index, data) in records.items()
+        ]
+        bills = [
+            (data['call'], data['start_timestamp'], data['timestamp'])
+            for call_id, (index, data) in ends.items()
+        ]
+        parked = [
+            PendingCallEnd(call_id=call_id, timestamp=data['timestamp'])
+            for call_id, (index, data) in parked.items()
+        ]
+        with transaction.atomic():
+            self.insert(Call, calls)
+            self.insert(CallLog, logs)
+            submit_calls(bills)
+            PendingCallEnd.objects.bulk_create(parked)
+            match_pending_ends([
+                (call, starts[call.id][1]['timestamp']) for call in calls
+            ], pending)
+
+
+def ingest_call_logs(records):
+    """
+    :param records: list of call log records as sent to the call-log endpoint
+    :return: list with the result of each record, in the same order
+    """
+    return CallLogBatch(records).ingest()
+
+
+def record_response(result):
+    """
+    :param result: result of a record, as returned by ingest_call_logs
+    :return: status and body of the response to the record posted on its
+    own, the errors alone when it is rejected
+    """
+    if result['status'] == 'error':
+        return STATUS_CODES['error'], result['errors']
+    data = dict(result)
+    del data['index']
+    return STATUS_CODES[result['status']], data
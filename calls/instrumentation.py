@@ -0,0 +1,274 @@
+"""
+Per-view timings and query counts of the requests, recorded by
+InstrumentationMiddleware when INSTRUMENTATION_ENABLED is set and served in
+the Prometheus text format on /metrics. Metrics are kept in the memory of
+each process, so every worker is scraped on its own.
+"""
+
+import logging
+import random
+import threading
+from bisect import bisect_left
+from time import perf_counter
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values):
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('\n', r'\n') \
+            .replace('"', r'\"')
+    return ','.join(
+        '{name}="{value}"'.format(name=name, value=escape(value))
+        for name, value in zip(names, values))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+
+    def observe(self, labels, value=1):
+        self.values[labels] = self.values.get(labels, 0) + value
+
+    def samples(self):
+        for labels, value in sorted(self.values.items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # labels: [count of each bucket, sum]
+        self.values = {}
+
+    def observe(self, labels, value):
+        counts = self.values.get(labels)
+        if counts is None:
+            counts = self.values[labels] = [[0] * len(self.buckets), 0]
+        counts[0][bisect_left(self.buckets, value)] += 1
+        counts[1] += value
+
+    def samples(self):
+        for labels, (counts, total) in sorted(self.values.items()):
+            label_text = format_labels(self.labelnames, labels)
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield self.name + '_bucket', ','.join(filter(None, (
+                    label_text, 'le="%s"' % format_value(bound)))), \
+                    cumulative
+            yield self.name + '_sum', label_text, total
+            yield self.name + '_count', label_text, cumulative
+
+
+class CallbackMetric(object):
+    """
+    Metric whose values are read when rendered, from a function returning
+    a dict of labels to value.
+    """
+
+    def __init__(self, kind, name, documentation, labelnames, collect):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.collect = collect
+
+    def samples(self):
+        for labels, value in sorted(self.collect().items()):
+            yield self.name, format_labels(self.labelnames, labels), value
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def observe(self, observations):
+        """
+        :param observations: iterable of (metric, labels, value)
+        """
+        with self.lock:
+            for metric, labels, value in observations:
+                metric.observe(labels, value)
+
+    def clear(self):
+        with self.lock:
+            for metric in self.metrics:
+                if not isinstance(metric, CallbackMetric):
+                    metric.values.clear()
+
+    def render(self):
+        lines = []
+        with self.lock:
+            for metric in self.metrics:
+                lines.append('# HELP {name} {documentation}'.format(
+                    name=metric.name, documentation=metric.documentation))
+                lines.append('# TYPE {name} {kind}'.format(
+                    name=metric.name, kind=metric.kind))
+                for name, labels, value in metric.samples():
+                    lines.append('{name}{labels} {value}'.format(
+                        name=name, labels='{%s}' % labels if labels else '',
+                        value=format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+VIEW_LABELS = ('view', 'method')
+requests_total = registry.register(Counter(
+    'billcalls_requests_total', "Requests served.",
+    VIEW_LABELS + ('status',)))
+request_duration = registry.register(Histogram(
+    'billcalls_request_duration_seconds', "Wall time of the requests.",
+    VIEW_LABELS, DURATION_BUCKETS))
+request_queries = registry.register(Histogram(
+    'billcalls_request_queries', "Database queries of each request.",
+    VIEW_LABELS, QUERY_BUCKETS))
+request_query_duration = registry.register(Histogram(
+    'billcalls_request_query_duration_seconds',
+    "Time of each request spent in database queries.",
+    VIEW_LABELS, DURATION_BUCKETS))
+request_serialization_duration = registry.register(Histogram(
+    'billcalls_request_serialization_duration_seconds',
+    "Time of each request spent rendering the response.",
+    VIEW_LABELS, DURATION_BUCKETS))
+slow_queries_total = registry.register(Counter(
+    'billcalls_slow_queries_total',
+    "Queries slower than SLOW_QUERY_MS.", VIEW_LABELS))
+
+
+def pool_values(*keys):
+    def collect():
+        from billcalls.db.pool import pool_stats
+        return {
+            (alias,) + labels: stats[key]
+            for alias, stats in pool_stats().items()
+            for key, labels in keys
+        }
+    return collect
+
+
+pool_connections = registry.register(CallbackMetric(
+    'gauge', 'billcalls_db_pool_connections',
+    "Connections of the database pool of this process.",
+    ('alias', 'state'),
+    pool_values(('idle', ('idle',)), ('in_use', ('in_use',)))))
+pool_max_size = registry.register(CallbackMetric(
+    'gauge', 'billcalls_db_pool_max_size',
+    "Maximum connections of the database pool.", ('alias',),
+    pool_values(('max_size', ()))))
+for key, documentation in (
+        ('created', "Connections opened by the database pool."),
+        ('checkouts', "Connections handed out by the database pool."),
+        ('waits', "Checkouts that waited for a connection to be released."),
+        ('timeouts', "Checkouts that gave up waiting for a connection."),
+        ('discarded', "Broken connections dropped by the database pool.")):
+    registry.register(CallbackMetric(
+        'counter', 'billcalls_db_pool_%s_total' % key, documentation,
+        ('alias',), pool_values((key, ()))))
+
+
+def replica_values(available):
+    def collect():
+        from billcalls.db.router import known_lag
+        lags = {
+            alias: known_lag(alias) for alias in settings.DATABASE_REPLICAS}
+        if available:
+            return {
+                (alias,): int(
+                    lag is not None and
+                    lag <= settings.DATABASE_REPLICA_MAX_LAG)
+                for alias, lag in lags.items()
+            }
+        return {
+            (alias,): lag for alias, lag in lags.items() if lag is not None}
+    return collect
+
+
+replica_lag = registry.register(CallbackMetric(
+    'gauge', 'billcalls_db_replica_lag_seconds',
+    "Seconds the read replica is behind the primary database, as last "
+    "checked by this process.", ('alias',), replica_values(False)))
+replica_available = registry.register(CallbackMetric(
+    'gauge', 'billcalls_db_replica_available',
+    "Whether reads are sent to the read replica, it is left out when it "
+    "cannot be reached or lags too far behind.", ('alias',),
+    replica_values(True)))
+
+
+class RequestRecorder(object):
+    """
+    Database execute wrapper counting and timing the queries of a request,
+    slow queries are logged for a sample of SLOW_QUERY_SAMPLE_RATE.
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.serialization_seconds = 0.0
+        self.slow_queries = 0
+        slow_query_ms = settings.SLOW_QUERY_MS
+        self.slow_query_seconds = \
+            None if slow_query_ms is None else slow_query_ms / 1000
+
+    def __call__(self, execute, sql, params, many, context):
+        started = perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = perf_counter() - started
+            self.queries += 1
+            self.query_seconds += duration
+            if self.slow_query_seconds is not None and \
+                    duration >= self.slow_query_seconds:
+                self.slow_queries += 1
+                if random.random() < settings.SLOW_QUERY_SAMPLE_RATE:
+                    logger.warning(
+                        "Slow query on %s (%.1f ms): %s",
+                        context['connection'].alias, duration * 1000, sql)
+
+    def start_rendering(self, response):
+        started = perf_counter()
+
+        def rendered(response):
+            self.serialization_seconds += perf_counter() - started
+        response.add_post_render_callback(rendered)
+
+    def observations(self, view, method, status, duration):
+        labels = (view, method)
+        yield requests_total, labels + (str(status),), 1
+        yield request_duration, labels, duration
+        yield request_queries, labels, self.queries
+        yield request_query_duration, labels, self.query_seconds
+        yield request_serialization_duration, labels, \
+            self.serialization_seconds
+        if self.slow_queries:
+            yield slow_queries_total, labels, self.slow_queries
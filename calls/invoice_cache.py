@@ -0,0 +1,119 @@
+"""
+Cache of the rendered bills of closed months, keyed by subscriber and
+month. Entries are dropped whenever a call is billed in their month, and
+with read replicas the bill is then read from the primary database for
+DATABASE_REPLICA_PIN_SECONDS. Each entry also keeps the version of the bill
+it was built from, so a cache local to the process never serves a bill
+changed by another process.
+"""
+
+import hashlib
+import json
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+from calls.models import InvoiceSummary
+
+
+KEY_PREFIX = 'call-invoice'
+
+
+def get_cache():
+    return caches[settings.INVOICE_CACHE_ALIAS]
+
+
+def cache_key(source, month):
+    return '{prefix}:{source}:{month:%Y%m}'.format(
+        prefix=KEY_PREFIX, source=source, month=month)
+
+
+def written_key(source, month):
+    return '{prefix}-written:{source}:{month:%Y%m}'.format(
+        prefix=KEY_PREFIX, source=source, month=month)
+
+
+def recently_written(source, month):
+    """
+    :return: whether a call of the bill was billed in the last
+    DATABASE_REPLICA_PIN_SECONDS, the read replicas may not have it yet
+    """
+    return bool(settings.DATABASE_REPLICAS) and \
+        get_cache().get(written_key(source, month)) is not None
+
+
+def bill_version(source, month):
+    """
+    :return: update time of the stored bill, None while it is not stored
+    """
+    return InvoiceSummary.objects.filter(
+        source=source, billing_month=month
+    ).values_list('updated_at', flat=True).first()
+
+
+def get(source, month):
+    """
+    Every hit runs one query, the lookup of the version of the stored bill,
+    so a bill changed by another process is never served from the cache of
+    this one. The lines and totals of the bill are not read.
+
+    :return: the cached entry of the bill, None when it is not cached or the
+    bill changed since it was cached
+    """
+    entry = get_cache().get(cache_key(source, month))
+    if entry is None or 'totals_etag' not in entry:
+        return None
+    if entry['version'] != bill_version(source, month):
+        return None
+    return entry
+
+
+def set(source, month, data, last_modified, totals, version):
+    """
+    :param data: line items of the bill
+    :param last_modified: datetime of the last change of the bill
+    :param totals: totals of the bill
+    :param version: update time of the stored bill the entry is built from
+    :return: the cached entry, with the serialized bill and the validators
+    of its representations with and without the totals
+    """
+    content = JSONRenderer().render(data)
+    digest = hashlib.sha1(content)
+    etag = '"%s"' % digest.hexdigest()
+    digest.update(JSONRenderer().render(totals))
+    entry = {
+        'data': json.loads(content),
+        'totals': totals,
+        'etag': etag,
+        'totals_etag': '"%s"' % digest.hexdigest(),
+        'last_modified': int(last_modified.timestamp()),
+        'version': version
+    }
+    get_cache().set(
+        cache_key(source, month), entry, settings.INVOICE_CACHE_TIMEOUT)
+    return entry
+
+
+def invalidate(bills):
+    """
+    :param bills: iterable of (source, month) pairs
+    """
+    bills = list(bills)
+    keys = [cache_key(source, month) for source, month in bills]
+    if not keys:
+        return
+    get_cache().delete_many(keys)
+    written = {
+        written_key(source, month): True for source, month in bills
+    } if settings.DATABASE_REPLICAS else {}
+
+    def committed():
+        # the bills are read from the primary until the replicas catch up,
+        # before a request can cache them again from a replica
+        if written:
+            get_cache().set_many(
+                written, settings.DATABASE_REPLICA_PIN_SECONDS)
+        # a request could cache the bill again before the transaction
+        # commits
+        get_cache().delete_many(keys)
+    transaction.on_commit(committed)
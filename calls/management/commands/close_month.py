@@ -0,0 +1,134 @@
+import datetime
+import json
+import multiprocessing
+import os
+import time
+from itertools import groupby
+from operator import itemgetter
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from calls.models import InvoiceLine, InvoiceSummary
+from calls.summaries import rebuild_month, shard_bounds, sources_in
+
+
+def close_shard(task):
+    """
+    Build the bills of a range of subscribers and write them as documents.
+
+    :param task: month, shard number, first and last source of the range,
+    output directory or None and number of bills stored at once
+    :return: shard number and number of bills written
+    """
+    month, shard, first_source, last_source, output, chunk_size = task
+    count = rebuild_month(month, chunk_size, first_source, last_source)
+    if output is not None:
+        write_documents(
+            os.path.join(output, 'invoices-{month:%Y%m}-{shard:04d}.ndjson'
+                         .format(month=month, shard=shard)),
+            sources_in(
+                InvoiceSummary.objects.filter(billing_month=month),
+                first_source, last_source
+            ).order_by('source'),
+            chunk_size)
+    return shard, count
+
+
+def write_documents(path, summaries, chunk_size):
+    """
+    Write one JSON invoice document per line, with the same line items the
+    invoice endpoint returns.
+    """
+    lines = InvoiceLine.objects.filter(summary__in=summaries).order_by(
+        'summary__source', 'ended_at', 'call_id'
+    ).values_list('summary_id', 'item')
+    bills = groupby(lines.iterator(chunk_size=chunk_size), key=itemgetter(0))
+    summary_id, items = next(bills, (None, ()))
+    with open(path, 'w') as documents:
+        for summary in summaries.iterator(chunk_size=chunk_size):
+            header = json.dumps({
+                'source': summary.source,
+                'month': summary.billing_month.strftime('%m%Y'),
+                'total': "R$ %s" % summary.total,
+                'call_count': summary.call_count,
+                'total_duration_seconds': summary.total_duration_seconds,
+            })
+            bill_items = []
+            if summary_id == summary.pk:
+                bill_items = [item for line_summary, item in items]
+                summary_id, items = next(bills, (None, ()))
+            # the items are stored serialized, they are not parsed again
+            documents.write(
+                header[:-1] + ', "items": [' + ','.join(bill_items) + ']}\n')
+
+
+class Command(BaseCommand):
+    help = "Build the bill of every subscriber of a closed month."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'month',
+            help="Reference month of the bills in the format MMYYYY"
+        )
+        parser.add_argument(
+            '--shards', type=int, default=64,
+            help="Number of ranges of subscribers built independently"
+        )
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help="Number of processes building shards concurrently"
+        )
+        parser.add_argument(
+            '--output',
+            help="Directory the invoice documents are written to, as one "
+                 "NDJSON file per shard"
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=1000,
+            help="Number of bills stored at once"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            date_ref = datetime.datetime.strptime(options['month'], '%m%Y')
+        except ValueError:
+            raise CommandError("The month must be in the format MMYYYY.")
+        month = date_ref.date()
+        if month >= datetime.date.today().replace(day=1):
+            raise CommandError(
+                "You cannot close a month that is not yet completed.")
+        output = options['output']
+        if output is not None:
+            os.makedirs(output, exist_ok=True)
+
+        started = time.monotonic()
+        bounds = shard_bounds(month, options['shards'])
+        tasks = [
+            (month, shard, first_source, last_source, output,
+             options['chunk_size'])
+            for shard, (first_source, last_source) in enumerate(bounds)
+        ]
+        total = 0
+        # SQLite takes one writer at a time, shards would wait on each other
+        if options['workers'] == 1 or connection.vendor == 'sqlite':
+            for task in tasks:
+                total += self.progress(close_shard(task), started)
+        else:
+            # each process must open its own database connection
+            connections.close_all()
+            with multiprocessing.Pool(
+                    options['workers'], initializer=django.setup) as pool:
+                for result in pool.imap_unordered(close_shard, tasks):
+                    total += self.progress(result, started)
+        elapsed = time.monotonic() - started
+        self.stdout.write(self.style.SUCCESS(
+            "Closed %s: %d bills in %d shards, %.0f bills/s." % (
+                options['month'], total, len(tasks),
+                total / elapsed if elapsed else 0)
+        ))
+
+    def progress(self, result, started):
+        shard, count = result
+        self.stdout.write("Shard %d: %d bills, %.1f s" % (
+            shard, count, time.monotonic() - started))
+        return count
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from calls.models import billing_month
+from calls.partitions import add_months, create_partitions, \
+    tables_partitioned
+
+
+class Command(BaseCommand):
+    help = "Create the monthly partitions of the call logs and invoices " \
+           "ahead of time."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--months-ahead', type=int, default=3,
+            help="Number of months after the current one to create"
+        )
+
+    def handle(self, *args, **options):
+        if not tables_partitioned(connection):
+            raise CommandError(
+                "The call logs and invoices are only partitioned on "
+                "PostgreSQL, after the migrations are applied.")
+        month = billing_month(timezone.now())
+        with transaction.atomic():
+            created = create_partitions(
+                connection, month, add_months(month, options['months_ahead']))
+        for partition in created:
+            self.stdout.write("Created %s." % partition)
+        self.stdout.write(self.style.SUCCESS(
+            "Created %d partitions." % len(created)))
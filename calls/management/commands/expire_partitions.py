@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from calls.models import billing_month
+from calls.partitions import add_months, expire_partitions, \
+    tables_partitioned
+
+
+class Command(BaseCommand):
+    help = "Drop, or detach, the monthly partitions of the call logs and " \
+           "invoices older than the retention period, along with the call " \
+           "records and bills of those months."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--keep-months', type=int, required=True,
+            help="Number of months kept, the current one included"
+        )
+        parser.add_argument(
+            '--detach', action='store_true',
+            help="Detach the partitions and keep them as plain tables"
+        )
+
+    def handle(self, *args, **options):
+        if options['keep_months'] < 1:
+            raise CommandError("At least the current month must be kept.")
+        if not tables_partitioned(connection):
+            raise CommandError(
+                "The call logs and invoices are only partitioned on "
+                "PostgreSQL, after the migrations are applied.")
+        before_month = add_months(
+            billing_month(timezone.now()), 1 - options['keep_months'])
+        with transaction.atomic():
+            expired = expire_partitions(
+                connection, before_month, detach=options['detach'])
+        action = "Detached" if options['detach'] else "Dropped"
+        for partition in expired:
+            self.stdout.write("%s %s." % (action, partition))
+        self.stdout.write(self.style.SUCCESS(
+            "%s %d partitions older than %s." % (
+                action, len(expired), before_month.strftime('%m%Y'))))
@@ -0,0 +1,108 @@
+import itertools
+import json
+import os
+import time
+from django.core.management.base import BaseCommand, CommandError
+from calls.cdr import CdrBatch, FORMATS, detect_format, open_cdr, \
+    read_records
+
+
+class Command(BaseCommand):
+    help = "Import call records from a CSV or NDJSON file, optionally " \
+           "gzipped."
+
+    def add_arguments(self, parser):
+        parser.add_argument('file')
+        parser.add_argument(
+            '--format', choices=FORMATS,
+            help="Format of the file, told by its extension when omitted"
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=10000,
+            help="Number of records validated and stored at once"
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help="File keeping the number of records already imported, "
+                 "defaults to the imported file name with a .checkpoint "
+                 "suffix"
+        )
+        parser.add_argument(
+            '--restart', action='store_true',
+            help="Ignore the checkpoint and import the whole file"
+        )
+        parser.add_argument(
+            '--errors',
+            help="File the rejected records are written to as NDJSON"
+        )
+
+    def handle(self, *args, **options):
+        path = options['file']
+        try:
+            file_format = options['format'] or detect_format(path)
+        except ValueError as exc:
+            raise CommandError(exc)
+        checkpoint = options['checkpoint'] or path + '.checkpoint'
+        skip = 0 if options['restart'] else self.read_checkpoint(checkpoint)
+        if skip:
+            self.stdout.write("Resuming after %d records." % skip)
+
+        totals = {'created': 0, 'pending': 0, 'error': 0}
+        imported = skip
+        started = time.monotonic()
+        errors = open(options['errors'], 'a') if options['errors'] else None
+        try:
+            with open_cdr(path) as stream:
+                records = itertools.islice(
+                    read_records(stream, file_format), skip, None)
+                for chunk in self.chunks(records, options['chunk_size']):
+                    for result in CdrBatch(chunk).ingest():
+                        totals[result['status']] += 1
+                        if errors and result['status'] == 'error':
+                            result['index'] += imported
+                            errors.write(json.dumps(result) + '\n')
+                    imported += len(chunk)
+                    # the chunk is committed, a failure from here on only
+                    # replays it and its records are rejected as duplicates
+                    self.write_checkpoint(checkpoint, imported)
+                    self.progress(imported - skip, totals, started)
+        except ValueError as exc:
+            raise CommandError(exc)
+        finally:
+            if errors:
+                errors.close()
+        if os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write(self.style.SUCCESS(
+            "Imported %d records: %d created, %d pending, %d rejected." % (
+                imported - skip, totals['created'], totals['pending'],
+                totals['error'])
+        ))
+
+    @staticmethod
+    def chunks(records, chunk_size):
+        chunk = list(itertools.islice(records, chunk_size))
+        while chunk:
+            yield chunk
+            chunk = list(itertools.islice(records, chunk_size))
+
+    def progress(self, count, totals, started):
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            "%d records, %d rejected, %.0f records/s" % (
+                count, totals['error'], count / elapsed if elapsed else 0)
+        )
+
+    @staticmethod
+    def read_checkpoint(checkpoint):
+        if not os.path.exists(checkpoint):
+            return 0
+        with open(checkpoint) as stream:
+            return json.load(stream)['records']
+
+    @staticmethod
+    def write_checkpoint(checkpoint, records):
+        # written aside and renamed so a crash never leaves it half written
+        with open(checkpoint + '.tmp', 'w') as stream:
+            json.dump({'records': records}, stream)
+        os.replace(checkpoint + '.tmp', checkpoint)
@@ -0,0 +1,32 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from calls.models import CallRecord
+from calls.summaries import rebuild_month
+
+
+class Command(BaseCommand):
+    help = "Rebuild the stored monthly bills from the call records."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--month',
+            help="Reference month of the bills in the format MMYYYY, "
+                 "every month is rebuilt when omitted"
+        )
+
+    def handle(self, *args, **options):
+        if options['month']:
+            try:
+                date_ref = datetime.datetime.strptime(
+                    options['month'], '%m%Y')
+            except ValueError:
+                raise CommandError("The month must be in the format MMYYYY.")
+            months = [date_ref.date()]
+        else:
+            months = CallRecord.objects.order_by(
+                'billing_month').values_list(
+                'billing_month', flat=True).distinct()
+        for month in months:
+            count = rebuild_month(month)
+            self.stdout.write(
+                "Rebuilt %d bills of %s." % (count, month.strftime('%m%Y')))
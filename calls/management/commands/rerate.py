@@ -0,0 +1,77 @@
+import datetime
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from calls import tariffs
+from calls.models import CallInvoice, CallRecord, month_range, \
+    reduced_minutes
+from calls.pricing import from_cents
+from calls.summaries import rebuild_month
+
+
+class Command(BaseCommand):
+    help = "Recompute the price of every call invoice of a month."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--month',
+            required=True,
+            help="Reference month of the invoices in the format MMYYYY"
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=50000,
+            help="Number of invoices priced and updated at once"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            date_ref = datetime.datetime.strptime(options['month'], '%m%Y')
+        except ValueError:
+            raise CommandError("The month must be in the format MMYYYY.")
+        chunk_size = options['chunk_size']
+        first_day, next_month = month_range(date_ref)
+        rows = CallInvoice.objects.with_call_logs().filter(
+            timestamp_end__gte=first_day,
+            timestamp_end__lt=next_month
+        ).order_by('id').values_list(
+            'id', 'call_id', 'call_id__source', 'call_id__destination',
+            'call_started_at', 'call_ended_at')
+
+        total = 0
+        chunk = []
+        for row in rows.iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                total += self.rerate(chunk)
+                chunk = []
+        if chunk:
+            total += self.rerate(chunk)
+        rebuild_month(first_day)
+        self.stdout.write(self.style.SUCCESS(
+            "Re-rated %d calls of %s." % (total, options['month'])))
+
+    def rerate(self, rows):
+        ids, call_ids, sources, destinations, starts, ends = zip(*rows)
+        prices, minutes = tariffs.get_index().charges_in_cents(
+            sources, destinations, starts, ends)
+        prices = [from_cents(price) for price in prices.tolist()]
+        minutes = minutes.tolist()
+        invoices = [
+            CallInvoice(id=invoice_id, price=price)
+            for invoice_id, price in zip(ids, prices)
+        ]
+        records = [
+            CallRecord(
+                call_id_id=call_id, price=price, normal_minutes=normal,
+                reduced_minutes=reduced_minutes(start, end, normal))
+            for call_id, price, normal, start, end in zip(
+                call_ids, prices, minutes, starts, ends)
+        ]
+        with transaction.atomic():
+            CallInvoice.objects.bulk_update(
+                invoices, ['price'], batch_size=1000)
+            CallRecord.objects.bulk_update(
+                records, ['price', 'normal_minutes', 'reduced_minutes'],
+                batch_size=1000)
+        return len(invoices)
@@ -0,0 +1,56 @@
+import multiprocessing
+import time
+from django.core.management.base import BaseCommand
+from django.db import connections
+from calls.billing import process_jobs
+
+
+def work(batch_size, max_attempts, poll_interval, once):
+    while True:
+        claimed = process_jobs(batch_size, max_attempts)
+        if once and not claimed:
+            return
+        if claimed < batch_size:
+            time.sleep(0 if once else poll_interval)
+
+
+class Command(BaseCommand):
+    help = "Bill the calls queued while ASYNC_BILLING is enabled."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help="Number of worker processes claiming jobs concurrently"
+        )
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument(
+            '--max-attempts', type=int, default=5,
+            help="A job is marked as failed after this many errors"
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help="Seconds to wait when there are no jobs left"
+        )
+        parser.add_argument(
+            '--once', action='store_true',
+            help="Stop when there are no jobs left instead of waiting"
+        )
+
+    def handle(self, *args, **options):
+        arguments = (
+            options['batch_size'], options['max_attempts'],
+            options['poll_interval'], options['once']
+        )
+        if options['workers'] == 1:
+            work(*arguments)
+            return
+        # each process must open its own database connection
+        connections.close_all()
+        workers = [
+            multiprocessing.Process(target=work, args=arguments)
+            for _ in range(options['workers'])
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -0,0 +1,43 @@
+import datetime
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from calls.models import PendingCallEnd
+from calls.pending import pair_parked_ends
+
+
+class Command(BaseCommand):
+    help = "Pair the parked end records whose call has started and report " \
+           "the ones left unmatched."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=float, default=24,
+            help="Hours after which an unmatched end record is reported"
+        )
+        parser.add_argument(
+            '--delete', action='store_true',
+            help="Delete the reported end records"
+        )
+
+    def handle(self, *args, **options):
+        paired = pair_parked_ends()
+        self.stdout.write("Paired %d end records." % paired)
+        received_before = timezone.now() - datetime.timedelta(
+            hours=options['older_than'])
+        orphans = PendingCallEnd.objects.filter(
+            received_at__lt=received_before
+        ).order_by('received_at')
+        count = 0
+        for orphan in orphans.iterator():
+            count += 1
+            self.stdout.write(
+                "Call %d ended at %s, received at %s: %s" % (
+                    orphan.call_id, orphan.timestamp.isoformat(),
+                    orphan.received_at.isoformat(),
+                    orphan.error or "no start record"
+                )
+            )
+        self.stdout.write("%d unmatched end records." % count)
+        if options['delete'] and count:
+            orphans.delete()
+            self.stdout.write("Deleted %d end records." % count)
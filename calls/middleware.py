@@ -0,0 +1,40 @@
+from contextlib import ExitStack
+from time import perf_counter
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from calls.instrumentation import RequestRecorder, registry
+
+
+class InstrumentationMiddleware(object):
+    """
+    Record the wall time, queries, query time and rendering time of each
+    request by view. Not loaded at all unless INSTRUMENTATION_ENABLED is
+    set. Queries run while a streaming response is consumed happen after
+    the middleware returns and are not counted.
+    """
+
+    def __init__(self, get_response):
+        if not settings.INSTRUMENTATION_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        recorder = RequestRecorder()
+        request._recorder = recorder
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            started = perf_counter()
+            response = self.get_response(request)
+            duration = perf_counter() - started
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unresolved'
+        registry.observe(recorder.observations(
+            view, request.method, response.status_code, duration))
+        return response
+
+    def process_template_response(self, request, response):
+        # called right before the response is rendered
+        request._recorder.start_rendering(response)
+        return response
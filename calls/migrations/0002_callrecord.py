@@ -0,0 +1,67 @@
+# Generated by Django 2.2.5 on 2026-10-18 17:14
+
+from datetime import timedelta
+from calls.models import billing_month
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+import django.db.models.deletion
+
+
+def populate_call_records(apps, schema_editor):
+    CallInvoice = apps.get_model('calls', 'CallInvoice')
+    CallLog = apps.get_model('calls', 'CallLog')
+    CallRecord = apps.get_model('calls', 'CallRecord')
+    logs = CallLog.objects.filter(call_id=OuterRef('call_id'))
+    invoices = CallInvoice.objects.select_related('call_id').annotate(
+        call_started_at=Subquery(
+            logs.filter(type='start').values('timestamp')[:1]),
+        call_ended_at=Subquery(
+            logs.filter(type='end').values('timestamp')[:1])
+    ).filter(call_started_at__isnull=False, call_ended_at__isnull=False)
+    records = []
+    for invoice in invoices.iterator():
+        started_at = invoice.call_started_at
+        ended_at = invoice.call_ended_at
+        records.append(CallRecord(
+            call_id=invoice.call_id,
+            source=invoice.call_id.source,
+            destination=invoice.call_id.destination,
+            started_at=started_at,
+            ended_at=ended_at,
+            duration_seconds=(ended_at - started_at) // timedelta(seconds=1),
+            price=invoice.price,
+            billing_month=billing_month(ended_at)
+        ))
+        if len(records) == 1000:
+            CallRecord.objects.bulk_create(records)
+            records = []
+    CallRecord.objects.bulk_create(records)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CallRecord',
+            fields=[
+                ('call_id', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='record', serialize=False, to='calls.Call')),
+                ('source', models.CharField(help_text='The subscriber phone number that originated the call', max_length=11)),
+                ('destination', models.CharField(help_text='The phone number receiving the call', max_length=11)),
+                ('started_at', models.DateTimeField()),
+                ('ended_at', models.DateTimeField()),
+                ('duration_seconds', models.PositiveIntegerField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('billing_month', models.DateField(help_text='First day of the month the call is billed in')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='callrecord',
+            index=models.Index(fields=['source', 'billing_month', 'ended_at', 'call_id'], name='callrecord_invoice_idx'),
+        ),
+        migrations.RunPython(
+            populate_call_records, migrations.RunPython.noop),
+    ]
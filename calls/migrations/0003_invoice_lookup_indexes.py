@@ -0,0 +1,23 @@
+# Generated by Django 2.2.5 on 2026-10-18 17:16
+
+import calls.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0002_callrecord'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='call',
+            name='source',
+            field=models.CharField(db_index=True, help_text='The subscriber phone number that originated the call', max_length=11, validators=[calls.validators.validate_phone_number]),
+        ),
+        migrations.AddIndex(
+            model_name='callinvoice',
+            index=models.Index(fields=['timestamp_end', 'call_id'], name='callinvoice_month_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.5 on 2026-10-18 17:19
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0003_invoice_lookup_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text='The subscriber phone number', max_length=11)),
+                ('billing_month', models.DateField(help_text='First day of the month of the bill')),
+                ('total', models.DecimalField(decimal_places=2, default=0, max_digits=15)),
+                ('call_count', models.PositiveIntegerField(default=0)),
+                ('total_duration_seconds', models.BigIntegerField(default=0)),
+                ('items', models.TextField(default='[]', help_text='Serialized line items of the bill, in the response order')),
+                ('item_keys', models.TextField(default='[]', help_text='Order key, call, price and duration of each line item')),
+                ('updated_at', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'unique_together': {('source', 'billing_month')},
+            },
+        ),
+    ]
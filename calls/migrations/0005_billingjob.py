@@ -0,0 +1,30 @@
+# Generated by Django 2.2.5 on 2026-10-18 17:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0004_invoicesummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BillingJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('failed', 'Failed')], default='pending', max_length=7)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now, help_text='The job is not claimed before this time')),
+                ('last_error', models.TextField(blank=True)),
+                ('call_id', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='billing_job', to='calls.Call')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='billingjob',
+            index=models.Index(fields=['status', 'available_at', 'id'], name='billingjob_claim_idx'),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# Generated by Django 2.2.5 on 2026-10-18 17:29
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0005_billingjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingCallEnd',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('call_id', models.IntegerField(help_text='Id of the call that has not started yet', unique=True)),
+                ('timestamp', models.DateTimeField(help_text='The timestamp of when the call ended')),
+                ('received_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('error', models.TextField(blank=True, help_text='Why the record could not be paired with its start')),
+            ],
+        ),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 2.2.5 on 2026-10-18 17:38
+
+import calls.validators
+import django.core.validators
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0006_pendingcallend'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Holiday',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True)),
+                ('name', models.CharField(blank=True, max_length=100)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TariffPlan',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=50, unique=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='TariffRate',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('destination_prefix', models.CharField(blank=True, help_text='Destinations the rate applies to, the longest matching prefix is used and a blank prefix matches any destination', max_length=11)),
+                ('effective_from', models.DateTimeField(help_text='Calls started from this time on are billed with the rate')),
+                ('standing_price', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('minute_price', models.DecimalField(decimal_places=2, help_text='Price of each minute outside the reduced windows', max_digits=15)),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rates', to='calls.TariffPlan')),
+            ],
+            options={
+                'unique_together': {('plan', 'destination_prefix', 'effective_from')},
+            },
+        ),
+        migrations.CreateModel(
+            name='ReducedWindow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('start_hour', models.PositiveSmallIntegerField(validators=[django.core.validators.MaxValueValidator(23)])),
+                ('end_hour', models.PositiveSmallIntegerField(validators=[django.core.validators.MaxValueValidator(24)])),
+                ('day_type', models.CharField(choices=[('all', 'All days'), ('weekday', 'Weekdays'), ('weekend', 'Weekends and holidays')], default='all', max_length=7)),
+                ('rate', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='reduced_windows', to='calls.TariffRate')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PlanSubscription',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(help_text='The subscriber phone number billed with the plan', max_length=11, validators=[calls.validators.validate_phone_number])),
+                ('valid_from', models.DateTimeField(help_text='Calls started from this time on are billed with the plan')),
+                ('plan', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='subscriptions', to='calls.TariffPlan')),
+            ],
+            options={
+                'unique_together': {('source', 'valid_from')},
+            },
+        ),
+    ]
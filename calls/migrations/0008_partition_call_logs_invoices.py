@@ -0,0 +1,166 @@
+from datetime import datetime, time
+from django.db import migrations, models
+from django.db.migrations.exceptions import IrreversibleError
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+MONTHS_AHEAD = 3
+# table, partition key, whether the key is a date rather than a timestamp,
+# as in calls.partitions when this migration was written
+PARTITIONED_TABLES = (
+    ('calls_calllog', 'timestamp', False),
+    ('calls_callinvoice', 'timestamp_end', True),
+)
+
+# primary keys and unique constraints of a partitioned table must include
+# the partition key, the unique pairs of calls are still enforced by the
+# primary keys of calls_call, calls_callrecord and calls_billingjob
+CONSTRAINTS = {
+    'calls_calllog': [
+        'ALTER TABLE calls_calllog ADD CONSTRAINT calls_calllog_pkey '
+        'PRIMARY KEY (id, "timestamp")',
+        'ALTER TABLE calls_calllog ADD CONSTRAINT '
+        'calls_calllog_type_call_id_id_timestamp_uniq '
+        'UNIQUE (type, call_id_id, "timestamp")',
+        'CREATE INDEX calls_calllog_call_id_id_idx '
+        'ON calls_calllog (call_id_id)',
+        'ALTER TABLE calls_calllog ADD CONSTRAINT '
+        'calls_calllog_call_id_id_fk_calls_call_id FOREIGN KEY (call_id_id) '
+        'REFERENCES calls_call (id) DEFERRABLE INITIALLY DEFERRED',
+    ],
+    'calls_callinvoice': [
+        'ALTER TABLE calls_callinvoice ADD CONSTRAINT calls_callinvoice_pkey '
+        'PRIMARY KEY (id, timestamp_end)',
+        'ALTER TABLE calls_callinvoice ADD CONSTRAINT '
+        'calls_callinvoice_call_id_id_timestamp_end_uniq '
+        'UNIQUE (call_id_id, timestamp_end)',
+        'CREATE INDEX callinvoice_month_idx '
+        'ON calls_callinvoice (timestamp_end, call_id_id)',
+        'ALTER TABLE calls_callinvoice ADD CONSTRAINT '
+        'calls_callinvoice_call_id_id_fk_calls_call_id '
+        'FOREIGN KEY (call_id_id) REFERENCES calls_call (id) '
+        'DEFERRABLE INITIALLY DEFERRED',
+    ],
+}
+
+
+def billing_month(date):
+    if isinstance(date, datetime):
+        if timezone.is_aware(date):
+            date = timezone.localtime(date, timezone.get_default_timezone())
+        date = date.date()
+    return date.replace(day=1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1, day=1)
+
+
+def month_bounds(month, is_date):
+    # bounds of a partition cannot be expressions, they are given as literals
+    bounds = (month, add_months(month, 1))
+    if is_date:
+        return tuple(day.isoformat() for day in bounds)
+    return tuple(
+        timezone.make_aware(
+            datetime.combine(day, time()), timezone.get_default_timezone()
+        ).isoformat(' ')
+        for day in bounds
+    )
+
+
+def create_partitions(cursor, quote_name, table, is_date, first_month,
+                      last_month):
+    # the table is new, none of its months has a partition yet
+    month = first_month
+    while month <= last_month:
+        cursor.execute(
+            'CREATE TABLE {partition} PARTITION OF {table} '
+            'FOR VALUES FROM (%s) TO (%s)'.format(
+                partition=quote_name(
+                    '{table}_p{month:%Y%m}'.format(table=table, month=month)),
+                table=quote_name(table)),
+            month_bounds(month, is_date))
+        month = add_months(month, 1)
+
+
+def fill_timestamp_end(apps, schema_editor):
+    CallInvoice = apps.get_model('calls', 'CallInvoice')
+    CallLog = apps.get_model('calls', 'CallLog')
+    ended_at = CallLog.objects.filter(
+        call_id=OuterRef('call_id'), type='end').values('timestamp')[:1]
+    for invoice in CallInvoice.objects.filter(
+            timestamp_end__isnull=True).annotate(
+                call_ended_at=Subquery(ended_at)):
+        invoice.timestamp_end = invoice.call_ended_at
+        invoice.save(update_fields=['timestamp_end'])
+
+
+def partition_tables(apps, schema_editor):
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    quote_name = connection.ops.quote_name
+    last_month = add_months(billing_month(timezone.now()), MONTHS_AHEAD)
+    for table, column, is_date in PARTITIONED_TABLES:
+        old_table = table + '_unpartitioned'
+        with connection.cursor() as cursor:
+            cursor.execute('ALTER TABLE {table} RENAME TO {old_table}'.format(
+                table=quote_name(table), old_table=quote_name(old_table)))
+            cursor.execute(
+                'CREATE TABLE {table} (LIKE {old_table} INCLUDING DEFAULTS) '
+                'PARTITION BY RANGE ({column})'.format(
+                    table=quote_name(table), old_table=quote_name(old_table),
+                    column=quote_name(column)))
+            cursor.execute(
+                'CREATE TABLE {default} PARTITION OF {table} DEFAULT'.format(
+                    default=quote_name(table + '_default'),
+                    table=quote_name(table)))
+            cursor.execute(
+                'SELECT MIN({column}) FROM {old_table}'.format(
+                    column=quote_name(column),
+                    old_table=quote_name(old_table)))
+            first_value, = cursor.fetchone()
+            first_month = billing_month(first_value) \
+                if first_value is not None else billing_month(timezone.now())
+            create_partitions(
+                cursor, quote_name, table, is_date,
+                min(first_month, last_month), last_month)
+            cursor.execute(
+                "SELECT pg_get_serial_sequence(%s, 'id')", [old_table])
+            sequence, = cursor.fetchone()
+            cursor.execute(
+                'ALTER SEQUENCE {sequence} OWNED BY {table}.id'.format(
+                    sequence=sequence, table=quote_name(table)))
+            cursor.execute(
+                'INSERT INTO {table} SELECT * FROM {old_table}'.format(
+                    table=quote_name(table), old_table=quote_name(old_table)))
+            cursor.execute('DROP TABLE {old_table}'.format(
+                old_table=quote_name(old_table)))
+            for statement in CONSTRAINTS[table]:
+                cursor.execute(statement)
+
+
+def unpartition_tables(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        raise IrreversibleError(
+            "The partitioned call log and invoice tables cannot be turned "
+            "back into plain tables by a migration.")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0007_tariff_plans'),
+    ]
+
+    operations = [
+        migrations.RunPython(fill_timestamp_end, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='callinvoice',
+            name='timestamp_end',
+            field=models.DateField(),
+        ),
+        migrations.RunPython(partition_tables, unpartition_tables),
+    ]
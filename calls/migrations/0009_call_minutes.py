@@ -0,0 +1,296 @@
+import json
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from itertools import groupby
+from django.db import migrations, models
+from django.utils import timezone
+
+CHUNK_SIZE = 1000
+
+# the pricing of calls.pricing and calls.tariffs when this migration was
+# written, only the minutes charged at the normal tariff are needed
+REDUCED_START = 22
+REDUCED_END = 6
+ONE_DAY = timedelta(days=1)
+ONE_MINUTE = timedelta(minutes=1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def naive(timestamp):
+    if timezone.is_aware(timestamp):
+        return timezone.make_naive(timestamp, timezone.utc)
+    return timestamp
+
+
+def standard_minutes(start_timestamp, end_timestamp):
+    start_timestamp = start_timestamp.replace(tzinfo=None)
+    end_timestamp = end_timestamp.replace(tzinfo=None)
+    normal_start = timedelta(hours=REDUCED_END)
+    normal_end = timedelta(hours=REDUCED_START)
+    first_day = datetime.combine(start_timestamp.date(), time())
+    if start_timestamp.hour >= REDUCED_START or \
+            start_timestamp.hour < REDUCED_END:
+        # a call started at reduced times is only charged from the next
+        # day's normal range
+        first_day += ONE_DAY
+        start_timestamp = first_day + normal_start
+    if end_timestamp <= start_timestamp:
+        return 0
+    last_day = datetime.combine(
+        (end_timestamp - normal_start - ONE_MICROSECOND).date(), time())
+    if end_timestamp == last_day + ONE_DAY + normal_start:
+        last_end = end_timestamp
+    else:
+        last_end = min(end_timestamp, last_day + normal_end)
+    if last_day == first_day:
+        return (last_end - start_timestamp) // ONE_MINUTE
+    first_minutes = (first_day + normal_end - start_timestamp) // ONE_MINUTE
+    full_days = (last_day - first_day).days - 1
+    last_minutes = (last_end - last_day - normal_start) // ONE_MINUTE
+    return first_minutes \
+        + full_days * ((normal_end - normal_start) // ONE_MINUTE) \
+        + last_minutes
+
+
+def normal_ranges(windows, day_type):
+    """
+    :return: (start, end) offsets of the day charged normally
+    """
+    reduced = [False] * 24
+    for start_hour, end_hour, window_day_type in windows:
+        if window_day_type not in ('all', day_type):
+            continue
+        if start_hour < end_hour:
+            hours = range(start_hour, end_hour)
+        else:
+            hours = list(range(start_hour, 24)) + list(range(end_hour))
+        for hour in hours:
+            reduced[hour] = True
+    ranges = []
+    for is_reduced, hours in groupby(range(24), key=reduced.__getitem__):
+        if not is_reduced:
+            hours = list(hours)
+            ranges.append(
+                (timedelta(hours=hours[0]), timedelta(hours=hours[-1] + 1)))
+    return ranges
+
+
+def plan_minutes(ranges, holidays, start_timestamp, end_timestamp):
+    """
+    :param ranges: normal ranges of the rate by day type
+    """
+    minutes = 0
+    day = datetime.combine(start_timestamp.date(), time())
+    while day < end_timestamp:
+        if day.weekday() >= 5 or day.date() in holidays:
+            day_ranges = ranges['weekend']
+        else:
+            day_ranges = ranges['weekday']
+        for range_start, range_end in day_ranges:
+            charged = min(end_timestamp, day + range_end) - \
+                max(start_timestamp, day + range_start)
+            if charged > timedelta(0):
+                minutes += charged // ONE_MINUTE
+        day += ONE_DAY
+    return minutes
+
+
+def reduced_minutes(started_at, ended_at, normal_minutes):
+    minutes = (ended_at - started_at) // ONE_MINUTE
+    return max(minutes - normal_minutes, 0)
+
+
+class Tariffs(object):
+
+    def __init__(self, apps):
+        Holiday = apps.get_model('calls', 'Holiday')
+        PlanSubscription = apps.get_model('calls', 'PlanSubscription')
+        ReducedWindow = apps.get_model('calls', 'ReducedWindow')
+        TariffRate = apps.get_model('calls', 'TariffRate')
+        windows = defaultdict(list)
+        for rate_id, start_hour, end_hour, day_type in \
+                ReducedWindow.objects.values_list(
+                    'rate_id', 'start_hour', 'end_hour', 'day_type'):
+            windows[rate_id].append((start_hour, end_hour, day_type))
+        # plans of each source and rates of each plan and prefix, sorted by
+        # the time they start
+        self.subscriptions = defaultdict(lambda: ([], []))
+        for source, valid_from, plan_id in sorted(
+                (source, naive(valid_from), plan_id)
+                for source, valid_from, plan_id in
+                PlanSubscription.objects.values_list(
+                    'source', 'valid_from', 'plan_id')):
+            starts, plans = self.subscriptions[source]
+            starts.append(valid_from)
+            plans.append(plan_id)
+        self.rates = defaultdict(lambda: ([], []))
+        for plan_id, prefix, effective_from, rate_id in sorted(
+                (plan_id, prefix, naive(effective_from), rate_id)
+                for rate_id, plan_id, prefix, effective_from in
+                TariffRate.objects.values_list(
+                    'id', 'plan_id', 'destination_prefix',
+                    'effective_from')):
+            starts, ranges = self.rates[(plan_id, prefix)]
+            starts.append(effective_from)
+            ranges.append({
+                day_type: normal_ranges(windows[rate_id], day_type)
+                for day_type in ('weekday', 'weekend')
+            })
+        self.holidays = frozenset(Holiday.objects.values_list(
+            'date', flat=True))
+
+    def rate_ranges(self, source, destination, timestamp):
+        """
+        :return: normal ranges of the plan rate of the call, None when it is
+        billed with the standard tariff
+        """
+        starts, plans = self.subscriptions.get(source, ([], []))
+        position = bisect_right(starts, timestamp) - 1
+        if position < 0:
+            return None
+        plan_id = plans[position]
+        # the longest prefix with a rate in effect
+        for length in range(len(destination), -1, -1):
+            starts, ranges = self.rates.get(
+                (plan_id, destination[:length]), ([], []))
+            position = bisect_right(starts, timestamp) - 1
+            if position >= 0:
+                return ranges[position]
+        return None
+
+    def normal_minutes(self, record):
+        started_at = naive(record.started_at)
+        ended_at = naive(record.ended_at)
+        ranges = self.rate_ranges(
+            record.source, record.destination, started_at)
+        if ranges is None:
+            return standard_minutes(started_at, ended_at)
+        return plan_minutes(ranges, self.holidays, started_at, ended_at)
+
+
+def fill_minutes(apps, schema_editor):
+    CallRecord = apps.get_model('calls', 'CallRecord')
+    connection = schema_editor.connection
+    tariffs = Tariffs(apps)
+    records = CallRecord.objects.order_by(
+        'source', 'billing_month', 'ended_at', 'call_id')
+    # bills are completed one at a time, a chunk never splits one
+    chunk = []
+    for bill, group in groupby(
+            records.iterator(chunk_size=CHUNK_SIZE),
+            key=lambda record: (record.source, record.billing_month)):
+        chunk.extend(group)
+        if len(chunk) >= CHUNK_SIZE:
+            fill_chunk(apps, connection, tariffs, chunk)
+            chunk = []
+    if chunk:
+        fill_chunk(apps, connection, tariffs, chunk)
+
+
+def fill_chunk(apps, connection, tariffs, records):
+    InvoiceSummary = apps.get_model('calls', 'InvoiceSummary')
+    calls = {}
+    for record in records:
+        normal = tariffs.normal_minutes(record)
+        record.normal_minutes = normal
+        record.reduced_minutes = reduced_minutes(
+            record.started_at, record.ended_at, normal)
+        calls[record.pk] = record
+    # a plain statement per row, bulk_update spends far longer building
+    # its CASE expressions than the database takes to run them
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'UPDATE calls_callrecord SET normal_minutes = %s, '
+            'reduced_minutes = %s WHERE call_id_id = %s',
+            [(record.normal_minutes, record.reduced_minutes, record.pk)
+             for record in records])
+    bills = {(record.source, record.billing_month) for record in records}
+    summaries = [
+        summary for summary in InvoiceSummary.objects.filter(
+            source__in={source for source, month in bills},
+            billing_month__in={month for source, month in bills})
+        if (summary.source, summary.billing_month) in bills
+    ]
+    for summary in summaries:
+        item_keys = []
+        for item_key in json.loads(summary.item_keys):
+            record = calls.get(item_key[1])
+            normal = record.normal_minutes if record else 0
+            reduced = record.reduced_minutes if record else 0
+            item_keys.append(item_key[:4] + [normal, reduced])
+            summary.normal_minutes += normal
+            summary.reduced_minutes += reduced
+        summary.item_keys = json.dumps(item_keys)
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            'UPDATE calls_invoicesummary SET item_keys = %s, '
+            'normal_minutes = %s, reduced_minutes = %s WHERE id = %s',
+            [(summary.item_keys, summary.normal_minutes,
+              summary.reduced_minutes, summary.pk)
+             for summary in summaries])
+
+
+def rewrite_item_keys(apps, rewrite):
+    InvoiceSummary = apps.get_model('calls', 'InvoiceSummary')
+    summaries = []
+    for summary in InvoiceSummary.objects.iterator(chunk_size=CHUNK_SIZE):
+        item_keys = json.dumps(
+            [rewrite(item_key) for item_key in json.loads(summary.item_keys)])
+        if item_keys == summary.item_keys:
+            continue
+        summary.item_keys = item_keys
+        summaries.append(summary)
+        if len(summaries) == CHUNK_SIZE:
+            InvoiceSummary.objects.bulk_update(summaries, ['item_keys'])
+            summaries = []
+    InvoiceSummary.objects.bulk_update(summaries, ['item_keys'])
+
+
+def add_minutes_to_item_keys(apps, schema_editor):
+    # lines of bills without call records get empty minutes
+    rewrite_item_keys(
+        apps, lambda item_key: item_key if len(item_key) == 6
+        else item_key[:4] + [0, 0])
+
+
+def remove_minutes_from_item_keys(apps, schema_editor):
+    rewrite_item_keys(apps, lambda item_key: item_key[:4])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0008_partition_call_logs_invoices'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callrecord',
+            name='normal_minutes',
+            field=models.PositiveIntegerField(default=0, help_text='Whole minutes charged at the normal tariff'),
+        ),
+        migrations.AddField(
+            model_name='callrecord',
+            name='reduced_minutes',
+            field=models.PositiveIntegerField(default=0, help_text='Whole minutes of the call that were not charged'),
+        ),
+        migrations.AddField(
+            model_name='invoicesummary',
+            name='normal_minutes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='invoicesummary',
+            name='reduced_minutes',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='invoicesummary',
+            name='item_keys',
+            field=models.TextField(default='[]', help_text='Order key, call, price, duration, normal and reduced minutes of each line item'),
+        ),
+        migrations.RunPython(fill_minutes, migrations.RunPython.noop),
+        migrations.RunPython(
+            add_minutes_to_item_keys, remove_minutes_from_item_keys),
+    ]
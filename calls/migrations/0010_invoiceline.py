@@ -0,0 +1,141 @@
+# Generated by Django 2.2.5 on 2026-10-18 18:32
+
+import json
+from itertools import groupby
+from django.db import migrations, models
+from django.utils import timezone
+import django.db.models.deletion
+
+CHUNK_SIZE = 1000
+
+
+def serialize_item(record):
+    # same item as CallRecordRowSerializer renders
+    hours, seconds = divmod(record.duration_seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return json.dumps({
+        'call_id': record.pk,
+        'price': "R$ %s" % record.price,
+        'duration': "%dh%dm%ds" % (hours, minutes, seconds),
+        'call_start_date': record.started_at.date().isoformat(),
+        'call_start_time': record.started_at.time().isoformat(),
+        'destination': record.destination,
+    })
+
+
+def build_bills(apps, schema_editor):
+    # every bill is built again from the call records, bills of the calls
+    # billed before the summaries were stored included
+    CallRecord = apps.get_model('calls', 'CallRecord')
+    InvoiceSummary = apps.get_model('calls', 'InvoiceSummary')
+    InvoiceSummary.objects.all().delete()
+    records = CallRecord.objects.order_by(
+        'source', 'billing_month', 'ended_at', 'call_id')
+    bills = {}
+    for bill, group in groupby(
+            records.iterator(chunk_size=CHUNK_SIZE),
+            key=lambda record: (record.source, record.billing_month)):
+        bills[bill] = list(group)
+        if len(bills) == CHUNK_SIZE:
+            store_bills(apps, bills)
+            bills = {}
+    store_bills(apps, bills)
+
+
+def store_bills(apps, bills):
+    InvoiceLine = apps.get_model('calls', 'InvoiceLine')
+    InvoiceSummary = apps.get_model('calls', 'InvoiceSummary')
+    InvoiceSummary.objects.bulk_create([
+        InvoiceSummary(
+            source=source,
+            billing_month=month,
+            total=sum(record.price for record in records),
+            call_count=len(records),
+            total_duration_seconds=sum(
+                record.duration_seconds for record in records),
+            normal_minutes=sum(record.normal_minutes for record in records),
+            reduced_minutes=sum(record.reduced_minutes for record in records),
+            updated_at=timezone.now()
+        )
+        for (source, month), records in bills.items()
+    ])
+    summaries = InvoiceSummary.objects.filter(
+        source__in={source for source, month in bills},
+        billing_month__in={month for source, month in bills})
+    InvoiceLine.objects.bulk_create([
+        InvoiceLine(
+            call_id_id=record.pk,
+            summary_id=summary.pk,
+            ended_at=record.ended_at,
+            price=record.price,
+            duration_seconds=record.duration_seconds,
+            normal_minutes=record.normal_minutes,
+            reduced_minutes=record.reduced_minutes,
+            item=serialize_item(record)
+        )
+        for summary in summaries
+        for record in bills.get((summary.source, summary.billing_month), [])
+    ], batch_size=CHUNK_SIZE)
+
+
+def build_items(apps, schema_editor):
+    InvoiceLine = apps.get_model('calls', 'InvoiceLine')
+    InvoiceSummary = apps.get_model('calls', 'InvoiceSummary')
+    lines = InvoiceLine.objects.order_by('summary', 'ended_at', 'call_id')
+    summaries = []
+    for summary_id, group in groupby(
+            lines.iterator(chunk_size=CHUNK_SIZE),
+            key=lambda line: line.summary_id):
+        group = list(group)
+        summaries.append(InvoiceSummary(
+            id=summary_id,
+            items='[%s]' % ','.join(line.item for line in group),
+            item_keys=json.dumps([
+                [line.ended_at.astimezone(timezone.utc).strftime(
+                    '%Y-%m-%dT%H:%M:%S.%f'), line.pk, str(line.price),
+                 line.duration_seconds, line.normal_minutes,
+                 line.reduced_minutes]
+                for line in group
+            ])
+        ))
+        if len(summaries) == CHUNK_SIZE:
+            InvoiceSummary.objects.bulk_update(
+                summaries, ['items', 'item_keys'])
+            summaries = []
+    InvoiceSummary.objects.bulk_update(summaries, ['items', 'item_keys'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0009_call_minutes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InvoiceLine',
+            fields=[
+                ('call_id', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='invoice_line', serialize=False, to='calls.Call')),
+                ('ended_at', models.DateTimeField()),
+                ('price', models.DecimalField(decimal_places=2, max_digits=15)),
+                ('duration_seconds', models.PositiveIntegerField()),
+                ('normal_minutes', models.PositiveIntegerField(default=0)),
+                ('reduced_minutes', models.PositiveIntegerField(default=0)),
+                ('item', models.TextField(help_text='Serialized line item')),
+                ('summary', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='calls.InvoiceSummary')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='invoiceline',
+            index=models.Index(fields=['summary', 'ended_at', 'call_id'], name='invoiceline_order_idx'),
+        ),
+        migrations.RunPython(build_bills, build_items),
+        migrations.RemoveField(
+            model_name='invoicesummary',
+            name='item_keys',
+        ),
+        migrations.RemoveField(
+            model_name='invoicesummary',
+            name='items',
+        ),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 2.2.5 on 2026-10-18 18:45
+
+from django.db import migrations
+
+# the keys created by 0008 on the partitioned tables of PostgreSQL, the
+# other databases get the same ones
+UNIQUE_TOGETHER = {
+    'calllog': ({('type', 'call_id')}, {('type', 'call_id', 'timestamp')}),
+    'callinvoice': ({('call_id',)}, {('call_id', 'timestamp_end')}),
+}
+
+
+def alter_unique_together(apps, schema_editor, reverse=False):
+    if schema_editor.connection.vendor == 'postgresql':
+        return
+    for model_name, (old, new) in UNIQUE_TOGETHER.items():
+        if reverse:
+            old, new = new, old
+        schema_editor.alter_unique_together(
+            apps.get_model('calls', model_name), old, new)
+
+
+def restore_unique_together(apps, schema_editor):
+    alter_unique_together(apps, schema_editor, reverse=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0011_tariffversion'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(
+                    alter_unique_together, restore_unique_together),
+            ],
+            state_operations=[
+                migrations.AlterUniqueTogether(
+                    name='callinvoice',
+                    unique_together={('call_id', 'timestamp_end')},
+                ),
+                migrations.AlterUniqueTogether(
+                    name='calllog',
+                    unique_together={('type', 'call_id', 'timestamp')},
+                ),
+            ],
+        ),
+    ]
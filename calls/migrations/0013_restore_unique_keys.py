@@ -0,0 +1,50 @@
+# Generated by Django 2.2.5 on 2026-10-18 21:10
+
+from django.db import migrations
+
+# only the partitioned tables of PostgreSQL need their partition key in the
+# unique keys, the other databases get back the keys 0012 widened
+UNIQUE_TOGETHER = {
+    'calllog': ({('type', 'call_id', 'timestamp')}, {('type', 'call_id')}),
+    'callinvoice': ({('call_id', 'timestamp_end')}, {('call_id',)}),
+}
+
+
+def alter_unique_together(apps, schema_editor, reverse=False):
+    if schema_editor.connection.vendor == 'postgresql':
+        return
+    for model_name, (old, new) in UNIQUE_TOGETHER.items():
+        if reverse:
+            old, new = new, old
+        schema_editor.alter_unique_together(
+            apps.get_model('calls', model_name), old, new)
+
+
+def widen_unique_together(apps, schema_editor):
+    alter_unique_together(apps, schema_editor, reverse=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('calls', '0012_partition_unique_keys'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunPython(
+                    alter_unique_together, widen_unique_together),
+            ],
+            state_operations=[
+                migrations.AlterUniqueTogether(
+                    name='callinvoice',
+                    unique_together={('call_id',)},
+                ),
+                migrations.AlterUniqueTogether(
+                    name='calllog',
+                    unique_together={('type', 'call_id')},
+                ),
+            ],
+        ),
+    ]
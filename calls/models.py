@@ -1,14 +1,80 @@
-from datetime import timedelta
+import json
+import uuid
+from datetime import datetime, timedelta
+from calls import pricing, tariffs
+from calls.pricing import charged_minutes
 from calls.validators import validate_phone_number
-from django.core.validators import ValidationError
+from django.conf import settings
+from django.core.validators import MaxValueValidator, ValidationError
 from django.db import models
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
 from django.utils.translation import gettext_lazy as _
 
 
+def format_duration(duration):
+    days = duration.days
+    hours, remainder = divmod(duration.seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    seconds += duration.microseconds / 1e6
+    seconds = int(seconds)
+    if days:
+        hours += days * 24
+    return "{}h{}m{}s".format(hours, minutes, seconds)
+
+
+def billing_month(date):
+    # invoices are grouped by the month of the date the call ended
+    if isinstance(date, datetime):
+        if timezone.is_aware(date):
+            date = timezone.localtime(date, timezone.get_default_timezone())
+        date = date.date()
+    return date.replace(day=1)
+
+
+def as_stored(timestamp):
+    # timestamps read back from the database are aware, naive ones given
+    # to the models are stored in the default time zone
+    if settings.USE_TZ and timezone.is_naive(timestamp):
+        return timezone.make_aware(timestamp, timezone.get_default_timezone())
+    return timestamp
+
+
+def reduced_minutes(started_at, ended_at, normal_minutes):
+    # whole minutes of the call left once the charged ones are taken out
+    minutes = (ended_at - started_at) // pricing.ONE_MINUTE
+    return max(minutes - normal_minutes, 0)
+
+
+def month_range(date):
+    # half-open range [first day of the month, first day of the next month)
+    # so lookups compare the raw column and can use its index
+    first_day = billing_month(date)
+    next_month = (first_day + timedelta(days=32)).replace(day=1)
+    return first_day, next_month
+
+
+class CallQuerySet(models.QuerySet):
+
+    def with_log_timestamps(self):
+        """
+        Load the timestamps of the start and end records along with the
+        calls, as started_at and ended_at, None while a record is missing.
+        """
+        logs = CallLog.objects.filter(call_id=OuterRef('pk'))
+        return self.annotate(
+            started_at=Subquery(
+                logs.filter(type='start').values('timestamp')[:1]),
+            ended_at=Subquery(
+                logs.filter(type='end').values('timestamp')[:1])
+        )
+
+
 class Call(models.Model):
     source = models.CharField(
         max_length=11,
         validators=[validate_phone_number],
+        db_index=True,
         help_text="The subscriber phone number that originated the call"
     )
     destination = models.CharField(
@@ -17,6 +83,8 @@ class Call(models.Model):
         help_text="The phone number receiving the call"
     )
 
+    objects = CallQuerySet.as_manager()
+
     def save(self, *args, **kwargs):
         if self.destination == self.source:
             msg = 'Source and destination cannot contain the same value.'
@@ -46,6 +114,10 @@ class CallLog(models.Model):
     )
 
     class Meta:
+        # on PostgreSQL the key also includes the timestamp, the partition
+        # key, a second record of the same type is then rejected by
+        # validation and, between concurrent requests, by the keys of the
+        # call, the call record and the billing job
         unique_together = (('type', 'call_id'),)
 
     def __str__(self):
@@ -54,20 +126,27 @@ class CallLog(models.Model):
         elif self.type == 'end':
             return "ended at {timestamp}".format(timestamp=self.timestamp)
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, log_start=None, **kwargs):
+        """
+        :param log_start: start record of the call, when the caller already
+        has it, it is not queried again
+        """
         if self.type == 'end':
-            try:
-                log_start = CallLog.objects.get(
-                    call_id=self.call_id, type='start')
-            except CallLog.DoesNotExist:
-                msg = "There is no start record for this call, " \
-                      "the end of a call cannot be logged before it starts."
-                raise ValidationError(msg)
+            if log_start is None:
+                try:
+                    log_start = CallLog.objects.get(
+                        call_id=self.call_id, type='start')
+                except CallLog.DoesNotExist:
+                    msg = "There is no start record for this call, the " \
+                          "end of a call cannot be logged before it starts."
+                    raise ValidationError(msg)
             if self.timestamp.replace(tzinfo=None) <= \
                     log_start.timestamp.replace(tzinfo=None):
                 msg = "The call end time cannot be earlier or equal than " \
                       "the start time."
                 raise ValidationError(_(msg))
+            # handed to the invoice created when the end is stored
+            self.log_start = log_start
 
         super(CallLog, self).save(*args, **kwargs)
 
@@ -80,69 +159,129 @@ class CallLog(models.Model):
         return self.call_id.source
 
 
+class CallInvoiceQuerySet(models.QuerySet):
+
+    def with_call_logs(self):
+        """
+        Load the call and its start and end timestamps along with the
+        invoices, so reading them does not cost extra queries per invoice.
+        """
+        logs = CallLog.objects.filter(call_id=OuterRef('call_id'))
+        return self.select_related('call_id').annotate(
+            call_started_at=Subquery(
+                logs.filter(type='start').values('timestamp')[:1]),
+            call_ended_at=Subquery(
+                logs.filter(type='end').values('timestamp')[:1])
+        )
+
+
 class CallInvoice(models.Model):
-    REDUCED_START = 22
-    REDUCED_END = 6
-    MINUTE_PRICE = 0.09
-    STANDING_PRICE = 0.36
+    REDUCED_START = pricing.REDUCED_START
+    REDUCED_END = pricing.REDUCED_END
+    MINUTE_PRICE = pricing.MINUTE_PRICE
+    STANDING_PRICE = pricing.STANDING_PRICE
 
     call_id = models.ForeignKey(
         Call,
         on_delete=models.CASCADE,
         related_name="invoice"
     )
-    timestamp_end = models.DateField(
-        null=True
-    )
+    # partition key of the table on PostgreSQL, so it cannot be null
+    timestamp_end = models.DateField()
     price = models.DecimalField(
         max_digits=15,
         decimal_places=2,
         null=True
     )
 
+    objects = CallInvoiceQuerySet.as_manager()
+
     class Meta:
+        # on PostgreSQL the key also includes timestamp_end, the partition key
         unique_together = ('call_id',)
+        indexes = [
+            models.Index(
+                fields=['timestamp_end', 'call_id'],
+                name='callinvoice_month_idx'
+            ),
+        ]
 
-    def save(self, *args, **kwargs):
-        try:
-            CallLog.objects.filter(call_id=self.call_id, type='end').get()
-        except CallLog.DoesNotExist:
-            msg = "You cannot create an invoice for a call without an end " \
-                  "registration."
-            raise ValidationError(msg)
-        log_start = self.call_id.logs.get(type='start')
-        log_end = self.call_id.logs.get(type='end')
-        self.timestamp_end = log_end.timestamp
-        self.price = self.compute_time_billing(
-            self.STANDING_PRICE, log_start.timestamp, log_end.timestamp)
+    def save(self, *args, log_start=None, log_end=None, **kwargs):
+        """
+        :param log_start: start record of the call, queried when not given
+        :param log_end: end record of the call, queried when not given
+        """
+        if log_end is None:
+            try:
+                log_end = CallLog.objects.get(call_id=self.call_id, type='end')
+            except CallLog.DoesNotExist:
+                msg = "You cannot create an invoice for a call without an " \
+                      "end registration."
+                raise ValidationError(msg)
+        if log_start is None:
+            log_start = self.call_id.logs.get(type='start')
+        self.bill(log_start.timestamp, log_end.timestamp)
         super(CallInvoice, self).save(*args, **kwargs)
 
+    def bill(self, start_timestamp, end_timestamp):
+        start_timestamp = as_stored(start_timestamp)
+        end_timestamp = as_stored(end_timestamp)
+        call = self.call_id
+        charge = tariffs.get_index().charge(
+            call.source, call.destination, start_timestamp, end_timestamp)
+        if charge is None:
+            minutes = charged_minutes(
+                start_timestamp, end_timestamp,
+                self.REDUCED_START, self.REDUCED_END)
+            charge = self.STANDING_PRICE + minutes * self.MINUTE_PRICE, \
+                minutes
+        self.set_charge(start_timestamp, end_timestamp, *charge)
+
+    def set_charge(self, start_timestamp, end_timestamp, price,
+                   normal_minutes):
+        """
+        Bill the call at a price computed beforehand, along with the other
+        calls of a batch. The timestamps are expected as stored.
+
+        :param price: Decimal price of the call
+        :param normal_minutes: minutes charged at the normal tariff
+        """
+        self.call_started_at = start_timestamp
+        self.call_ended_at = end_timestamp
+        self.timestamp_end = end_timestamp
+        self.price = price
+        self.normal_minutes = normal_minutes
+
     @property
     def price_display(self):
         return "R$ %s" % self.price
 
     @property
     def call_start_date(self):
-        if self.call_id.logs.filter(type='start').exists():
-            log_start = self.call_id.logs.get(type='start')
-            return log_start.timestamp.date()
+        started_at = self.started_at
+        if started_at is not None:
+            return started_at.date()
 
     @property
     def call_start_time(self):
-        if self.call_id.logs.filter(type='start').exists():
-            log_start = self.call_id.logs.get(type='start')
-            return log_start.timestamp.time()
+        started_at = self.started_at
+        if started_at is not None:
+            return started_at.time()
 
     @property
     def started_at(self):
-        if self.call_id.logs.filter(type='start').exists():
-            log_start = self.call_id.logs.get(type='start')
+        if hasattr(self, 'call_started_at'):
+            return self.call_started_at
+        log_start = self.call_id.logs.filter(type='start').first()
+        if log_start is not None:
             return log_start.timestamp
 
     @property
     def ended_at(self):
-        if self.call_id.logs.filter(type='end').exists():
-            log_end = self.call_id.logs.get(type='end')
+        if hasattr(self, 'call_ended_at'):
+            return self.call_ended_at
+        log_end = self.call_id.logs.filter(type='end').first()
+        if log_end is not None:
             return log_end.timestamp
 
     @property
@@ -151,91 +290,314 @@ class CallInvoice(models.Model):
 
     @property
     def duration(self):
-        duration = self.ended_at - self.started_at
-        days = duration.days
-        hours, remainder = divmod(duration.seconds, 3600)
-        minutes, seconds = divmod(remainder, 60)
-        seconds += duration.microseconds / 1e6
-        seconds = int(seconds)
-        if days:
-            hours += days * 24
-        return "{}h{}m{}s".format(hours, minutes, seconds)
-
-    def compute_time_billing(
-            self, start_price, start_timestamp, end_timestamp):
+        return format_duration(self.ended_at - self.started_at)
+
+
+class CallRecord(models.Model):
+    """
+    Denormalized call with everything needed to bill it, kept in sync with
+    the call invoices so reading a bill does not need any join.
+    """
+    call_id = models.OneToOneField(
+        Call,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="record"
+    )
+    source = models.CharField(
+        max_length=11,
+        help_text="The subscriber phone number that originated the call"
+    )
+    destination = models.CharField(
+        max_length=11,
+        help_text="The phone number receiving the call"
+    )
+    started_at = models.DateTimeField()
+    ended_at = models.DateTimeField()
+    duration_seconds = models.PositiveIntegerField()
+    price = models.DecimalField(
+        max_digits=15,
+        decimal_places=2
+    )
+    normal_minutes = models.PositiveIntegerField(
+        default=0,
+        help_text="Whole minutes charged at the normal tariff"
+    )
+    reduced_minutes = models.PositiveIntegerField(
+        default=0,
+        help_text="Whole minutes of the call that were not charged"
+    )
+    billing_month = models.DateField(
+        help_text="First day of the month the call is billed in"
+    )
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['source', 'billing_month', 'ended_at', 'call_id'],
+                name='callrecord_invoice_idx'
+            ),
+        ]
+
+    @classmethod
+    def from_invoice(cls, invoice):
+        call = invoice.call_id
+        started_at = invoice.started_at
+        ended_at = invoice.ended_at
+        return cls(
+            call_id=call,
+            source=call.source,
+            destination=call.destination,
+            started_at=started_at,
+            ended_at=ended_at,
+            duration_seconds=(ended_at - started_at) // timedelta(seconds=1),
+            price=invoice.price,
+            normal_minutes=invoice.normal_minutes,
+            reduced_minutes=reduced_minutes(
+                started_at, ended_at, invoice.normal_minutes),
+            billing_month=billing_month(ended_at)
+        )
+
+    @property
+    def price_display(self):
+        return "R$ %s" % self.price
+
+    @property
+    def call_start_date(self):
+        return self.started_at.date()
+
+    @property
+    def call_start_time(self):
+        return self.started_at.time()
+
+    @property
+    def duration(self):
+        return format_duration(timedelta(seconds=self.duration_seconds))
+
+
+class InvoiceSummary(models.Model):
+    """
+    Bill of a subscriber for one month, updated as each call is billed so
+    closed months are served without reading the calls again.
+    """
+    source = models.CharField(
+        max_length=11,
+        help_text="The subscriber phone number"
+    )
+    billing_month = models.DateField(
+        help_text="First day of the month of the bill"
+    )
+    total = models.DecimalField(
+        max_digits=15,
+        decimal_places=2,
+        default=0
+    )
+    call_count = models.PositiveIntegerField(default=0)
+    total_duration_seconds = models.BigIntegerField(default=0)
+    normal_minutes = models.BigIntegerField(default=0)
+    reduced_minutes = models.BigIntegerField(default=0)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = ('source', 'billing_month')
+
+    def serialized_items(self):
         """
-        :param start_price: starting price of the calculation
-        :param start_timestamp: start date of calculation
-        :param end_timestamp: end date of calculation
-        :return: price
+        :return: JSON array of the line items in the response order, joined
+        from the stored lines without parsing them
         """
-        def reduced_fare_range(start_reduced, end_reduced, timestamp):
-            # check if the past date is within the uncharged range
-            if timestamp.hour >= start_reduced or timestamp.hour < end_reduced:
-                return True
-
-        def replace_date_to_normal_range(end_reduced, timestamp):
-            # replace the date to normal billing time
-            next_day = timestamp + timedelta(days=1)
-            new_timestamp = timestamp.replace(
-                day=next_day.day, month=next_day.month,
-                hour=end_reduced, minute=0, second=0, microsecond=0
-            )
-            return new_timestamp
-
-        def get_time_charged(start_reduced, timestamp):
-            # calculates the time charged when the end of the call is
-            # more than 22 hours of the call start day
-            start_fare_range = timestamp.replace(
-                hour=start_reduced, minute=0, second=0, microsecond=0)
-            time_charged = int(
-                (start_fare_range - timestamp).total_seconds() / 60)
-            return time_charged
-
-        reduced_start = self.REDUCED_START
-        reduced_end = self.REDUCED_END
-        start_timestamp = start_timestamp.replace(tzinfo=None)
-        end_timestamp = end_timestamp.replace(tzinfo=None)
-        price = start_price
-        next_start_date = replace_date_to_normal_range(
-            reduced_end, start_timestamp)
-        if reduced_fare_range(reduced_start, reduced_end, start_timestamp):
-            # check if the start date is at non-charged times
-            if end_timestamp < next_start_date:
-                # if the end date is also non-billing, no minutes are charged
-                # and the starting price must be returned
-                return price
-            else:
-                # If the call end date is greater than the no charge time, the
-                # start date should be replaced with the next date and time in
-                # the normal charge range and the method called
-                # using recursion.
-                price = self.compute_time_billing(
-                    price, next_start_date, end_timestamp)
-        elif reduced_fare_range(reduced_start, reduced_end, end_timestamp):
-            # if the start date and time are not at no charge
-            # times but the call end date and time are within the no
-            # charge range
-            minutes_normal = get_time_charged(reduced_start, start_timestamp)
-            price += minutes_normal * self.MINUTE_PRICE
-            if next_start_date > end_timestamp:
-                # if the call end date and time is less than the next charge
-                # start date and time, the calculated price must be returned
-                return price
-            price = self.compute_time_billing(
-                price, next_start_date, end_timestamp)
-        elif end_timestamp > next_start_date:
-            # tests if the call end date and time are longer than the next
-            # charged date and time
-            minutes_bill = get_time_charged(reduced_start, start_timestamp)
-            price += minutes_bill * self.MINUTE_PRICE
-            price = self.compute_time_billing(
-                price, next_start_date, end_timestamp)
-        # elif start_timestamp.day == end_timestamp.day:
-        else:
-            # otherwise it is understood that the call occurred
-            # entirely on the same day and at normal billing time.
-            minutes_normal = int(
-                (end_timestamp - start_timestamp).total_seconds() / 60)
-            price += (minutes_normal * self.MINUTE_PRICE)
-        return price
+        items = self.lines.order_by('ended_at', 'call_id').values_list(
+            'item', flat=True)
+        return '[%s]' % ','.join(items)
+
+    def line_items(self):
+        return json.loads(self.serialized_items())
+
+
+class InvoiceLine(models.Model):
+    """
+    Line item of a stored bill, kept serialized along with what it adds to
+    the totals, so billing a call inserts its line and leaves the others
+    alone.
+    """
+    call_id = models.OneToOneField(
+        Call,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="invoice_line"
+    )
+    # the order index below starts with the bill
+    summary = models.ForeignKey(
+        InvoiceSummary,
+        on_delete=models.CASCADE,
+        related_name='lines',
+        db_index=False
+    )
+    ended_at = models.DateTimeField()
+    price = models.DecimalField(
+        max_digits=15,
+        decimal_places=2
+    )
+    duration_seconds = models.PositiveIntegerField()
+    normal_minutes = models.PositiveIntegerField(default=0)
+    reduced_minutes = models.PositiveIntegerField(default=0)
+    item = models.TextField(help_text="Serialized line item")
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['summary', 'ended_at', 'call_id'],
+                name='invoiceline_order_idx'
+            ),
+        ]
+
+
+class BillingJob(models.Model):
+    """
+    Call waiting to be billed, used when billing runs in the background
+    workers instead of in the request that stores the end of the call.
+    """
+    STATUSES = (
+        ('pending', 'Pending'),
+        ('failed', 'Failed')
+    )
+
+    call_id = models.OneToOneField(
+        Call,
+        on_delete=models.CASCADE,
+        related_name="billing_job"
+    )
+    status = models.CharField(
+        choices=STATUSES,
+        max_length=7,
+        default='pending'
+    )
+    attempts = models.PositiveIntegerField(default=0)
+    available_at = models.DateTimeField(
+        default=timezone.now,
+        help_text="The job is not claimed before this time"
+    )
+    last_error = models.TextField(blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=['status', 'available_at', 'id'],
+                name='billingjob_claim_idx'
+            ),
+        ]
+
+
+class PendingCallEnd(models.Model):
+    """
+    End record received before the start of its call, kept until the start
+    arrives and the pair can be billed.
+    """
+    call_id = models.IntegerField(
+        unique=True,
+        help_text="Id of the call that has not started yet"
+    )
+    timestamp = models.DateTimeField(
+        help_text="The timestamp of when the call ended"
+    )
+    received_at = models.DateTimeField(default=timezone.now, db_index=True)
+    error = models.TextField(
+        blank=True,
+        help_text="Why the record could not be paired with its start"
+    )
+
+
+class TariffPlan(models.Model):
+    """
+    Set of effective-dated rates. Calls of subscribers without a plan are
+    billed with the standard tariff of calls.pricing.
+    """
+    name = models.CharField(max_length=50, unique=True)
+
+    def __str__(self):
+        return self.name
+
+
+class PlanSubscription(models.Model):
+    source = models.CharField(
+        max_length=11,
+        validators=[validate_phone_number],
+        help_text="The subscriber phone number billed with the plan"
+    )
+    plan = models.ForeignKey(
+        TariffPlan,
+        on_delete=models.CASCADE,
+        related_name='subscriptions'
+    )
+    valid_from = models.DateTimeField(
+        help_text="Calls started from this time on are billed with the plan"
+    )
+
+    class Meta:
+        unique_together = ('source', 'valid_from')
+
+
+class TariffRate(models.Model):
+    plan = models.ForeignKey(
+        TariffPlan,
+        on_delete=models.CASCADE,
+        related_name='rates'
+    )
+    destination_prefix = models.CharField(
+        max_length=11,
+        blank=True,
+        help_text="Destinations the rate applies to, the longest matching "
+                  "prefix is used and a blank prefix matches any destination"
+    )
+    effective_from = models.DateTimeField(
+        help_text="Calls started from this time on are billed with the rate"
+    )
+    standing_price = models.DecimalField(max_digits=15, decimal_places=2)
+    minute_price = models.DecimalField(
+        max_digits=15,
+        decimal_places=2,
+        help_text="Price of each minute outside the reduced windows"
+    )
+
+    class Meta:
+        unique_together = ('plan', 'destination_prefix', 'effective_from')
+
+
+class ReducedWindow(models.Model):
+    """
+    Hours of the day whose minutes are not charged, a window ending at or
+    before its start hour goes across midnight.
+    """
+    DAY_TYPES = (
+        ('all', 'All days'),
+        ('weekday', 'Weekdays'),
+        ('weekend', 'Weekends and holidays')
+    )
+
+    rate = models.ForeignKey(
+        TariffRate,
+        on_delete=models.CASCADE,
+        related_name='reduced_windows'
+    )
+    start_hour = models.PositiveSmallIntegerField(
+        validators=[MaxValueValidator(23)])
+    end_hour = models.PositiveSmallIntegerField(
+        validators=[MaxValueValidator(24)])
+    day_type = models.CharField(
+        choices=DAY_TYPES,
+        max_length=7,
+        default='all'
+    )
+
+
+class Holiday(models.Model):
+    date = models.DateField(unique=True)
+    name = models.CharField(max_length=100, blank=True)
+
+
+class TariffVersion(models.Model):
+    """
+    Single row changed along with the tariffs, the processes compare it with
+    the version of the tariffs they compiled.
+    """
+    version = models.UUIDField(default=uuid.uuid4)
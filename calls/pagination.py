@@ -0,0 +1,85 @@
+import base64
+from collections import OrderedDict
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class InvoiceCursorPagination(BasePagination):
+    """
+    Keyset pagination of call records on (ended_at, call_id), the order of
+    the invoice index, so every page is a single index range scan however
+    deep it is. Pagination is only used when a cursor or a page size is
+    requested.
+    """
+    cursor_query_param = 'cursor'
+    page_size_query_param = 'page_size'
+    page_size = 100
+    max_page_size = 1000
+    invalid_cursor_message = 'Invalid cursor'
+
+    def is_requested(self, request):
+        return self.cursor_query_param in request.query_params or \
+            self.page_size_query_param in request.query_params
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.is_requested(request):
+            return None
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = request.query_params.get(self.cursor_query_param)
+        if cursor:
+            ended_at, call_id = self.decode_cursor(cursor)
+            queryset = queryset.filter(
+                Q(ended_at__gt=ended_at) |
+                Q(ended_at=ended_at, call_id__gt=call_id)
+            )
+        records = list(
+            queryset.order_by('ended_at', 'call_id')[:self.page_size + 1])
+        self.has_next = len(records) > self.page_size
+        records = records[:self.page_size]
+        self.last = records[-1] if records else None
+        return records
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(
+            url, self.page_size_query_param, self.page_size)
+        return replace_query_param(
+            url, self.cursor_query_param, self.encode_cursor(self.last))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+    def encode_cursor(self, row):
+        position = '{}|{}'.format(row['ended_at'].isoformat(), row['call_id'])
+        return base64.urlsafe_b64encode(position.encode('ascii')).decode()
+
+    def decode_cursor(self, cursor):
+        try:
+            position = base64.urlsafe_b64decode(cursor.encode('ascii'))
+            ended_at, call_id = position.decode('ascii').split('|')
+            ended_at = parse_datetime(ended_at)
+            call_id = int(call_id)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        if ended_at is None:
+            raise NotFound(self.invalid_cursor_message)
+        return ended_at, call_id
@@ -0,0 +1,216 @@
+"""
+Monthly range partitions of the call logs and invoices, PostgreSQL 11 or
+later only. Each table has a partition per month named <table>_pYYYYMM and
+a default partition catching the rows of months without one, so inserts
+never fail when create_partitions runs late. Old months are dropped, or
+detached for archiving, a partition at a time instead of deleted row by row.
+The logs of a call are kept as long as its invoice, and the call records and
+bills of the expired months are deleted along with them.
+"""
+
+import re
+from datetime import date, datetime, time
+from django.db.models import Min
+from django.utils import timezone
+from calls.models import CallLog, billing_month, month_range
+from calls.summaries import expire_bills
+
+
+# table, partition key, whether the key is a date rather than a timestamp
+PARTITIONED_TABLES = (
+    ('calls_calllog', 'timestamp', False),
+    ('calls_callinvoice', 'timestamp_end', True),
+)
+PARTITION_NAME = re.compile(r'_p(\d{4})(\d{2})$')
+
+
+def add_months(month, months):
+    """
+    :param month: first day of a month
+    :return: first day of the month that many months later
+    """
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1, day=1)
+
+
+def partition_name(table, month):
+    return '{table}_p{month:%Y%m}'.format(table=table, month=month)
+
+
+def default_partition_name(table):
+    return table + '_default'
+
+
+def month_start(month):
+    return timezone.make_aware(
+        datetime.combine(month, time()), timezone.get_default_timezone())
+
+
+def month_bounds(month, is_date):
+    """
+    :return: the first and last (excluded) values of the partition key in
+    the month, as literals, bounds of a partition cannot be expressions
+    """
+    first_day, next_month = month_range(month)
+    if is_date:
+        return first_day.isoformat(), next_month.isoformat()
+    return tuple(
+        month_start(day).isoformat(' ') for day in (first_day, next_month))
+
+
+def is_partitioned(cursor, table):
+    cursor.execute(
+        'SELECT 1 FROM pg_partitioned_table p '
+        'JOIN pg_class c ON c.oid = p.partrelid '
+        'WHERE c.relname = %s AND pg_table_is_visible(c.oid)', [table])
+    return cursor.fetchone() is not None
+
+
+def tables_partitioned(connection):
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        return all(
+            is_partitioned(cursor, table)
+            for table, column, is_date in PARTITIONED_TABLES)
+
+
+def partition_months(cursor, table):
+    """
+    :return: sorted list of the months with a partition
+    """
+    cursor.execute(
+        'SELECT c.relname FROM pg_inherits i '
+        'JOIN pg_class c ON c.oid = i.inhrelid '
+        'JOIN pg_class p ON p.oid = i.inhparent '
+        'WHERE p.relname = %s AND pg_table_is_visible(p.oid)', [table])
+    months = []
+    for name, in cursor.fetchall():
+        match = PARTITION_NAME.search(name)
+        if match is None:
+            continue
+        month = date(int(match.group(1)), int(match.group(2)), 1)
+        if name == partition_name(table, month):
+            months.append(month)
+    return sorted(months)
+
+
+def default_months(cursor, quote_name, table, column, is_date,
+                   before_month):
+    """
+    :return: the months before the given one with rows in the default
+    partition
+    """
+    key = quote_name(column)
+    params = [month_bounds(before_month, is_date)[0]]
+    if not is_date:
+        key += ' AT TIME ZONE %s'
+        params.insert(0, timezone.get_default_timezone_name())
+    cursor.execute(
+        "SELECT DISTINCT CAST(date_trunc('month', {key}) AS date) "
+        "FROM {default} WHERE {column} < %s".format(
+            key=key, default=quote_name(default_partition_name(table)),
+            column=quote_name(column)),
+        params)
+    return sorted(month for month, in cursor.fetchall())
+
+
+def first_log_month(before_month):
+    """
+    :return: first month whose call logs are kept, the month the earliest
+    call ending from the given month on started
+    """
+    first = month_start(before_month)
+    started_at = CallLog.objects.filter(
+        type='start', timestamp__lt=first,
+        call_id__logs__type='end', call_id__logs__timestamp__gte=first
+    ).aggregate(started_at=Min('timestamp'))['started_at']
+    return billing_month(started_at) if started_at else before_month
+
+
+def create_partition(cursor, quote_name, table, column, is_date, month):
+    """
+    Create the partition of a month, moving into it the rows of the month
+    the default partition caught.
+    """
+    partition = quote_name(partition_name(table, month))
+    default = quote_name(default_partition_name(table))
+    first, last = month_bounds(month, is_date)
+    cursor.execute(
+        'CREATE TABLE {partition} (LIKE {table} INCLUDING DEFAULTS)'.format(
+            partition=partition, table=quote_name(table)))
+    cursor.execute(
+        'WITH moved AS (DELETE FROM {default} WHERE {column} >= %s AND '
+        '{column} < %s RETURNING *) '
+        'INSERT INTO {partition} SELECT * FROM moved'.format(
+            default=default, column=quote_name(column),
+            partition=partition),
+        [first, last])
+    cursor.execute(
+        'ALTER TABLE {table} ATTACH PARTITION {partition} '
+        'FOR VALUES FROM (%s) TO (%s)'.format(
+            table=quote_name(table), partition=partition),
+        [first, last])
+
+
+def create_partitions(connection, first_month, last_month,
+                      tables=PARTITIONED_TABLES):
+    """
+    Create the missing partitions of every table from the first to the
+    last month, both included.
+
+    :param tables: list of (table, partition key, whether it is a date)
+    :return: list of the names of the partitions created
+    """
+    created = []
+    with connection.cursor() as cursor:
+        for table, column, is_date in tables:
+            existing = set(partition_months(cursor, table))
+            month = first_month
+            while month <= last_month:
+                if month not in existing:
+                    create_partition(
+                        cursor, connection.ops.quote_name, table, column,
+                        is_date, month)
+                    created.append(partition_name(table, month))
+                month = add_months(month, 1)
+    return created
+
+
+def expire_partitions(connection, before_month, detach=False):
+    """
+    Drop, or only detach, the partitions of every table of the months
+    before the given one, the rows of those months the default partition
+    caught are moved to their partition first. The call logs are kept from
+    the month the calls ending from the given month on started, and the call
+    records and bills of the expired months are deleted.
+
+    :return: list of the names of the partitions expired
+    """
+    quote_name = connection.ops.quote_name
+    first_kept = {table: before_month for table, column, is_date in
+                  PARTITIONED_TABLES}
+    first_kept['calls_calllog'] = first_log_month(before_month)
+    expired = []
+    with connection.cursor() as cursor:
+        for table, column, is_date in PARTITIONED_TABLES:
+            for month in default_months(cursor, quote_name, table, column,
+                                        is_date, first_kept[table]):
+                create_partition(
+                    cursor, quote_name, table, column, is_date, month)
+            for month in partition_months(cursor, table):
+                if month >= first_kept[table]:
+                    break
+                partition = partition_name(table, month)
+                if detach:
+                    cursor.execute(
+                        'ALTER TABLE {table} DETACH PARTITION '
+                        '{partition}'.format(
+                            table=quote_name(table),
+                            partition=quote_name(partition)))
+                else:
+                    cursor.execute('DROP TABLE {partition}'.format(
+                        partition=quote_name(partition)))
+                expired.append(partition)
+    expire_bills(before_month)
+    return expired
@@ -0,0 +1,82 @@
+"""
+End records received before the start of their call are parked in the
+PendingCallEnd table and paired as soon as the start is stored.
+"""
+
+import logging
+from django.db import transaction
+from calls.billing import submit_calls
+from calls.models import CallLog, PendingCallEnd
+
+
+logger = logging.getLogger(__name__)
+
+EARLIER_END = "The call end time cannot be earlier or equal than the " \
+              "start time."
+
+
+def park_end(call_id, timestamp):
+    """
+    :return: False when an end record of the call is already parked
+    """
+    pending, created = PendingCallEnd.objects.get_or_create(
+        call_id=call_id, defaults={'timestamp': timestamp})
+    return created
+
+
+def pending_ends(call_ids):
+    return {
+        pending.call_id: pending
+        for pending in PendingCallEnd.objects.filter(call_id__in=call_ids)
+    }
+
+
+def match_pending_ends(starts, pending):
+    """
+    Store and bill the parked end records of calls that just started.
+
+    :param starts: list of (call, start timestamp)
+    :param pending: parked end records by call id
+    :return: number of calls paired
+    """
+    logs = []
+    bills = []
+    rejected = []
+    for call, start_timestamp in starts:
+        end = pending.get(call.id)
+        if end is None or end.error:
+            continue
+        if end.timestamp.replace(tzinfo=None) <= \
+                start_timestamp.replace(tzinfo=None):
+            end.error = EARLIER_END
+            rejected.append(end)
+            continue
+        logs.append(CallLog(type='end', timestamp=end.timestamp, call_id=call))
+        bills.append((call, start_timestamp, end.timestamp))
+    if not logs and not rejected:
+        return 0
+    with transaction.atomic():
+        CallLog.objects.bulk_create(logs)
+        submit_calls(bills)
+        PendingCallEnd.objects.filter(
+            call_id__in=[call.id for call, start, end in bills]).delete()
+        PendingCallEnd.objects.bulk_update(rejected, ['error'])
+    for end in rejected:
+        logger.warning("End record of call %s rejected: %s",
+                       end.call_id, end.error)
+    return len(bills)
+
+
+def pair_parked_ends():
+    """
+    Pair the parked end records whose start was stored without matching
+    them, e.g. when both arrived at the same time.
+
+    :return: number of calls paired
+    """
+    pending = pending_ends(PendingCallEnd.objects.filter(
+        error='').values('call_id'))
+    starts = CallLog.objects.filter(
+        type='start', call_id__in=pending.keys()).select_related('call_id')
+    return match_pending_ends(
+        [(log.call_id, log.timestamp) for log in starts], pending)
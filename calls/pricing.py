@@ -0,0 +1,183 @@
+"""
+Call pricing. A call costs a standing charge plus a price per whole minute
+spent in the normal tariff range (from REDUCED_END to REDUCED_START hours),
+minutes inside the reduced range are not charged.
+
+The price is computed in constant time: the whole days spanned by the call
+are counted arithmetically and only the partial first and last days are
+inspected.
+"""
+
+from datetime import datetime, time, timedelta
+from decimal import Decimal
+import numpy as np
+
+
+REDUCED_START = 22
+REDUCED_END = 6
+MINUTE_PRICE = Decimal('0.09')
+STANDING_PRICE = Decimal('0.36')
+
+ONE_DAY = timedelta(days=1)
+ONE_MINUTE = timedelta(minutes=1)
+ONE_MICROSECOND = timedelta(microseconds=1)
+
+
+def in_reduced_range(timestamp, reduced_start=REDUCED_START,
+                     reduced_end=REDUCED_END):
+    return timestamp.hour >= reduced_start or timestamp.hour < reduced_end
+
+
+def charged_minutes(start_timestamp, end_timestamp,
+                    reduced_start=REDUCED_START, reduced_end=REDUCED_END):
+    """
+    :param start_timestamp: call start date and time
+    :param end_timestamp: call end date and time
+    :param reduced_start: hour the reduced tariff starts
+    :param reduced_end: hour the reduced tariff ends
+    :return: number of minutes charged at the normal tariff
+    """
+    start_timestamp = start_timestamp.replace(tzinfo=None)
+    end_timestamp = end_timestamp.replace(tzinfo=None)
+    normal_start = timedelta(hours=reduced_end)
+    normal_end = timedelta(hours=reduced_start)
+    first_day = datetime.combine(start_timestamp.date(), time())
+    if in_reduced_range(start_timestamp, reduced_start, reduced_end):
+        # a call started at reduced times is only charged from the next
+        # day's normal range, even when it started after midnight
+        first_day += ONE_DAY
+        start_timestamp = first_day + normal_start
+    if end_timestamp <= start_timestamp:
+        return 0
+    # the last day whose normal range the call reaches, a call ending
+    # exactly at the start of a normal range belongs to the day before
+    last_day = datetime.combine(
+        (end_timestamp - normal_start - ONE_MICROSECOND).date(), time())
+    if end_timestamp == last_day + ONE_DAY + normal_start:
+        # the whole span since the last day's normal start is charged
+        last_end = end_timestamp
+    else:
+        last_end = min(end_timestamp, last_day + normal_end)
+    if last_day == first_day:
+        return (last_end - start_timestamp) // ONE_MINUTE
+    first_minutes = (first_day + normal_end - start_timestamp) // ONE_MINUTE
+    full_days = (last_day - first_day).days - 1
+    last_minutes = (last_end - last_day - normal_start) // ONE_MINUTE
+    return first_minutes \
+        + full_days * ((normal_end - normal_start) // ONE_MINUTE) \
+        + last_minutes
+
+
+def compute_price(start_timestamp, end_timestamp,
+                  standing_price=STANDING_PRICE, minute_price=MINUTE_PRICE,
+                  reduced_start=REDUCED_START, reduced_end=REDUCED_END):
+    """
+    :param start_timestamp: call start date and time
+    :param end_timestamp: call end date and time
+    :param standing_price: fixed charge of every call
+    :param minute_price: price of each minute at the normal tariff
+    :param reduced_start: hour the reduced tariff starts
+    :param reduced_end: hour the reduced tariff ends
+    :return: price
+    """
+    minutes = charged_minutes(
+        start_timestamp, end_timestamp, reduced_start, reduced_end)
+    return standing_price + minutes * minute_price
+
+
+def charged_minutes_batch(start_timestamps, end_timestamps,
+                          reduced_start=REDUCED_START,
+                          reduced_end=REDUCED_END):
+    """
+    Vectorized version of charged_minutes.
+
+    :param start_timestamps: array of call start datetime64 values
+    :param end_timestamps: array of call end datetime64 values
+    :param reduced_start: hour the reduced tariff starts
+    :param reduced_end: hour the reduced tariff ends
+    :return: int64 array with the minutes charged at the normal tariff
+    """
+    start_timestamps = np.asarray(start_timestamps, dtype='datetime64[us]')
+    end_timestamps = np.asarray(end_timestamps, dtype='datetime64[us]')
+    day = np.timedelta64(1, 'D')
+    minute = np.timedelta64(1, 'm')
+    normal_start = np.timedelta64(reduced_end, 'h')
+    normal_end = np.timedelta64(reduced_start, 'h')
+
+    first_day = start_timestamps.astype('datetime64[D]')
+    hour = (start_timestamps - first_day) // np.timedelta64(1, 'h')
+    reduced = (hour >= reduced_start) | (hour < reduced_end)
+    first_day = np.where(reduced, first_day + day, first_day)
+    start_timestamps = np.where(
+        reduced, first_day + normal_start, start_timestamps)
+
+    last_day = (end_timestamps - normal_start - np.timedelta64(1, 'us'))
+    last_day = last_day.astype('datetime64[D]')
+    last_end = np.where(
+        end_timestamps == last_day + day + normal_start,
+        end_timestamps,
+        np.minimum(end_timestamps, last_day + normal_end)
+    )
+
+    same_day_minutes = (last_end - start_timestamps) // minute
+    first_minutes = (first_day + normal_end - start_timestamps) // minute
+    full_days = (last_day - first_day) // day - 1
+    last_minutes = (last_end - last_day - normal_start) // minute
+    minutes = np.where(
+        last_day == first_day,
+        same_day_minutes,
+        first_minutes
+        + full_days * ((normal_end - normal_start) // minute)
+        + last_minutes
+    )
+    return np.where(end_timestamps <= start_timestamps, 0, minutes)
+
+
+def compute_prices_in_cents(start_timestamps, end_timestamps,
+                            standing_price=STANDING_PRICE,
+                            minute_price=MINUTE_PRICE,
+                            reduced_start=REDUCED_START,
+                            reduced_end=REDUCED_END):
+    """
+    Vectorized version of compute_price, prices are returned as integer
+    cents so no precision is lost on the way back to the database.
+
+    :param start_timestamps: array of call start datetime64 values
+    :param end_timestamps: array of call end datetime64 values
+    :param standing_price: fixed charge of every call
+    :param minute_price: price of each minute at the normal tariff
+    :param reduced_start: hour the reduced tariff starts
+    :param reduced_end: hour the reduced tariff ends
+    :return: int64 array of prices in cents
+    """
+    return compute_charges_in_cents(
+        start_timestamps, end_timestamps, standing_price, minute_price,
+        reduced_start, reduced_end)[0]
+
+
+def compute_charges_in_cents(start_timestamps, end_timestamps,
+                             standing_price=STANDING_PRICE,
+                             minute_price=MINUTE_PRICE,
+                             reduced_start=REDUCED_START,
+                             reduced_end=REDUCED_END):
+    """
+    Same as compute_prices_in_cents along with the minutes charged at the
+    normal tariff.
+
+    :return: int64 arrays of prices in cents and of minutes
+    """
+    minutes = charged_minutes_batch(
+        start_timestamps, end_timestamps, reduced_start, reduced_end)
+    return to_cents(standing_price) + minutes * to_cents(minute_price), \
+        minutes
+
+
+def to_cents(price):
+    cents = Decimal(price) * 100
+    if cents != cents.to_integral_value():
+        raise ValueError("%s cannot be represented in cents." % price)
+    return int(cents)
+
+
+def from_cents(cents):
+    return Decimal(int(cents)).scaleb(-2)
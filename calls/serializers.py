@@ -1,6 +1,6 @@
 from rest_framework import serializers
 from rest_framework.validators import UniqueTogetherValidator
-from calls.models import Call, CallLog, CallInvoice
+from calls.models import Call, CallLog, CallInvoice, CallRecord
 
 
 class CallSerializer(serializers.ModelSerializer):
@@ -70,10 +70,25 @@ class AbstractCallLogSerializer(serializers.Serializer):
         return data
 
 
+class LoggedCallField(serializers.PrimaryKeyRelatedField):
+    """
+    Call of a record, loaded with the timestamps of its stored records in
+    the same query. The call created along with a start record is taken
+    from the context, it has no records yet.
+    """
+
+    def to_internal_value(self, data):
+        call = self.context.get('call')
+        if call is not None and str(call.pk) == str(data):
+            call.started_at = call.ended_at = None
+            return call
+        return super(LoggedCallField, self).to_internal_value(data)
+
+
 class CallLogSerializer(serializers.ModelSerializer):
 
-    call_id = serializers.PrimaryKeyRelatedField(
-        queryset=Call.objects.all(),
+    call_id = LoggedCallField(
+        queryset=Call.objects.with_log_timestamps(),
         required=True,
         allow_null=True,
         help_text="Unique for each call record pair"
@@ -86,6 +101,9 @@ class CallLogSerializer(serializers.ModelSerializer):
         fields = [
             'id', 'source', 'destination', 'type', 'call_id', 'timestamp'
         ]
+        # the unique ('type', 'call_id') pair is checked in validate with
+        # the log timestamps loaded along with the call
+        validators = []
 
     def get_destination(self, obj):
         return obj.destination
@@ -94,23 +112,38 @@ class CallLogSerializer(serializers.ModelSerializer):
         return obj.source
 
     def validate(self, data):
+        call = data.get('call_id')
+        logs = {}
+        if call is not None:
+            logs = {
+                log_type: CallLog(type=log_type, timestamp=timestamp,
+                                  call_id=call)
+                for log_type, timestamp in (
+                    ('start', call.started_at), ('end', call.ended_at))
+                if timestamp is not None
+            }
+        if data.get('type') in logs:
+            msg = "The fields type, call_id must make a unique set."
+            raise serializers.ValidationError(msg)
         if data.get('type') == 'end':
-            try:
-                log_start = CallLog.objects.get(
-                    call_id=data.get('call_id'),
-                    type='start'
-                )
-            except CallLog.DoesNotExist:
+            log_start = logs.get('start')
+            if log_start is None:
                 msg = "There is no start record for this call, " \
                       "the end of a call cannot be logged before it starts."
-                raise serializers.ValidationError(msg)
+                raise serializers.ValidationError(msg, code='no_start')
             if data.get('timestamp').replace(tzinfo=None) <= \
                     log_start.timestamp.replace(tzinfo=None):
                 msg = "The call end time cannot be earlier or equal than " \
                       "the start time."
                 raise serializers.ValidationError(msg)
+            self.log_start = log_start
         return data
 
+    def create(self, validated_data):
+        instance = CallLog(**validated_data)
+        instance.save(log_start=getattr(self, 'log_start', None))
+        return instance
+
 
 class CallInvoiceSerializer(serializers.ModelSerializer):
     duration = serializers.SerializerMethodField()
@@ -140,3 +173,140 @@ class CallInvoiceSerializer(serializers.ModelSerializer):
 
     def get_destination(self, obj):
         return obj.destination
+
+
+class CallRecordSerializer(serializers.ModelSerializer):
+    duration = serializers.SerializerMethodField()
+    call_start_date = serializers.SerializerMethodField()
+    call_start_time = serializers.SerializerMethodField()
+    price = serializers.SerializerMethodField()
+
+    class Meta:
+        model = CallRecord
+        fields = [
+            'call_id', 'price', 'duration', 'call_start_date',
+            'call_start_time', 'destination'
+        ]
+
+    def get_price(self, obj):
+        return obj.price_display
+
+    def get_duration(self, obj):
+        return obj.duration
+
+    def get_call_start_date(self, obj):
+        return obj.call_start_date
+
+    def get_call_start_time(self, obj):
+        return obj.call_start_time
+
+
+class CallLogRowSerializer(object):
+    """
+    Builds the same output as CallLogSerializer from rows of
+    CallLog.objects.values(*CallLogRowSerializer.fields), without the model
+    introspection and the per field dispatch of a DRF serializer.
+    """
+    fields = (
+        'id', 'call_id__source', 'call_id__destination', 'type', 'call_id',
+        'timestamp'
+    )
+    timestamp_field = serializers.DateTimeField()
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @property
+    def data(self):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in self.rows]
+
+    @classmethod
+    def to_representation(cls, row):
+        return {
+            'id': row['id'],
+            'source': row['call_id__source'],
+            'destination': row['call_id__destination'],
+            'type': row['type'],
+            'call_id': row['call_id'],
+            'timestamp': cls.timestamp_field.to_representation(
+                row['timestamp']),
+        }
+
+    @staticmethod
+    def row(log):
+        call = log.call_id
+        return {
+            'id': log.id,
+            'call_id__source': call.source,
+            'call_id__destination': call.destination,
+            'type': log.type,
+            'call_id': call.id,
+            'timestamp': log.timestamp,
+        }
+
+
+class CallRecordRowSerializer(object):
+    """
+    Builds the same items as CallRecordSerializer from rows of
+    CallRecord.objects.values(*CallRecordRowSerializer.fields), without the
+    per field dispatch of a DRF serializer. ended_at is only read by the
+    invoice pagination.
+    """
+    fields = (
+        'call_id', 'price', 'duration_seconds', 'started_at', 'ended_at',
+        'destination'
+    )
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    @property
+    def data(self):
+        to_representation = self.to_representation
+        return [to_representation(row) for row in self.rows]
+
+    @staticmethod
+    def to_representation(row):
+        # same output as format_duration for a whole number of seconds
+        hours, seconds = divmod(row['duration_seconds'], 3600)
+        minutes, seconds = divmod(seconds, 60)
+        started_at = row['started_at']
+        return {
+            'call_id': row['call_id'],
+            'price': "R$ %s" % row['price'],
+            'duration': "%dh%dm%ds" % (hours, minutes, seconds),
+            'call_start_date': started_at.date(),
+            'call_start_time': started_at.time(),
+            'destination': row['destination'],
+        }
+
+    @staticmethod
+    def row(record):
+        return {
+            'call_id': record.pk,
+            'price': record.price,
+            'duration_seconds': record.duration_seconds,
+            'started_at': record.started_at,
+            'ended_at': record.ended_at,
+            'destination': record.destination,
+        }
+
+
+class InvoiceTotalsSerializer(object):
+    """
+    Totals of a bill from a row with the sums of
+    InvoiceTotalsSerializer.fields, as stored in InvoiceSummary or
+    aggregated over the call records.
+    """
+    fields = ('total', 'call_count', 'normal_minutes', 'reduced_minutes')
+
+    @staticmethod
+    def to_representation(row):
+        return {
+            'total': "R$ %s" % row['total'],
+            'call_count': row['call_count'],
+            'billed_minutes': row['normal_minutes'] + row['reduced_minutes'],
+            'normal_minutes': row['normal_minutes'],
+            'reduced_minutes': row['reduced_minutes'],
+        }
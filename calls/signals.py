@@ -1,9 +1,49 @@
-from django.db.models.signals import post_save
+from django.conf import settings
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
-from calls.models import CallInvoice, CallLog
+from calls.billing import enqueue_calls
+from calls import tariffs
+from calls.models import CallInvoice, CallLog, CallRecord, Holiday, \
+    PlanSubscription, ReducedWindow, TariffPlan, TariffRate
+from calls.pending import match_pending_ends, pending_ends
+from calls.summaries import add_records
 
 
 @receiver(post_save, sender=CallLog)
 def create_call_invoice(sender, instance, **kwargs):
-    if instance.type == 'end':
-        CallInvoice.objects.create(call_id=instance.call_id)
+    if instance.type == 'end' and settings.ASYNC_BILLING:
+        enqueue_calls([instance.call_id])
+    elif instance.type == 'end':
+        invoice = CallInvoice(call_id=instance.call_id)
+        invoice.save(
+            force_insert=True,
+            log_start=getattr(instance, 'log_start', None),
+            log_end=instance
+        )
+
+
+@receiver(post_save, sender=CallLog)
+def match_pending_end(sender, instance, created, **kwargs):
+    if instance.type == 'start' and created:
+        match_pending_ends(
+            [(instance.call_id, instance.timestamp)],
+            pending_ends([instance.call_id_id])
+        )
+
+
+@receiver(post_save, sender=CallInvoice)
+def update_call_record(sender, instance, created, **kwargs):
+    # the record of a call is never stored without its line in the bill,
+    # within the transaction of the caller when there is one
+    with transaction.atomic(savepoint=False):
+        record = CallRecord.from_invoice(instance)
+        record.save(force_insert=created)
+        add_records([record], new=created)
+
+
+for tariff_model in (TariffPlan, PlanSubscription, TariffRate, ReducedWindow,
+                     Holiday):
+    # the compiled tariffs are loaded again on the next call billed
+    post_save.connect(tariffs.invalidate, sender=tariff_model)
+    post_delete.connect(tariffs.invalidate, sender=tariff_model)
@@ -0,0 +1,297 @@
+"""
+Incremental maintenance of the monthly bills stored in InvoiceSummary and
+their InvoiceLine rows. Billing a call inserts its line and adds it to the
+totals of its bill, the other lines of the bill are never read.
+"""
+
+import json
+from collections import defaultdict
+from decimal import Decimal
+from itertools import islice
+from django.db import transaction
+from django.db.models import Count, OuterRef, Subquery, Sum
+from django.utils import timezone
+from rest_framework.utils.encoders import JSONEncoder
+from calls import invoice_cache
+from calls.models import CallRecord, InvoiceLine, InvoiceSummary
+from calls.serializers import CallRecordRowSerializer
+
+
+SUMMARY_FIELDS = [
+    'total', 'call_count', 'total_duration_seconds', 'normal_minutes',
+    'reduced_minutes', 'updated_at'
+]
+LINE_FIELDS = CallRecordRowSerializer.fields + (
+    'source', 'normal_minutes', 'reduced_minutes')
+
+
+def invoice_line(summary, record):
+    row = CallRecordRowSerializer.row(record)
+    row.update(normal_minutes=record.normal_minutes,
+               reduced_minutes=record.reduced_minutes)
+    return row_line(summary.pk, row)
+
+
+def row_line(summary_id, row):
+    """
+    :param row: values of LINE_FIELDS of a call record
+    :return: unsaved line of the call in the bill
+    """
+    item = CallRecordRowSerializer.to_representation(row)
+    return InvoiceLine(
+        call_id_id=row['call_id'],
+        summary_id=summary_id,
+        ended_at=row['ended_at'],
+        price=row['price'],
+        duration_seconds=row['duration_seconds'],
+        normal_minutes=row['normal_minutes'],
+        reduced_minutes=row['reduced_minutes'],
+        item=json.dumps(item, cls=JSONEncoder)
+    )
+
+
+def add_to_summary(summary, lines, sign=1):
+    """
+    Add lines, or call records, to the totals of their bill, or take them
+    out with a sign of -1.
+    """
+    for line in lines:
+        summary.total += sign * line.price
+        summary.call_count += sign
+        summary.total_duration_seconds += sign * line.duration_seconds
+        summary.normal_minutes += sign * line.normal_minutes
+        summary.reduced_minutes += sign * line.reduced_minutes
+    summary.updated_at = timezone.now()
+
+
+def locked_summaries(bills):
+    """
+    :param bills: (source, month) pairs
+    :return: dict of the stored bills by (source, month), locked until the
+    end of the transaction
+    """
+    stored = InvoiceSummary.objects.select_for_update().filter(
+        source__in={source for source, month in bills},
+        billing_month__in={month for source, month in bills}
+    )
+    return {
+        (summary.source, summary.billing_month): summary
+        for summary in stored
+        if (summary.source, summary.billing_month) in bills
+    }
+
+
+def add_records(records, new=False):
+    """
+    Add billed calls to the bills of their subscribers, with a constant
+    number of queries however many bills are touched.
+
+    :param records: CallRecord instances
+    :param new: whether the records were just inserted, a call billed for
+    the first time has no line to replace
+    """
+    groups = defaultdict(list)
+    for record in records:
+        groups[(record.source, record.billing_month)].append(record)
+    if not groups:
+        return
+    with transaction.atomic(savepoint=False):
+        summaries = locked_summaries(groups)
+        missing = [bill for bill in groups if bill not in summaries]
+        if missing:
+            # the first calls of a bill billed at the same time both insert
+            # it, the second insert is ignored and waits for the lock
+            InvoiceSummary.objects.bulk_create([
+                InvoiceSummary(source=source, billing_month=month)
+                for source, month in missing
+            ], ignore_conflicts=True)
+        # calls billed before the bill was stored are in it too
+        empty = missing + [
+            bill for bill, summary in summaries.items()
+            if not summary.call_count
+        ]
+        if empty:
+            inserted, records = empty_bills(empty)
+            for bill, summary in inserted.items():
+                summaries.setdefault(bill, summary)
+            groups.update(records)
+        lost = [bill for bill in missing if bill not in summaries]
+        if lost:
+            summaries.update(locked_summaries(lost))
+        touched = {summary.pk: summary for summary in summaries.values()}
+        # a call billed again leaves the line it had, in whatever bill
+        replaced = [] if new else list(InvoiceLine.objects.filter(
+            call_id__in=[
+                record.pk for group in groups.values() for record in group]))
+        others = {line.summary_id for line in replaced} - set(touched)
+        if others:
+            touched.update(
+                (summary.pk, summary)
+                for summary in InvoiceSummary.objects.select_for_update()
+                .filter(pk__in=others))
+        for line in replaced:
+            add_to_summary(touched[line.summary_id], [line], -1)
+        InvoiceLine.objects.filter(
+            call_id__in=[line.pk for line in replaced]).delete()
+        lines = []
+        for bill, group in groups.items():
+            bill_lines = [
+                invoice_line(summaries[bill], record) for record in group]
+            add_to_summary(summaries[bill], bill_lines)
+            lines.extend(bill_lines)
+        InvoiceLine.objects.bulk_create(lines)
+        InvoiceSummary.objects.bulk_update(touched.values(), SUMMARY_FIELDS)
+        invoice_cache.invalidate(
+            (summary.source, summary.billing_month)
+            for summary in touched.values())
+
+
+def empty_bills(bills):
+    """
+    Read the empty bills along with their call records, which include the
+    records being added, in a single query. A bill just inserted is locked
+    by its insert until the end of the transaction.
+
+    :param bills: list of (source, month) pairs
+    :return: dict of the bills still empty by (source, month), and dict of
+    their call records as billed so far
+    """
+    bills = set(bills)
+    # a bill inserted by a concurrent call first is not empty anymore
+    empty = InvoiceSummary.objects.filter(
+        source=OuterRef('source'),
+        billing_month=OuterRef('billing_month'),
+        call_count=0
+    )
+    summaries = {}
+    records = defaultdict(list)
+    for record in CallRecord.objects.filter(
+            source__in={source for source, month in bills},
+            billing_month__in={month for source, month in bills}
+    ).annotate(
+        summary_pk=Subquery(empty.values('pk'))
+    ).order_by('ended_at', 'call_id'):
+        bill = (record.source, record.billing_month)
+        if bill in bills and record.summary_pk is not None:
+            summaries[bill] = InvoiceSummary(
+                pk=record.summary_pk, source=record.source,
+                billing_month=record.billing_month)
+            records[bill].append(record)
+    return summaries, records
+
+
+def rebuild_month(month, chunk_size=1000, first_source=None,
+                  last_source=None):
+    """
+    Recompute every bill of a month from the call records, with a grouped
+    aggregate for the totals and a single stream of rows for the lines. The
+    bills are inserted and locked first as add_records does, calls billed
+    meanwhile wait for the rebuild and are then added to the rebuilt bills.
+
+    :param month: first day of the month
+    :param first_source: only rebuild the bills of this source on
+    :param last_source: only rebuild the bills of the sources before this one
+    :return: number of bills written
+    """
+    records = sources_in(
+        CallRecord.objects.filter(billing_month=month),
+        first_source, last_source
+    ).order_by()
+    bills = sources_in(
+        InvoiceSummary.objects.filter(billing_month=month),
+        first_source, last_source)
+    with transaction.atomic():
+        InvoiceSummary.objects.bulk_create([
+            InvoiceSummary(source=source, billing_month=month)
+            for source in records.values_list('source', flat=True).distinct()
+        ], batch_size=chunk_size, ignore_conflicts=True)
+        summaries = {
+            summary.source: summary
+            for summary in bills.select_for_update().only('id', 'source')
+        }
+        invoice_cache.invalidate(
+            (source, month) for source in summaries)
+        # only the locked bills, others of the range may have been inserted
+        # since
+        for ids in chunks(
+                (summary.pk for summary in summaries.values()), chunk_size):
+            InvoiceLine.objects.filter(summary__in=ids).delete()
+        rebuilt = []
+        for row in records.values('source').annotate(
+                total=Sum('price'),
+                call_count=Count('pk'),
+                total_duration_seconds=Sum('duration_seconds'),
+                normal_minutes=Sum('normal_minutes'),
+                reduced_minutes=Sum('reduced_minutes')):
+            summary = summaries.pop(row['source'], None)
+            if summary is None:
+                continue
+            # SQLite adds the prices up as floating point numbers
+            summary.total = row['total'].quantize(Decimal('0.01'))
+            for field in ('call_count', 'total_duration_seconds',
+                          'normal_minutes', 'reduced_minutes'):
+                setattr(summary, field, row[field])
+            summary.updated_at = timezone.now()
+            rebuilt.append(summary)
+        # bills whose calls all moved to other months
+        for ids in chunks(
+                (summary.pk for summary in summaries.values()), chunk_size):
+            InvoiceSummary.objects.filter(pk__in=ids).delete()
+        InvoiceSummary.objects.bulk_update(
+            rebuilt, SUMMARY_FIELDS, batch_size=chunk_size)
+        summary_ids = {summary.source: summary.pk for summary in rebuilt}
+        rows = records.values(*LINE_FIELDS).iterator(chunk_size=chunk_size)
+        for chunk in chunks(rows, chunk_size):
+            InvoiceLine.objects.bulk_create([
+                row_line(summary_ids[row['source']], row)
+                for row in chunk if row['source'] in summary_ids
+            ])
+    return len(rebuilt)
+
+
+def chunks(items, chunk_size):
+    items = iter(items)
+    chunk = list(islice(items, chunk_size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(items, chunk_size))
+
+
+def sources_in(queryset, first_source, last_source):
+    if first_source is not None:
+        queryset = queryset.filter(source__gte=first_source)
+    if last_source is not None:
+        queryset = queryset.filter(source__lt=last_source)
+    return queryset
+
+
+def shard_bounds(month, shards):
+    """
+    Split the subscribers billed in a month into ranges of sources with
+    about the same number of subscribers.
+
+    :param month: first day of the month
+    :param shards: maximum number of ranges
+    :return: list of (first_source, last_source) pairs, None leaves the
+    range open
+    """
+    sources = list(CallRecord.objects.filter(
+        billing_month=month
+    ).order_by('source').values_list('source', flat=True).distinct())
+    size = max(1, -(-len(sources) // shards))
+    starts = sources[size::size]
+    return list(zip([None] + starts, starts + [None]))
+
+
+def expire_bills(before_month):
+    """
+    Delete the call records and bills of the months before the given one.
+
+    :return: number of bills deleted
+    """
+    InvoiceLine.objects.filter(
+        summary__billing_month__lt=before_month).delete()
+    deleted, rows = InvoiceSummary.objects.filter(
+        billing_month__lt=before_month).delete()
+    CallRecord.objects.filter(billing_month__lt=before_month).delete()
+    return rows.get(InvoiceSummary._meta.label, 0)
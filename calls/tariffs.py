@@ -0,0 +1,408 @@
+"""
+Tariff plans. The rates, reduced windows, holidays and subscriptions are
+compiled once per process into a TariffIndex, so pricing a call never
+queries the database. A change drops the index of the process right away
+and stores a new TariffVersion in the same transaction, the other processes
+compare it with the version they loaded every TARIFF_RELOAD_INTERVAL
+seconds.
+
+A plan rate charges a standing price plus every whole minute of each
+normal-tariff range of the days the call goes through. The rate applied is
+the one of the longest prefix of the destination in effect when the call
+started.
+"""
+
+import time as clock
+import uuid
+from bisect import bisect_right
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from itertools import chain, groupby
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+from calls.pricing import ONE_DAY, ONE_MICROSECOND, ONE_MINUTE, \
+    compute_charges_in_cents, from_cents, to_cents
+
+
+DAY_TYPES = ('weekday', 'weekend')
+
+
+def naive(timestamp):
+    # rates are matched on the UTC wall time, as the standard tariff
+    if timezone.is_aware(timestamp):
+        return timezone.make_naive(timestamp, timezone.utc)
+    return timestamp
+
+
+def normal_ranges(windows, day_type):
+    """
+    :param windows: list of (start hour, end hour, day type) reduced windows
+    :param day_type: 'weekday' or 'weekend'
+    :return: tuple of (start, end) offsets of the day charged normally
+    """
+    reduced = [False] * 24
+    for start_hour, end_hour, window_day_type in windows:
+        if window_day_type not in ('all', day_type):
+            continue
+        if start_hour < end_hour:
+            hours = range(start_hour, end_hour)
+        else:
+            hours = chain(range(start_hour, 24), range(end_hour))
+        for hour in hours:
+            reduced[hour] = True
+    ranges = []
+    for is_reduced, hours in groupby(range(24), key=reduced.__getitem__):
+        if not is_reduced:
+            hours = list(hours)
+            ranges.append(
+                (timedelta(hours=hours[0]), timedelta(hours=hours[-1] + 1)))
+    return tuple(ranges)
+
+
+class Rate(object):
+    __slots__ = ('standing_cents', 'minute_cents', 'normal_ranges',
+                 'day_minutes')
+
+    def __init__(self, standing_price, minute_price, windows=()):
+        self.standing_cents = to_cents(standing_price)
+        self.minute_cents = to_cents(minute_price)
+        self.normal_ranges = {
+            day_type: normal_ranges(windows, day_type)
+            for day_type in DAY_TYPES
+        }
+        # minutes charged for a whole day of each type
+        self.day_minutes = {
+            day_type: sum(
+                (range_end - range_start) // ONE_MINUTE
+                for range_start, range_end in ranges)
+            for day_type, ranges in self.normal_ranges.items()
+        }
+
+    @staticmethod
+    def day_type(day, holidays):
+        if day.weekday() >= 5 or day.date() in holidays:
+            return 'weekend'
+        return 'weekday'
+
+    def charged_minutes(self, start_timestamp, end_timestamp,
+                        holidays=frozenset()):
+        """
+        The whole days between the first and the last day of the call are
+        counted arithmetically, only the partial first and last days are
+        inspected.
+
+        :return: number of minutes charged at the normal tariff
+        """
+        first_day = datetime.combine(start_timestamp.date(), time())
+        last_day = datetime.combine(
+            (end_timestamp - ONE_MICROSECOND).date(), time())
+        minutes = self.partial_day_minutes(
+            first_day, start_timestamp, end_timestamp, holidays)
+        if last_day <= first_day:
+            return minutes
+        minutes += self.partial_day_minutes(
+            last_day, start_timestamp, end_timestamp, holidays)
+        full_days = (last_day - first_day).days - 1
+        if full_days <= 0:
+            return minutes
+        first_full_day = first_day + ONE_DAY
+        weeks, days = divmod(full_days, 7)
+        weekend_days = weeks * 2 + sum(
+            1 for day in range(days)
+            if (first_full_day.weekday() + day) % 7 >= 5)
+        # holidays on weekdays are charged as weekend days
+        weekend_days += sum(
+            1 for holiday in holidays
+            if first_day.date() < holiday < last_day.date() and
+            holiday.weekday() < 5)
+        return minutes \
+            + (full_days - weekend_days) * self.day_minutes['weekday'] \
+            + weekend_days * self.day_minutes['weekend']
+
+    def partial_day_minutes(self, day, start_timestamp, end_timestamp,
+                            holidays):
+        minutes = 0
+        for range_start, range_end in \
+                self.normal_ranges[self.day_type(day, holidays)]:
+            charged = min(end_timestamp, day + range_end) - \
+                max(start_timestamp, day + range_start)
+            if charged > timedelta(0):
+                minutes += charged // ONE_MINUTE
+        return minutes
+
+
+class PrefixIndex(object):
+    """
+    Longest-prefix match over a sorted array of prefixes. The greatest
+    prefix not after a key either is a prefix of it or descends from its
+    longest matching prefix, so a lookup is a binary search followed by a
+    walk up the chain of parents, at most as long as the key.
+    """
+
+    def __init__(self, entries):
+        """
+        :param entries: iterable of (prefix, value)
+        """
+        entries = sorted(dict(entries).items())
+        self.prefixes = [prefix for prefix, value in entries]
+        self.values = [value for prefix, value in entries]
+        # position of the longest other prefix of each prefix, or -1
+        self.parents = []
+        ancestors = []
+        for position, prefix in enumerate(self.prefixes):
+            while ancestors and \
+                    not prefix.startswith(self.prefixes[ancestors[-1]]):
+                ancestors.pop()
+            self.parents.append(ancestors[-1] if ancestors else -1)
+            ancestors.append(position)
+        width = max([len(prefix) for prefix in self.prefixes] + [1])
+        self.prefix_array = np.array(self.prefixes, dtype='U%d' % width)
+        self.parent_array = np.array(self.parents, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.prefixes)
+
+    def find(self, key):
+        """
+        :return: position of the longest prefix of the key, -1 when none
+        """
+        prefixes = self.prefixes
+        position = bisect_right(prefixes, key) - 1
+        while position >= 0 and not key.startswith(prefixes[position]):
+            position = self.parents[position]
+        return position
+
+    def lookup(self, key):
+        """
+        :return: positions of the prefixes of the key, longest first
+        """
+        return self.ancestors(self.find(key))
+
+    def ancestors(self, position):
+        """
+        :return: the position and the positions of its prefixes, longest
+        first
+        """
+        while position >= 0:
+            yield position
+            position = self.parents[position]
+
+    def get(self, key, default=None):
+        position = self.find(key)
+        return self.values[position] if position >= 0 else default
+
+    def lookup_many(self, keys):
+        """
+        :param keys: sequence of strings
+        :return: int64 array with the position of the longest prefix of
+        each key, -1 for the keys without one
+        """
+        keys = np.asarray(keys, dtype=str)
+        if not len(self.prefixes) or not len(keys):
+            return np.full(len(keys), -1, dtype=np.int64)
+        positions = np.searchsorted(
+            self.prefix_array, keys, side='right') - 1
+        pending = np.flatnonzero(positions >= 0)
+        while len(pending):
+            matched = np.char.startswith(
+                keys[pending], self.prefix_array[positions[pending]])
+            pending = pending[~matched]
+            positions[pending] = self.parent_array[positions[pending]]
+            pending = pending[positions[pending] >= 0]
+        return positions
+
+
+class TariffIndex(object):
+
+    def __init__(self, subscriptions=(), rates=(), holidays=()):
+        """
+        :param subscriptions: iterable of (source, valid from, plan id)
+        :param rates: iterable of (plan id, destination prefix,
+        effective from, Rate)
+        :param holidays: iterable of dates
+        """
+        self.subscriptions = {}
+        for source, valid_from, plan_id in sorted(
+                (source, naive(valid_from), plan_id)
+                for source, valid_from, plan_id in subscriptions):
+            starts, plans = self.subscriptions.setdefault(source, ([], []))
+            starts.append(valid_from)
+            plans.append(plan_id)
+        tables = defaultdict(dict)
+        for plan_id, prefix, effective_from, rate in sorted(
+                ((plan_id, prefix, naive(effective_from), rate)
+                 for plan_id, prefix, effective_from, rate in rates),
+                key=lambda entry: entry[:3]):
+            starts, prefix_rates = tables[plan_id].setdefault(
+                prefix, ([], []))
+            starts.append(effective_from)
+            prefix_rates.append(rate)
+        self.rates = {
+            plan_id: PrefixIndex(table.items())
+            for plan_id, table in tables.items()
+        }
+        self.holidays = frozenset(holidays)
+
+    @classmethod
+    def load(cls):
+        from calls.models import Holiday, PlanSubscription, ReducedWindow, \
+            TariffRate
+        windows = defaultdict(list)
+        for rate_id, start_hour, end_hour, day_type in \
+                ReducedWindow.objects.values_list(
+                    'rate_id', 'start_hour', 'end_hour', 'day_type'):
+            windows[rate_id].append((start_hour, end_hour, day_type))
+        rates = [
+            (plan_id, prefix, effective_from,
+             Rate(standing_price, minute_price, windows[rate_id]))
+            for rate_id, plan_id, prefix, effective_from, standing_price,
+            minute_price in TariffRate.objects.values_list(
+                'id', 'plan_id', 'destination_prefix', 'effective_from',
+                'standing_price', 'minute_price')
+        ]
+        return cls(
+            PlanSubscription.objects.values_list(
+                'source', 'valid_from', 'plan_id'),
+            rates,
+            Holiday.objects.values_list('date', flat=True)
+        )
+
+    def plan(self, source, timestamp):
+        subscription = self.subscriptions.get(source)
+        if subscription is None:
+            return None
+        starts, plans = subscription
+        position = bisect_right(starts, naive(timestamp)) - 1
+        return plans[position] if position >= 0 else None
+
+    def rate(self, source, destination, timestamp):
+        """
+        :return: Rate of the call, None when the subscriber has no plan or
+        the plan no rate for the destination
+        """
+        plan_id = self.plan(source, timestamp)
+        if plan_id is None:
+            return None
+        table = self.rates.get(plan_id)
+        if table is None:
+            return None
+        return self.effective_rate(
+            table, table.lookup(destination), naive(timestamp))
+
+    @staticmethod
+    def effective_rate(table, positions, timestamp):
+        # a prefix whose rates are not in effect yet falls back to the
+        # shorter prefixes
+        for position in positions:
+            starts, rates = table.values[position]
+            index = bisect_right(starts, timestamp) - 1
+            if index >= 0:
+                return rates[index]
+        return None
+
+    def rates_many(self, sources, destinations, timestamps):
+        """
+        Rates of a batch of calls, the destinations of the calls of each
+        plan are matched at once.
+
+        :return: list with the Rate of each call, None for the calls billed
+        with the standard tariff
+        """
+        rates = [None] * len(sources)
+        plan_calls = defaultdict(list)
+        for position, (source, timestamp) in enumerate(
+                zip(sources, timestamps)):
+            plan_id = self.plan(source, timestamp)
+            if plan_id in self.rates:
+                plan_calls[plan_id].append(position)
+        for plan_id, positions in plan_calls.items():
+            table = self.rates[plan_id]
+            matches = table.lookup_many(
+                [destinations[position] for position in positions])
+            for position, match in zip(positions, matches.tolist()):
+                if match < 0:
+                    continue
+                rates[position] = self.effective_rate(
+                    table, table.ancestors(match),
+                    naive(timestamps[position]))
+        return rates
+
+    def charge(self, source, destination, start_timestamp, end_timestamp):
+        """
+        :return: price of the call and minutes charged at the normal
+        tariff, None when it is billed with the standard tariff
+        """
+        rate = self.rate(source, destination, start_timestamp)
+        if rate is None:
+            return None
+        minutes = rate.charged_minutes(
+            naive(start_timestamp), naive(end_timestamp), self.holidays)
+        return from_cents(
+            rate.standing_cents + minutes * rate.minute_cents), minutes
+
+    def charges_in_cents(self, sources, destinations, start_timestamps,
+                         end_timestamps):
+        """
+        Prices of a batch of calls along with their minutes charged at the
+        normal tariff, the calls billed with the standard tariff are charged
+        at once by compute_charges_in_cents.
+
+        :return: int64 arrays of prices in cents and of minutes
+        """
+        start_timestamps = [naive(timestamp) for timestamp in start_timestamps]
+        end_timestamps = [naive(timestamp) for timestamp in end_timestamps]
+        prices, minutes = compute_charges_in_cents(
+            np.array(start_timestamps, dtype='datetime64[us]'),
+            np.array(end_timestamps, dtype='datetime64[us]')
+        )
+        if not self.subscriptions:
+            return prices, minutes
+        rates = self.rates_many(sources, destinations, start_timestamps)
+        for position, rate in enumerate(rates):
+            if rate is not None:
+                minutes[position] = rate.charged_minutes(
+                    start_timestamps[position], end_timestamps[position],
+                    self.holidays)
+                prices[position] = rate.standing_cents + \
+                    minutes[position] * rate.minute_cents
+        return prices, minutes
+
+
+_index = None
+_version = None
+_checked_at = None
+
+
+def stored_version():
+    from calls.models import TariffVersion
+    return TariffVersion.objects.values_list('version', flat=True).first()
+
+
+def get_index():
+    global _index, _version, _checked_at
+    now = clock.monotonic()
+    if _index is not None and \
+            now - _checked_at < settings.TARIFF_RELOAD_INTERVAL:
+        return _index
+    version = stored_version()
+    if _index is None or version != _version:
+        # the version is read first so a change made while loading is
+        # picked up by the next check
+        _index = TariffIndex.load()
+        _version = version
+    _checked_at = now
+    return _index
+
+
+def publish_version():
+    from calls.models import TariffVersion
+    version = uuid.uuid4()
+    if not TariffVersion.objects.update(version=version):
+        TariffVersion.objects.create(version=version)
+
+
+def invalidate(**kwargs):
+    global _index
+    _index = None
+    publish_version()
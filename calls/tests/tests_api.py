@@ -1,5 +1,21 @@
+import json
+import re
+from contextlib import contextmanager
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock, skipIf
+from django.core.cache import cache
+from django.db import IntegrityError, connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 from rest_framework.test import APITestCase, APIClient
-from calls.models import CallLog, CallInvoice
+from calls import tariffs
+from calls.models import CallLog, CallInvoice, CallRecord, InvoiceSummary, \
+    PendingCallEnd
+from calls.serializers import CallLogSerializer
+
+
+TRANSACTION_STATEMENT = re.compile(r'(BEGIN|SAVEPOINT|RELEASE SAVEPOINT)\b')
 
 
 class CallLogTestCase(APITestCase):
@@ -32,6 +48,7 @@ class CallLogTestCase(APITestCase):
 
 class CallInvoiceTestCase(APITestCase):
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
         self.source = '41998986565'
         data_start = {
@@ -59,6 +76,54 @@ class CallInvoiceTestCase(APITestCase):
         )
         self.assertEqual(len(response.data), 1)
 
+    def test_conditional_requests(self):
+        uri = '/call-invoice/{source}?date=032018'.format(source=self.source)
+        response = self.client.get(uri)
+        etag = response['ETag']
+        last_modified = response['Last-Modified']
+        # the cached bill is only checked against the version of the bill
+        with self.assertNumQueries(1):
+            response = self.client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        response = self.client.get(
+            uri, HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(uri, HTTP_IF_NONE_MATCH='"other"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_totals_representation_has_its_own_etag(self):
+        uri = '/call-invoice/{source}?date=032018'.format(source=self.source)
+        etag = self.client.get(uri)['ETag']
+        response = self.client.get(
+            uri + '&totals=true', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('totals', response.data)
+        self.assertNotEqual(response['ETag'], etag)
+        response = self.client.get(
+            uri + '&totals=true', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_late_call_invalidates_cached_invoice(self):
+        uri = '/call-invoice/{source}?date=032018'.format(source=self.source)
+        etag = self.client.get(uri)['ETag']
+        self.client.post('/call-log', {
+            'type': 'start',
+            'source': self.source,
+            'call_id': 2,
+            'destination': '11998986565',
+            'timestamp': '2018-03-10T10:00:00Z'
+        }, format='json')
+        self.client.post('/call-log', {
+            'type': 'end',
+            'call_id': 2,
+            'timestamp': '2018-03-10T10:05:00Z',
+        }, format='json')
+        response = self.client.get(uri, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data), 2)
+        self.assertNotEqual(response['ETag'], etag)
+
     def test_call_invoice_not_found(self):
         response = self.client.get(
             '/call-invoice/{source}'.format(
@@ -132,3 +197,385 @@ class BadRequestsTestCase(APITestCase):
         }
         call_end = self.client.post('/call-log', data_end, format='json')
         self.assertEqual(call_end.status_code, 400)
+
+
+class CallLogBatchTestCase(APITestCase):
+    def setUp(self):
+        # the tariffs are loaded once per process, not per request
+        tariffs.get_index()
+        self.uri_batch = '/call-log/batch'
+        self.client = APIClient()
+
+    def records(self, calls):
+        records = []
+        for call_id in range(1, calls + 1):
+            records.append({
+                'type': 'start',
+                'call_id': call_id,
+                'source': '41987654321',
+                'destination': '1196385274',
+                'timestamp': '2016-02-29T12:00:00Z'
+            })
+            records.append({
+                'type': 'end',
+                'call_id': call_id,
+                'timestamp': '2016-02-29T14:00:00Z'
+            })
+        return records
+
+    def test_post_batch(self):
+        response = self.client.post(
+            self.uri_batch, self.records(3), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), 6)
+        self.assertEqual(CallLog.objects.count(), 6)
+        self.assertEqual(CallInvoice.objects.count(), 3)
+        self.assertEqual(
+            str(CallInvoice.objects.get(call_id=1).price), '11.16')
+        self.assertEqual(CallRecord.objects.count(), 3)
+
+    def test_post_batch_ndjson(self):
+        body = '\n'.join(json.dumps(record) for record in self.records(2))
+        response = self.client.post(
+            self.uri_batch, body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(CallLog.objects.count(), 4)
+        self.assertEqual(CallInvoice.objects.count(), 2)
+
+    def test_post_batch_per_record_errors(self):
+        records = self.records(2)
+        records[1]['timestamp'] = '2016-02-29T11:00:00Z'
+        records[2]['source'] = 'abc'
+        records.append({
+            'type': 'end',
+            'call_id': 9,
+            'timestamp': '2016-02-29T14:00:00Z'
+        })
+        response = self.client.post(self.uri_batch, records, format='json')
+        self.assertEqual(response.status_code, 207)
+        statuses = [result['status'] for result in response.data]
+        self.assertEqual(
+            statuses, ['created', 'error', 'error', 'pending', 'pending'])
+        self.assertIn('source', response.data[2]['errors'])
+        self.assertEqual(CallLog.objects.count(), 1)
+        self.assertEqual(CallInvoice.objects.count(), 0)
+
+    def test_post_batch_end_of_stored_call(self):
+        self.client.post(self.uri_batch, self.records(1)[:1], format='json')
+        response = self.client.post(
+            self.uri_batch, self.records(1), format='json')
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual(response.data[0]['status'], 'error')
+        self.assertEqual(response.data[1]['status'], 'created')
+        self.assertEqual(CallInvoice.objects.count(), 1)
+
+    def test_post_batch_query_count(self):
+        # set-based validation: the number of queries does not depend on
+        # the number of records
+        with self.assertNumQueries(14):
+            self.client.post(self.uri_batch, self.records(1), format='json')
+        # the bill is stored by then, it is updated instead of built
+        with self.assertNumQueries(12):
+            self.client.post(
+                self.uri_batch, self.records(50)[2:], format='json')
+
+    def test_post_batch_must_be_a_list(self):
+        response = self.client.post(
+            self.uri_batch, self.records(1)[0], format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class CallInvoiceQueryCountTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.source = '41998986565'
+        self.uri_invoice = '/call-invoice/{source}?date=032018'.format(
+            source=self.source)
+
+    def create_calls(self, first_id, count):
+        records = []
+        for call_id in range(first_id, first_id + count):
+            records.append({
+                'type': 'start',
+                'call_id': call_id,
+                'source': self.source,
+                'destination': '11998986565',
+                'timestamp': '2018-03-01T21:57:13Z'
+            })
+            records.append({
+                'type': 'end',
+                'call_id': call_id,
+                'timestamp': '2018-03-01T22:10:56Z'
+            })
+        self.client.post('/call-log/batch', records, format='json')
+
+    def test_query_count_does_not_grow_with_calls(self):
+        # the bill, then its lines
+        self.create_calls(1, 1)
+        with self.assertNumQueries(2):
+            response = self.client.get(self.uri_invoice)
+        self.assertEqual(len(response.data), 1)
+        self.create_calls(2, 30)
+        with self.assertNumQueries(2):
+            response = self.client.get(self.uri_invoice)
+        self.assertEqual(len(response.data), 31)
+        self.assertEqual(response.json()[0], {
+            'call_id': 1,
+            'price': 'R$ 0.54',
+            'duration': '0h13m43s',
+            'call_start_date': '2018-03-01',
+            'call_start_time': '21:57:13',
+            'destination': '11998986565'
+        })
+
+    def test_totals(self):
+        self.create_calls(1, 3)
+        totals = {
+            'total': 'R$ 1.62',
+            'call_count': 3,
+            'billed_minutes': 39,
+            'normal_minutes': 6,
+            'reduced_minutes': 33
+        }
+        with self.assertNumQueries(2):
+            response = self.client.get(self.uri_invoice + '&totals=true')
+        self.assertEqual(response.data['totals'], totals)
+        self.assertEqual(len(response.data['items']), 3)
+        # the cached bill is served with or without its totals
+        with self.assertNumQueries(1):
+            response = self.client.get(self.uri_invoice + '&totals=1')
+        self.assertEqual(response.data['totals'], totals)
+        self.assertEqual(len(self.client.get(self.uri_invoice).data), 3)
+
+        # a bill changed by another process is not served from this cache
+        InvoiceSummary.objects.update(
+            total=Decimal('1.00'), updated_at=timezone.now())
+        response = self.client.get(self.uri_invoice + '&totals=true')
+        self.assertEqual(response.data['totals']['total'], 'R$ 1.00')
+
+        # bills without a summary are added up by the database
+        InvoiceSummary.objects.all().delete()
+        cache.clear()
+        with self.assertNumQueries(3):
+            response = self.client.get(self.uri_invoice + '&totals=true')
+        self.assertEqual(response.data['totals'], totals)
+
+
+class CallInvoicePaginationTestCase(APITestCase):
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.source = '41998986565'
+        self.uri_invoice = '/call-invoice/{source}?date=032018'.format(
+            source=self.source)
+        records = []
+        for call_id in range(1, 8):
+            records.append({
+                'type': 'start',
+                'call_id': call_id,
+                'source': self.source,
+                'destination': '11998986565',
+                'timestamp': '2018-03-01T10:00:00Z'
+            })
+            records.append({
+                'type': 'end',
+                'call_id': call_id,
+                # calls 1 to 4 end at the same time to exercise the ties
+                'timestamp': '2018-03-{:02d}T10:05:00Z'.format(
+                    max(call_id, 4))
+            })
+        self.client.post('/call-log/batch', records, format='json')
+
+    def test_cursor_pagination(self):
+        response = self.client.get(self.uri_invoice + '&page_size=3')
+        calls = [item['call_id'] for item in response.data['results']]
+        pages = 1
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            calls += [item['call_id'] for item in response.data['results']]
+            pages += 1
+        self.assertEqual(calls, [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(pages, 3)
+        self.assertEqual(response.data['totals']['call_count'], 7)
+        self.assertEqual(response.data['totals']['total'], 'R$ 2338.47')
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.uri_invoice + '&cursor=abc')
+        self.assertEqual(response.status_code, 404)
+
+    def test_stream_ndjson(self):
+        response = self.client.get(self.uri_invoice + '&stream=ndjson')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        items = [json.loads(line) for line in lines]
+        self.assertEqual(
+            items, self.client.get(self.uri_invoice).json())
+
+    def test_stream_json(self):
+        response = self.client.get(self.uri_invoice + '&stream=json')
+        content = b''.join(response.streaming_content).decode()
+        self.assertEqual(
+            json.loads(content), self.client.get(self.uri_invoice).json())
+
+    def test_stream_invalid_format(self):
+        response = self.client.get(self.uri_invoice + '&stream=xml')
+        self.assertEqual(response.status_code, 400)
+
+
+class CallLogQueryBudgetTestCase(APITestCase):
+    def setUp(self):
+        tariffs.get_index()
+        self.client = APIClient()
+        self.data_start = {
+            'type': 'start',
+            'source': '41998986565',
+            'call_id': 1,
+            'destination': '11998986565',
+            'timestamp': '2018-02-28T21:57:13Z'
+        }
+        self.data_end = {
+            'type': 'end',
+            'call_id': 1,
+            'timestamp': '2018-03-01T22:10:56Z',
+        }
+
+    @contextmanager
+    def assertNumStatements(self, num):
+        # the statements of the request, without the savepoints or BEGIN
+        # that depend on the backend and on the transaction of the test
+        with CaptureQueriesContext(connection) as context:
+            yield
+        statements = [
+            query['sql'] for query in context.captured_queries
+            if not TRANSACTION_STATEMENT.match(query['sql'])
+        ]
+        self.assertEqual(len(statements), num, '\n'.join(statements))
+
+    def test_query_budget_per_event(self):
+        # start: call unique check, call insert, log insert and the lookup
+        # of an end record received before it
+        with self.assertNumStatements(4):
+            response = self.client.post(
+                '/call-log', self.data_start, format='json')
+        self.assertEqual(response.status_code, 201)
+        # end of the first call of a bill: call and logs lookup, the inserts
+        # of the log, invoice and call record, the locked lookup of the bill,
+        # its insert, the call records of the new bill, the line insert and
+        # the totals update
+        with self.assertNumStatements(9):
+            response = self.client.post(
+                '/call-log', self.data_end, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(CallInvoice.objects.get().price, Decimal('86.94'))
+        self.client.post('/call-log', dict(
+            self.data_start, call_id=2), format='json')
+        # end of the next calls: the bill is locked and updated
+        with self.assertNumStatements(7):
+            response = self.client.post('/call-log', dict(
+                self.data_end, call_id=2), format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            InvoiceSummary.objects.get().total, Decimal('173.88'))
+
+    def test_duplicated_end(self):
+        self.client.post('/call-log', self.data_start, format='json')
+        self.client.post('/call-log', self.data_end, format='json')
+        response = self.client.post('/call-log', self.data_end, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data['non_field_errors'],
+            ['The fields type, call_id must make a unique set.']
+        )
+
+    def test_duplicated_start(self):
+        self.client.post('/call-log', self.data_start, format='json')
+        response = self.client.post('/call-log', dict(
+            self.data_start, timestamp='2018-02-28T21:58:13Z'), format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(CallLog.objects.filter(type='start').count(), 1)
+
+    @skipIf(connection.vendor == 'postgresql',
+            "The keys of the partitioned table include the timestamp")
+    def test_duplicated_start_rejected_by_the_database(self):
+        self.client.post('/call-log', self.data_start, format='json')
+        log = CallLog.objects.get()
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            CallLog.objects.create(
+                type='start', call_id=log.call_id,
+                timestamp=log.timestamp + timedelta(minutes=1))
+
+    def test_concurrent_duplicated_end(self):
+        self.client.post('/call-log', self.data_start, format='json')
+        self.client.post('/call-log', self.data_end, format='json')
+        # validated before the first end of the call was stored
+        with mock.patch.object(CallLogSerializer, 'validate',
+                               lambda serializer, data: data):
+            response = self.client.post('/call-log', dict(
+                self.data_end, timestamp='2018-03-02T22:10:56Z'),
+                format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            response.data['non_field_errors'],
+            ['The fields type, call_id must make a unique set.']
+        )
+        self.assertEqual(CallLog.objects.filter(type='end').count(), 1)
+        self.assertEqual(CallInvoice.objects.count(), 1)
+
+
+class CallLogOutOfOrderTestCase(APITestCase):
+    def setUp(self):
+        self.uri_call_log = '/call-log'
+        self.client = APIClient()
+        self.data_start = {
+            'type': 'start',
+            'source': '41998986565',
+            'call_id': 1,
+            'destination': '11998986565',
+            'timestamp': '2018-02-28T21:57:13Z'
+        }
+        self.data_end = {
+            'type': 'end',
+            'call_id': 1,
+            'timestamp': '2018-03-01T22:10:56Z',
+        }
+
+    def test_end_before_start(self):
+        response = self.client.post(
+            self.uri_call_log, self.data_end, format='json')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(PendingCallEnd.objects.get().call_id, 1)
+        self.assertFalse(CallLog.objects.exists())
+        response = self.client.post(
+            self.uri_call_log, self.data_start, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertFalse(PendingCallEnd.objects.exists())
+        self.assertEqual(CallLog.objects.count(), 2)
+        self.assertEqual(CallInvoice.objects.get().price, Decimal('86.94'))
+        self.assertEqual(CallRecord.objects.count(), 1)
+
+    def test_duplicated_pending_end(self):
+        self.client.post(self.uri_call_log, self.data_end, format='json')
+        response = self.client.post(
+            self.uri_call_log, self.data_end, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(PendingCallEnd.objects.count(), 1)
+
+    def test_pending_end_earlier_than_start(self):
+        self.data_end['timestamp'] = '2018-02-28T20:00:00Z'
+        self.client.post(self.uri_call_log, self.data_end, format='json')
+        self.client.post(self.uri_call_log, self.data_start, format='json')
+        self.assertFalse(CallInvoice.objects.exists())
+        self.assertIn('earlier', PendingCallEnd.objects.get().error)
+
+    def test_batch_end_before_start(self):
+        response = self.client.post(
+            '/call-log/batch', [self.data_end], format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(response.data[0]['status'], 'pending')
+        response = self.client.post(
+            '/call-log/batch', [self.data_start], format='json')
+        self.assertEqual(response.data[0]['status'], 'created')
+        self.assertFalse(PendingCallEnd.objects.exists())
+        self.assertEqual(CallInvoice.objects.get().price, Decimal('86.94'))
@@ -0,0 +1,170 @@
+import asyncio
+import json
+from unittest import mock
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from django.db import IntegrityError
+from django.test import TestCase, TransactionTestCase, override_settings
+from billcalls.asgi import Router
+from calls import async_ingestion
+from calls.async_ingestion import CallLogApplication
+from calls.models import Call, CallInvoice, CallLog, InvoiceSummary
+
+
+START = {
+    'type': 'start',
+    'source': '41987654321',
+    'destination': '1196385274',
+    'call_id': 1,
+    'timestamp': '2016-02-29T12:00:00Z'
+}
+END = {'type': 'end', 'call_id': 1, 'timestamp': '2016-02-29T14:00:00Z'}
+
+
+def scope(method='POST', path='/call-log/ingest', host=b'testserver'):
+    return {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'headers': [(b'host', host), (b'content-type', b'application/json')],
+    }
+
+
+async def post(application, body, **kwargs):
+    communicator = ApplicationCommunicator(application, scope(**kwargs))
+    await communicator.send_input({'type': 'http.request', 'body': body})
+    start = await communicator.receive_output(1)
+    content = await communicator.receive_output(1)
+    return start['status'], json.loads(content['body'])
+
+
+def post_records(*records, application=None):
+    application = application or CallLogApplication()
+
+    async def post_all():
+        return await asyncio.gather(*[
+            post(application, json.dumps(record).encode())
+            for record in records
+        ])
+    return async_to_sync(post_all)()
+
+
+class CallLogApplicationTestCase(TransactionTestCase):
+    # records are ingested in the thread of the batcher, outside of the
+    # transaction of the test
+
+    def test_post_start(self):
+        [(status, data)] = post_records(START)
+        self.assertEqual(status, 201)
+        self.assertEqual(
+            data, {'status': 'created', 'call_id': 1, 'type': 'start'})
+        self.assertTrue(Call.objects.filter(id=1).exists())
+
+    def test_concurrent_records_are_ingested_together(self):
+        with mock.patch.object(
+                async_ingestion, 'ingest_call_logs',
+                wraps=async_ingestion.ingest_call_logs) as ingest:
+            results = post_records(START, END)
+        self.assertEqual(ingest.call_count, 1)
+        self.assertEqual([status for status, data in results], [201, 201])
+        self.assertEqual(CallLog.objects.count(), 2)
+        self.assertEqual(CallInvoice.objects.count(), 1)
+
+    def test_end_before_start_is_pending(self):
+        [(status, data)] = post_records(END)
+        self.assertEqual(status, 202)
+        self.assertEqual(data['status'], 'pending')
+
+    def test_invalid_record(self):
+        [(status, data)] = post_records(dict(START, source='123'))
+        self.assertEqual(status, 400)
+        self.assertIn('source', data)
+        self.assertFalse(Call.objects.exists())
+
+    def test_invalid_body(self):
+        status, data = async_to_sync(post)(CallLogApplication(), b'{')
+        self.assertEqual(status, 400)
+        self.assertIn('JSON parse error', data['detail'])
+        status, data = async_to_sync(post)(CallLogApplication(), b'[]')
+        self.assertEqual(status, 400)
+
+    def test_same_responses_as_the_wsgi_application(self):
+        records = [START, END, END, dict(START, call_id=2, source='123')]
+        responses = []
+        for record in records:
+            responses.extend(post_records(record))
+        Call.objects.all().delete()
+        InvoiceSummary.objects.all().delete()
+        for record, response in zip(records, responses):
+            wsgi_response = self.client.post(
+                '/call-log/ingest', record, content_type='application/json')
+            self.assertEqual(
+                (wsgi_response.status_code, wsgi_response.json()), response)
+
+    @override_settings(ALLOWED_HOSTS=['billcalls.herokuapp.com'])
+    def test_host_must_be_allowed(self):
+        status, data = async_to_sync(post)(
+            CallLogApplication(), json.dumps(START).encode(),
+            host=b'evil.example.com')
+        self.assertEqual(status, 400)
+        self.assertFalse(Call.objects.exists())
+
+    def test_failed_batch_is_ingested_record_by_record(self):
+        ingest_call_logs = async_ingestion.ingest_call_logs
+        batches = []
+
+        def fail_first_batch(records):
+            batches.append(len(records))
+            if len(batches) == 1:
+                raise IntegrityError
+            return ingest_call_logs(records)
+
+        with mock.patch.object(
+                async_ingestion, 'ingest_call_logs',
+                side_effect=fail_first_batch):
+            with self.assertLogs('calls.async_ingestion', 'ERROR'):
+                results = post_records(START, dict(START, call_id=2))
+        self.assertEqual(batches, [2, 1, 1])
+        self.assertEqual([status for status, data in results], [201, 201])
+        self.assertEqual(Call.objects.count(), 2)
+
+
+class RouterTestCase(TestCase):
+
+    def test_other_requests_go_to_the_default_application(self):
+        seen = []
+
+        async def default(scope, receive, send):
+            seen.append(scope['path'])
+            await send({'type': 'http.response.start', 'status': 204,
+                        'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def get():
+            communicator = ApplicationCommunicator(
+                Router(CallLogApplication(), default),
+                scope(method='GET', path='/call-invoice/41987654321'))
+            await communicator.send_input(
+                {'type': 'http.request', 'body': b''})
+            return await communicator.receive_output(1)
+        self.assertEqual(async_to_sync(get)()['status'], 204)
+        self.assertEqual(seen, ['/call-invoice/41987654321'])
+
+    def test_call_log_goes_to_the_default_application(self):
+        seen = []
+
+        async def default(scope, receive, send):
+            seen.append(scope['path'])
+            await send({'type': 'http.response.start', 'status': 201,
+                        'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def post_start():
+            communicator = ApplicationCommunicator(
+                Router(CallLogApplication(), default),
+                scope(path='/call-log'))
+            await communicator.send_input(
+                {'type': 'http.request', 'body': json.dumps(START).encode()})
+            return await communicator.receive_output(1)
+        self.assertEqual(async_to_sync(post_start)()['status'], 201)
+        self.assertEqual(seen, ['/call-log'])
@@ -0,0 +1,248 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+from decimal import Decimal
+from io import StringIO
+from django.core.management import call_command, CommandError
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from calls.models import BillingJob, Call, CallLog, CallInvoice, \
+    CallRecord, InvoiceSummary, PendingCallEnd
+
+
+def parse_date(date_string):
+    date_obj = datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%SZ')
+    return timezone.make_aware(date_obj, timezone.utc)
+
+
+def create_call(start, end, source="41987654321", destination="1196385274"):
+    call = Call.objects.create(source=source, destination=destination)
+    CallLog.objects.create(
+        type='start', timestamp=parse_date(start), call_id=call)
+    CallLog.objects.create(
+        type='end', timestamp=parse_date(end), call_id=call)
+    return call
+
+
+class RerateCommandTestCase(TestCase):
+    def setUp(self):
+        create_call('2017-12-11T15:07:13Z', '2017-12-11T15:14:56Z')
+        create_call('2017-12-13T21:57:13Z', '2017-12-14T22:10:56Z')
+        create_call('2018-02-28T21:57:13Z', '2018-03-01T22:10:56Z')
+        CallInvoice.objects.update(price=0)
+
+    def test_rerate_month(self):
+        CallRecord.objects.update(normal_minutes=0, reduced_minutes=0)
+        out = StringIO()
+        call_command('rerate', month='122017', chunk_size=1, stdout=out)
+        self.assertIn('Re-rated 2 calls', out.getvalue())
+        prices = CallInvoice.objects.order_by('id').values_list(
+            'price', flat=True)
+        self.assertEqual(
+            list(prices), [Decimal('0.99'), Decimal('86.94'), Decimal('0')])
+        minutes = CallRecord.objects.order_by('call_id').values_list(
+            'normal_minutes', 'reduced_minutes')
+        self.assertEqual(list(minutes), [(7, 0), (962, 491), (0, 0)])
+
+    def test_invalid_month(self):
+        self.assertRaises(
+            CommandError, call_command, 'rerate', month='2017-12')
+
+
+@override_settings(ASYNC_BILLING=True)
+class RunBillingWorkersCommandTestCase(TestCase):
+    def test_end_of_call_is_queued(self):
+        call = create_call('2016-02-29T12:00:00Z', '2016-02-29T14:00:00Z')
+        self.assertFalse(CallInvoice.objects.exists())
+        self.assertEqual(BillingJob.objects.get().call_id, call)
+
+    def test_bill_queued_calls(self):
+        create_call('2016-02-29T12:00:00Z', '2016-02-29T14:00:00Z')
+        create_call('2017-12-13T21:57:13Z', '2017-12-14T22:10:56Z')
+        call_command('run_billing_workers', once=True, batch_size=1)
+        prices = CallInvoice.objects.order_by('id').values_list(
+            'price', flat=True)
+        self.assertEqual(list(prices), [Decimal('11.16'), Decimal('86.94')])
+        self.assertEqual(CallRecord.objects.count(), 2)
+        self.assertFalse(BillingJob.objects.exists())
+
+    def test_failed_job_is_retried_later(self):
+        create_call('2016-02-29T12:00:00Z', '2016-02-29T14:00:00Z')
+        CallLog.objects.filter(type='start').delete()
+        call_command('run_billing_workers', once=True, max_attempts=1)
+        job = BillingJob.objects.get()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('no start or end record', job.last_error)
+        self.assertFalse(CallInvoice.objects.exists())
+
+
+class SweepPendingEndsCommandTestCase(TestCase):
+    def test_report_orphans(self):
+        PendingCallEnd.objects.create(
+            call_id=7, timestamp=parse_date('2018-03-01T22:10:56Z'),
+            received_at=parse_date('2018-03-01T22:11:00Z')
+        )
+        PendingCallEnd.objects.create(
+            call_id=8, timestamp=parse_date('2018-03-01T22:10:56Z'))
+        out = StringIO()
+        call_command('sweep_pending_ends', delete=True, stdout=out)
+        self.assertIn('Call 7 ended at', out.getvalue())
+        self.assertIn('1 unmatched end records', out.getvalue())
+        self.assertEqual(
+            list(PendingCallEnd.objects.values_list('call_id', flat=True)),
+            [8]
+        )
+
+    def test_pair_started_calls(self):
+        call = Call.objects.create(source="41987654321",
+                                   destination="1196385274")
+        CallLog.objects.bulk_create([CallLog(
+            type='start', timestamp=parse_date('2016-02-29T12:00:00Z'),
+            call_id=call)])
+        PendingCallEnd.objects.create(
+            call_id=call.id, timestamp=parse_date('2016-02-29T14:00:00Z'))
+        out = StringIO()
+        call_command('sweep_pending_ends', stdout=out)
+        self.assertIn('Paired 1 end records', out.getvalue())
+        self.assertEqual(CallInvoice.objects.get().price, Decimal('11.16'))
+
+
+class ImportCdrsCommandTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.records = [
+            {'type': 'end', 'call_id': 2,
+             'timestamp': '2017-12-14T22:10:56Z'},
+            {'type': 'start', 'call_id': 1, 'source': '41987654321',
+             'destination': '1196385274',
+             'timestamp': '2016-02-29T12:00:00Z'},
+            {'type': 'end', 'call_id': 1,
+             'timestamp': '2016-02-29T14:00:00Z'},
+            {'type': 'start', 'call_id': 2, 'source': '41987654321',
+             'destination': '1196385274',
+             'timestamp': '2017-12-13T21:57:13Z'},
+            {'type': 'start', 'call_id': 3, 'source': 'abc',
+             'destination': '1196385274',
+             'timestamp': '2017-12-13T21:57:13Z'},
+        ]
+
+    def write_file(self, name, content):
+        path = os.path.join(self.directory, name)
+        opener = gzip.open if name.endswith('.gz') else open
+        with opener(path, 'wt') as stream:
+            stream.write(content)
+        return path
+
+    def assert_imported(self):
+        prices = CallInvoice.objects.order_by('call_id').values_list(
+            'price', flat=True)
+        self.assertEqual(list(prices), [Decimal('11.16'), Decimal('86.94')])
+        self.assertFalse(PendingCallEnd.objects.exists())
+
+    def test_import_csv(self):
+        lines = ['type,call_id,timestamp,source,destination']
+        for record in self.records:
+            lines.append(','.join(
+                str(record.get(field, '')) for field in
+                ('type', 'call_id', 'timestamp', 'source', 'destination')
+            ))
+        path = self.write_file('cdrs.csv', '\n'.join(lines))
+        out = StringIO()
+        call_command('import_cdrs', path, chunk_size=2, stdout=out)
+        self.assertIn('3 created, 1 pending, 1 rejected', out.getvalue())
+        self.assert_imported()
+
+    def test_import_gzipped_ndjson(self):
+        lines = [json.dumps(record) for record in self.records]
+        path = self.write_file('cdrs.ndjson.gz', '\n'.join(lines) + '\n{')
+        errors = os.path.join(self.directory, 'errors.ndjson')
+        call_command('import_cdrs', path, errors=errors, stdout=StringIO())
+        self.assert_imported()
+        with open(errors) as stream:
+            rejected = [json.loads(line) for line in stream]
+        self.assertEqual([error['index'] for error in rejected], [4, 5])
+        self.assertIn('NDJSON parse error on line 6',
+                      rejected[1]['errors']['non_field_errors'][0])
+
+    def test_resume_from_checkpoint(self):
+        lines = [json.dumps(record) for record in self.records]
+        path = self.write_file('cdrs.ndjson', '\n'.join(lines))
+        with open(path + '.checkpoint', 'w') as stream:
+            json.dump({'records': 3}, stream)
+        out = StringIO()
+        call_command('import_cdrs', path, stdout=out)
+        self.assertIn('Resuming after 3 records', out.getvalue())
+        self.assertEqual(
+            list(Call.objects.values_list('id', flat=True)), [2])
+        self.assertFalse(os.path.exists(path + '.checkpoint'))
+
+    def test_unknown_format(self):
+        self.assertRaises(
+            CommandError, call_command, 'import_cdrs', 'cdrs.txt')
+
+
+class CloseMonthCommandTestCase(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.sources = ['11987654321', '21987654321', '41987654321']
+        for source in self.sources:
+            create_call('2017-12-11T15:07:13Z', '2017-12-11T15:14:56Z',
+                        source=source)
+        create_call('2017-12-13T21:57:13Z', '2017-12-14T22:10:56Z')
+        create_call('2018-01-11T15:07:13Z', '2018-01-11T15:14:56Z')
+        self.bills = {
+            summary.source: summary
+            for summary in InvoiceSummary.objects.filter(
+                billing_month='2017-12-01')
+        }
+        self.items = {
+            source: bill.line_items() for source, bill in self.bills.items()
+        }
+        InvoiceSummary.objects.filter(billing_month='2017-12-01').delete()
+
+    def test_close_month(self):
+        out = StringIO()
+        call_command('close_month', '122017', shards=2, workers=1,
+                     output=self.directory, stdout=out)
+        self.assertIn('Closed 122017: 3 bills in 2 shards', out.getvalue())
+        for source, bill in self.bills.items():
+            closed = InvoiceSummary.objects.get(
+                source=source, billing_month='2017-12-01')
+            self.assertEqual(closed.line_items(), self.items[source])
+            self.assertEqual(closed.total, bill.total)
+        documents = []
+        for name in sorted(os.listdir(self.directory)):
+            with open(os.path.join(self.directory, name)) as stream:
+                documents.extend(json.loads(line) for line in stream)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['invoices-201712-0000.ndjson', 'invoices-201712-0001.ndjson'])
+        self.assertEqual(
+            [document['source'] for document in documents], self.sources)
+        self.assertEqual(documents[2]['total'], 'R$ 87.93')
+        self.assertEqual(documents[2]['call_count'], 2)
+        self.assertEqual(
+            documents[2]['items'], self.items['41987654321'])
+
+    def test_bills_outside_the_month_are_kept(self):
+        # shards are built in this process on SQLite whatever the workers
+        call_command('close_month', '122017', workers=4, stdout=StringIO())
+        self.assertEqual(InvoiceSummary.objects.filter(
+            billing_month='2017-12-01').count(), 3)
+        self.assertEqual(InvoiceSummary.objects.filter(
+            billing_month='2018-01-01').count(), 1)
+
+    def test_open_month(self):
+        month = timezone.now().strftime('%m%Y')
+        self.assertRaises(
+            CommandError, call_command, 'close_month', month)
+
+    def test_invalid_month(self):
+        self.assertRaises(
+            CommandError, call_command, 'close_month', '2017-12')
@@ -0,0 +1,113 @@
+from django.test import SimpleTestCase, override_settings
+from rest_framework.test import APITestCase, APIClient
+from calls import instrumentation
+from calls.instrumentation import Counter, Histogram, Registry
+
+
+class TestRegistry(SimpleTestCase):
+
+    def test_render(self):
+        registry = Registry()
+        counter = registry.register(
+            Counter('requests_total', "Requests.", ('view',)))
+        histogram = registry.register(
+            Histogram('duration_seconds', "Duration.", ('view',), (0.1, 1)))
+        registry.observe([
+            (counter, ('call-log-list',), 1),
+            (counter, ('call-log-list',), 1),
+            (histogram, ('call-log-list',), 0.1),
+            (histogram, ('call-log-list',), 0.5),
+            (histogram, ('call-log-list',), 2.0),
+        ])
+        self.assertEqual(registry.render(), '\n'.join([
+            '# HELP requests_total Requests.',
+            '# TYPE requests_total counter',
+            'requests_total{view="call-log-list"} 2',
+            '# HELP duration_seconds Duration.',
+            '# TYPE duration_seconds histogram',
+            'duration_seconds_bucket{view="call-log-list",le="0.1"} 1',
+            'duration_seconds_bucket{view="call-log-list",le="1"} 2',
+            'duration_seconds_bucket{view="call-log-list",le="+Inf"} 3',
+            'duration_seconds_sum{view="call-log-list"} 2.6',
+            'duration_seconds_count{view="call-log-list"} 3',
+        ]) + '\n')
+
+    def test_label_values_are_escaped(self):
+        counter = Counter('total', "Total.", ('view',))
+        counter.observe(('a"b\\c\nd',))
+        self.assertEqual(
+            list(counter.samples()),
+            [('total', r'view="a\"b\\c\nd"', 1)])
+
+
+@override_settings(INSTRUMENTATION_ENABLED=True)
+class InstrumentationTestCase(APITestCase):
+
+    def setUp(self):
+        instrumentation.registry.clear()
+        self.addCleanup(instrumentation.registry.clear)
+        self.client = APIClient()
+
+    def post_start(self):
+        data = {
+            'type': 'start',
+            'source': '41987654321',
+            'destination': '1196385274',
+            'call_id': 1,
+            'timestamp': '2016-02-29T12:00:00Z'
+        }
+        response = self.client.post('/call-log', data, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_metrics_by_view(self):
+        self.post_start()
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response['Content-Type'], instrumentation.CONTENT_TYPE)
+        content = response.content.decode()
+        labels = 'view="call-log-list",method="POST"'
+        self.assertIn(
+            'billcalls_requests_total{%s,status="201"} 1' % labels, content)
+        self.assertIn(
+            'billcalls_request_duration_seconds_count{%s} 1' % labels,
+            content)
+        self.assertIn(
+            'billcalls_request_serialization_duration_seconds_count{%s} 1'
+            % labels, content)
+        queries = instrumentation.request_queries.values[
+            ('call-log-list', 'POST')]
+        # counts of the buckets and sum of the queries
+        self.assertEqual(queries[0][0], 0)
+        self.assertGreater(queries[1], 0)
+
+    @override_settings(SLOW_QUERY_MS=0, SLOW_QUERY_SAMPLE_RATE=1.0)
+    def test_slow_queries_are_logged(self):
+        with self.assertLogs('calls.instrumentation', 'WARNING') as logs:
+            self.post_start()
+        self.assertTrue(logs.output)
+        self.assertIn('Slow query on default', logs.output[0])
+        self.assertIn(
+            ('call-log-list', 'POST'),
+            instrumentation.slow_queries_total.values)
+
+    @override_settings(SLOW_QUERY_MS=0, SLOW_QUERY_SAMPLE_RATE=0)
+    def test_slow_queries_are_sampled(self):
+        with self.assertRaises(AssertionError):
+            with self.assertLogs('calls.instrumentation', 'WARNING'):
+                self.post_start()
+        self.assertIn(
+            ('call-log-list', 'POST'),
+            instrumentation.slow_queries_total.values)
+
+
+class InstrumentationDisabledTestCase(APITestCase):
+
+    def setUp(self):
+        instrumentation.registry.clear()
+        self.client = APIClient()
+
+    def test_nothing_is_recorded(self):
+        self.client.get('/call-invoice/41987654321?date=012018')
+        self.assertFalse(instrumentation.requests_total.values)
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
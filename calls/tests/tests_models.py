@@ -1,6 +1,6 @@
-from datetime import datetime
+from datetime import date, datetime
 from django.test import TestCase
-from calls.models import Call, CallLog, CallInvoice
+from calls.models import Call, CallLog, CallInvoice, CallRecord
 
 
 def parse_date(date_string):
@@ -165,3 +165,17 @@ class CallModelsTestCase(TestCase):
         for field in fields_call_invoice:
             with self.subTest():
                 self.assertTrue(hasattr(CallInvoice, field))
+
+    def test_call_record_is_kept_in_sync(self):
+        self.assertEqual(CallRecord.objects.count(), 8)
+        invoice = CallInvoice.objects.get(call_id__logs__timestamp=parse_date(
+            '2017-12-14T22:10:56Z'))
+        record = CallRecord.objects.get(call_id=invoice.call_id)
+        self.assertEqual(record.source, '1196385274')
+        self.assertEqual(record.destination, '41987654321')
+        self.assertEqual(record.duration_seconds, 87223)
+        self.assertEqual(record.duration, invoice.duration)
+        self.assertEqual(record.price, invoice.price)
+        self.assertEqual(record.billing_month, date(2017, 12, 1))
+        invoice.save()
+        self.assertEqual(CallRecord.objects.count(), 8)
@@ -0,0 +1,135 @@
+from datetime import date, datetime
+from io import StringIO
+from unittest import skipIf, skipUnless
+from django.core.management import call_command, CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.utils import timezone
+from calls.models import Call, CallLog, CallRecord, InvoiceLine, \
+    InvoiceSummary
+from calls.partitions import add_months, create_partitions, \
+    expire_partitions, first_log_month, month_bounds, partition_months, \
+    partition_name
+from calls.summaries import expire_bills
+from calls.tests.tests_commands import create_call
+
+
+class TestPartitionNames(SimpleTestCase):
+
+    def test_add_months(self):
+        self.assertEqual(add_months(date(2018, 11, 1), 1), date(2018, 12, 1))
+        self.assertEqual(add_months(date(2018, 12, 1), 1), date(2019, 1, 1))
+        self.assertEqual(add_months(date(2018, 1, 1), -1), date(2017, 12, 1))
+        self.assertEqual(add_months(date(2018, 3, 1), -26), date(2016, 1, 1))
+
+    def test_partition_name(self):
+        self.assertEqual(
+            partition_name('calls_calllog', date(2018, 2, 1)),
+            'calls_calllog_p201802')
+
+    def test_month_bounds(self):
+        self.assertEqual(
+            month_bounds(date(2018, 12, 1), True),
+            ('2018-12-01', '2019-01-01'))
+        self.assertEqual(
+            month_bounds(date(2018, 12, 1), False),
+            ('2018-12-01 00:00:00+00:00', '2019-01-01 00:00:00+00:00'))
+
+
+class ExpiredMonthsTestCase(TestCase):
+
+    def setUp(self):
+        create_call('2017-11-11T15:07:13Z', '2017-11-11T15:14:56Z')
+        create_call('2017-11-30T21:57:13Z', '2017-12-01T22:10:56Z')
+        create_call('2017-12-13T21:57:13Z', '2017-12-14T22:10:56Z')
+
+    def test_logs_kept_with_their_invoice(self):
+        # the call ending in December started in November
+        self.assertEqual(first_log_month(date(2017, 12, 1)), date(2017, 11, 1))
+        self.assertEqual(first_log_month(date(2018, 1, 1)), date(2018, 1, 1))
+
+    def test_bills_of_expired_months_deleted(self):
+        self.assertEqual(expire_bills(date(2017, 12, 1)), 1)
+        self.assertEqual(
+            list(InvoiceSummary.objects.values_list(
+                'billing_month', flat=True)),
+            [date(2017, 12, 1)])
+        self.assertEqual(CallRecord.objects.count(), 2)
+        self.assertEqual(InvoiceLine.objects.count(), 2)
+
+
+@skipIf(connection.vendor == 'postgresql', "Tables are partitioned")
+class PartitionCommandsTestCase(TestCase):
+
+    def test_commands_need_partitioned_tables(self):
+        self.assertRaises(
+            CommandError, call_command, 'create_partitions')
+        self.assertRaises(
+            CommandError, call_command, 'expire_partitions', keep_months=12)
+
+
+@skipUnless(connection.vendor == 'postgresql', "Needs PostgreSQL")
+class PartitionedTablesTestCase(TestCase):
+
+    def count(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT COUNT(*) FROM %s' % table)
+            return cursor.fetchone()[0]
+
+    def test_create_partition_moves_default_rows(self):
+        month = date(2100, 1, 1)
+        call = Call.objects.create(
+            source='41987654321', destination='1196385274')
+        CallLog.objects.create(
+            type='start', call_id=call, timestamp=timezone.make_aware(
+                datetime(2100, 1, 15, 12), timezone.utc))
+        self.assertEqual(self.count('calls_calllog_default'), 1)
+        created = create_partitions(connection, month, month)
+        self.assertIn('calls_calllog_p210001', created)
+        self.assertIn('calls_callinvoice_p210001', created)
+        self.assertEqual(self.count('calls_calllog_default'), 0)
+        self.assertEqual(self.count('calls_calllog_p210001'), 1)
+        self.assertEqual(CallLog.objects.get(call_id=call).type, 'start')
+        self.assertEqual(create_partitions(connection, month, month), [])
+
+    def test_expire_partitions(self):
+        create_partitions(connection, date(2100, 1, 1), date(2100, 2, 1))
+        expired = expire_partitions(
+            connection, date(2100, 2, 1), detach=True)
+        self.assertIn('calls_calllog_p210001', expired)
+        self.assertNotIn('calls_calllog_p210002', expired)
+        with connection.cursor() as cursor:
+            self.assertNotIn(
+                date(2100, 1, 1), partition_months(cursor, 'calls_calllog'))
+            # a detached partition is kept as a plain table
+            self.assertEqual(self.count('calls_calllog_p210001'), 0)
+
+    def test_expire_rows_of_the_default_partition(self):
+        month = add_months(date.today().replace(day=1), -30)
+        create_partitions(connection, month, add_months(month, 2))
+        call = create_call(
+            '{0:%Y-%m}-28T23:00:00Z'.format(add_months(month, -1)),
+            '{0:%Y-%m}-02T01:00:00Z'.format(month))
+        # a table with pending foreign key checks cannot be dropped
+        connection.check_constraints()
+        expired = expire_partitions(connection, month)
+        # the call is billed in a kept month, its start log is kept too
+        self.assertNotIn(
+            partition_name('calls_calllog', add_months(month, -1)), expired)
+        self.assertEqual(CallLog.objects.filter(call_id=call).count(), 2)
+        expired = expire_partitions(connection, add_months(month, 1))
+        self.assertIn(
+            partition_name('calls_calllog', add_months(month, -1)), expired)
+        self.assertIn(partition_name('calls_calllog', month), expired)
+        self.assertFalse(CallLog.objects.filter(call_id=call).exists())
+        self.assertFalse(CallRecord.objects.filter(call_id=call).exists())
+        self.assertFalse(InvoiceSummary.objects.exists())
+
+    def test_create_partitions_command(self):
+        out = StringIO()
+        call_command('create_partitions', months_ahead=2, stdout=out)
+        self.assertIn('partitions', out.getvalue())
+        with connection.cursor() as cursor:
+            months = partition_months(cursor, 'calls_calllog')
+        self.assertGreaterEqual(
+            months[-1], add_months(date.today().replace(day=1), 2))
@@ -0,0 +1,161 @@
+import threading
+import time
+from unittest import mock
+from django.db.utils import ProgrammingError
+from django.test import SimpleTestCase
+from billcalls.db import pool
+from billcalls.db.pool import ConnectionPool, PoolTimeout, get_pool, \
+    pool_stats
+from calls import instrumentation
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def execute(self, sql):
+        if self.connection.broken:
+            raise ConnectionError("server closed the connection")
+        # as psycopg2, a statement out of autocommit opens a transaction
+        if not self.connection.autocommit:
+            self.connection.in_transaction = True
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = 0
+        self.broken = False
+        self.in_transaction = False
+        self._autocommit = False
+        self.rollbacks = 0
+
+    @property
+    def autocommit(self):
+        return self._autocommit
+
+    @autocommit.setter
+    def autocommit(self, value):
+        if self.in_transaction:
+            raise ProgrammingError(
+                "set_session cannot be used inside a transaction")
+        self._autocommit = value
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        self.rollbacks += 1
+        self.in_transaction = False
+
+    def close(self):
+        self.closed = 1
+
+
+class TestConnectionPool(SimpleTestCase):
+
+    def test_connections_are_reused(self):
+        connection_pool = ConnectionPool(FakeConnection, max_size=2)
+        first = connection_pool.acquire()
+        second = connection_pool.acquire()
+        self.assertIsNot(first, second)
+        connection_pool.release(first)
+        self.assertIs(connection_pool.acquire(), first)
+        # released connections are rolled back and out of autocommit
+        self.assertEqual(first.rollbacks, 1)
+        self.assertFalse(first.autocommit)
+        self.assertEqual(connection_pool.stats(), {
+            'created': 2, 'checkouts': 3, 'waits': 0, 'timeouts': 0,
+            'discarded': 0, 'max_size': 2, 'idle': 0, 'in_use': 2,
+        })
+
+    def test_timeout(self):
+        connection_pool = ConnectionPool(
+            FakeConnection, max_size=1, timeout=0.01)
+        connection_pool.acquire()
+        self.assertRaises(PoolTimeout, connection_pool.acquire)
+        self.assertEqual(connection_pool.stats()['timeouts'], 1)
+
+    def test_wait_for_a_released_connection(self):
+        connection_pool = ConnectionPool(FakeConnection, max_size=1)
+        connection = connection_pool.acquire()
+
+        def release():
+            time.sleep(0.05)
+            connection_pool.release(connection)
+        thread = threading.Thread(target=release)
+        thread.start()
+        self.assertIs(connection_pool.acquire(), connection)
+        thread.join()
+        self.assertEqual(connection_pool.stats()['waits'], 1)
+
+    def test_broken_idle_connection_is_replaced(self):
+        connection_pool = ConnectionPool(
+            FakeConnection, max_size=1, check_interval=0)
+        connection = connection_pool.acquire()
+        connection_pool.release(connection)
+        connection.broken = True
+        replacement = connection_pool.acquire()
+        self.assertIsNot(replacement, connection)
+        self.assertTrue(connection.closed)
+        stats = connection_pool.stats()
+        self.assertEqual(stats['discarded'], 1)
+        self.assertEqual(stats['in_use'], 1)
+
+    def test_checked_connection_can_be_set_up_again(self):
+        connection_pool = ConnectionPool(
+            FakeConnection, max_size=1, check_interval=0)
+        connection = connection_pool.acquire()
+        # set up by Django as it does with a new connection
+        connection.autocommit = True
+        connection.cursor().execute('SELECT 1')
+        connection_pool.release(connection)
+        self.assertIs(connection_pool.acquire(), connection)
+        self.assertFalse(connection.in_transaction)
+        connection.autocommit = True
+
+    def test_closed_connection_is_not_pooled(self):
+        connection_pool = ConnectionPool(FakeConnection, max_size=1)
+        connection = connection_pool.acquire()
+        connection.close()
+        connection_pool.release(connection)
+        self.assertEqual(connection_pool.stats()['idle'], 0)
+        self.assertIsNot(connection_pool.acquire(), connection)
+
+    def test_failed_connect_frees_its_slot(self):
+        connect = mock.Mock(side_effect=[ConnectionError, FakeConnection()])
+        connection_pool = ConnectionPool(connect, max_size=1, timeout=0.01)
+        self.assertRaises(ConnectionError, connection_pool.acquire)
+        self.assertIsInstance(connection_pool.acquire(), FakeConnection)
+
+
+class TestPoolRegistry(SimpleTestCase):
+
+    def setUp(self):
+        patcher = mock.patch.dict(pool._pools, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pools_are_kept_per_process(self):
+        connection_pool = get_pool('default', FakeConnection)
+        self.assertIs(get_pool('default', FakeConnection), connection_pool)
+        with mock.patch('os.getpid', return_value=-1):
+            self.assertIsNot(
+                get_pool('default', FakeConnection), connection_pool)
+        self.assertEqual(list(pool_stats()), ['default'])
+
+    def test_metrics(self):
+        get_pool('default', FakeConnection).acquire()
+        content = instrumentation.registry.render()
+        self.assertIn(
+            'billcalls_db_pool_connections{alias="default",state="in_use"} 1',
+            content)
+        self.assertIn(
+            'billcalls_db_pool_created_total{alias="default"} 1', content)
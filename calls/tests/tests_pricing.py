@@ -0,0 +1,157 @@
+import unittest
+from datetime import datetime, timedelta
+from decimal import Decimal
+import numpy as np
+from hypothesis import assume, given, settings, strategies as st
+from calls.pricing import charged_minutes, charged_minutes_batch, \
+    compute_price, compute_prices_in_cents, from_cents
+
+
+def legacy_compute_time_billing(start_price, start_timestamp, end_timestamp):
+    # recursive implementation previously found in
+    # CallInvoice.compute_time_billing, kept as the reference of the
+    # expected prices
+    reduced_start = 22
+    reduced_end = 6
+    minute_price = 0.09
+
+    def reduced_fare_range(timestamp):
+        return timestamp.hour >= reduced_start or timestamp.hour < reduced_end
+
+    def replace_date_to_normal_range(timestamp):
+        next_day = timestamp + timedelta(days=1)
+        return timestamp.replace(
+            day=next_day.day, month=next_day.month,
+            hour=reduced_end, minute=0, second=0, microsecond=0
+        )
+
+    def get_time_charged(timestamp):
+        start_fare_range = timestamp.replace(
+            hour=reduced_start, minute=0, second=0, microsecond=0)
+        return int((start_fare_range - timestamp).total_seconds() / 60)
+
+    start_timestamp = start_timestamp.replace(tzinfo=None)
+    end_timestamp = end_timestamp.replace(tzinfo=None)
+    price = start_price
+    next_start_date = replace_date_to_normal_range(start_timestamp)
+    if reduced_fare_range(start_timestamp):
+        if end_timestamp < next_start_date:
+            return price
+        price = legacy_compute_time_billing(
+            price, next_start_date, end_timestamp)
+    elif reduced_fare_range(end_timestamp):
+        price += get_time_charged(start_timestamp) * minute_price
+        if next_start_date > end_timestamp:
+            return price
+        price = legacy_compute_time_billing(
+            price, next_start_date, end_timestamp)
+    elif end_timestamp > next_start_date:
+        price += get_time_charged(start_timestamp) * minute_price
+        price = legacy_compute_time_billing(
+            price, next_start_date, end_timestamp)
+    else:
+        minutes_normal = int(
+            (end_timestamp - start_timestamp).total_seconds() / 60)
+        price += minutes_normal * minute_price
+    return price
+
+
+def parse_date(date_string):
+    return datetime.strptime(date_string, '%Y-%m-%dT%H:%M:%SZ')
+
+
+# the legacy implementation moves to the next day keeping the year, so calls
+# reaching December 31st are left out of the comparison
+call_starts = st.datetimes(
+    min_value=datetime(2000, 1, 1), max_value=datetime(2030, 12, 1))
+call_starts = st.one_of(
+    call_starts,
+    call_starts.map(lambda date: date.replace(minute=0, second=0,
+                                              microsecond=0)),
+)
+call_durations = st.one_of(
+    st.timedeltas(min_value=timedelta(microseconds=1),
+                  max_value=timedelta(days=1)),
+    st.timedeltas(min_value=timedelta(microseconds=1),
+                  max_value=timedelta(days=40)),
+    st.integers(min_value=1, max_value=40 * 24).map(
+        lambda hours: timedelta(hours=hours)),
+)
+
+
+class TestComputePrice(unittest.TestCase):
+    def test_known_prices(self):
+        calls = (
+            ('2016-02-29T12:00:00Z', '2016-02-29T14:00:00Z', '11.16'),
+            ('2017-12-11T15:07:13Z', '2017-12-11T15:14:56Z', '0.99'),
+            ('2017-12-12T22:47:56Z', '2017-12-12T22:50:56Z', '0.36'),
+            ('2017-12-12T21:57:13Z', '2017-12-12T22:10:56Z', '0.54'),
+            ('2017-12-12T04:57:13Z', '2017-12-12T06:10:56Z', '0.36'),
+            ('2017-12-13T21:57:13Z', '2017-12-14T22:10:56Z', '86.94'),
+            ('2017-12-12T15:07:58Z', '2017-12-12T15:12:56Z', '0.72'),
+            ('2018-02-28T21:57:13Z', '2018-03-01T22:10:56Z', '86.94'),
+        )
+        for start, end, price in calls:
+            with self.subTest(start=start, end=end):
+                self.assertEqual(
+                    compute_price(parse_date(start), parse_date(end)),
+                    Decimal(price)
+                )
+
+    def test_call_across_year_boundary(self):
+        start = parse_date('2017-12-31T21:00:00Z')
+        end = parse_date('2018-01-01T07:00:00Z')
+        self.assertEqual(charged_minutes(start, end), 60 + 60)
+
+    def test_long_call_is_constant_time(self):
+        start = parse_date('2000-01-01T12:00:00Z')
+        end = parse_date('2019-01-01T12:00:00Z')
+        days = (end - start).days
+        self.assertEqual(charged_minutes(start, end), days * 16 * 60)
+
+    @settings(max_examples=2000, deadline=None)
+    @given(start=call_starts, duration=call_durations)
+    def test_same_price_as_legacy_implementation(self, start, duration):
+        end = start + duration
+        assume(end < datetime(start.year, 12, 31))
+        legacy_price = legacy_compute_time_billing(0.36, start, end)
+        self.assertEqual(
+            compute_price(start, end),
+            Decimal(legacy_price).quantize(Decimal('0.01'))
+        )
+
+
+class TestComputePricesBatch(unittest.TestCase):
+    def test_known_prices(self):
+        starts = np.array([
+            '2016-02-29T12:00:00', '2017-12-12T04:57:13',
+            '2017-12-13T21:57:13', '2017-12-31T21:00:00'
+        ], dtype='datetime64[us]')
+        ends = np.array([
+            '2016-02-29T14:00:00', '2017-12-12T06:10:56',
+            '2017-12-14T22:10:56', '2018-01-01T07:00:00'
+        ], dtype='datetime64[us]')
+        prices = compute_prices_in_cents(starts, ends)
+        self.assertEqual(prices.tolist(), [1116, 36, 8694, 36 + 120 * 9])
+        self.assertEqual(from_cents(prices[0]), Decimal('11.16'))
+
+    def test_prices_must_fit_in_cents(self):
+        self.assertRaises(
+            ValueError, compute_prices_in_cents, [], [],
+            minute_price=Decimal('0.095')
+        )
+
+    @settings(max_examples=200, deadline=None)
+    @given(calls=st.lists(st.tuples(call_starts, call_durations),
+                          min_size=1, max_size=50))
+    def test_same_minutes_as_scalar_version(self, calls):
+        starts = [start for start, duration in calls]
+        ends = [start + duration for start, duration in calls]
+        minutes = charged_minutes_batch(
+            np.array(starts, dtype='datetime64[us]'),
+            np.array(ends, dtype='datetime64[us]')
+        )
+        self.assertEqual(
+            minutes.tolist(),
+            [charged_minutes(start, end) for start, end in zip(starts, ends)]
+        )
@@ -0,0 +1,219 @@
+import datetime
+import unittest
+from unittest import mock
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, \
+    override_settings
+from django.test.utils import CaptureQueriesContext
+from billcalls.db import router
+from billcalls.db.router import ReplicaRouter, use_primary
+from calls import instrumentation, invoice_cache, views
+from calls.ingestion import ingest_call_logs
+from calls.models import Call, CallRecord, InvoiceSummary
+
+
+START = {
+    'type': 'start',
+    'source': '41987654321',
+    'destination': '1196385274',
+    'call_id': 1,
+    'timestamp': '2016-02-29T12:00:00Z'
+}
+END = {'type': 'end', 'call_id': 1, 'timestamp': '2016-02-29T14:00:00Z'}
+MONTH = datetime.date(2016, 2, 1)
+
+
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaRouterTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        request_started.send(sender=self.__class__)
+        patcher = mock.patch.object(router, 'known_lag', return_value=0.0)
+        self.known_lag = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reporting_reads_go_to_a_replica(self):
+        self.assertEqual(self.router.db_for_read(CallRecord), 'replica')
+        self.assertEqual(self.router.db_for_read(InvoiceSummary), 'replica')
+
+    def test_other_reads_go_to_the_primary(self):
+        self.assertIsNone(self.router.db_for_read(Call))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        self.assertIsNone(self.router.db_for_read(CallRecord))
+
+    def test_use_primary(self):
+        with use_primary():
+            with use_primary():
+                pass
+            self.assertIsNone(self.router.db_for_read(CallRecord))
+        self.assertEqual(self.router.db_for_read(CallRecord), 'replica')
+
+    def test_reads_after_a_write_go_to_the_primary(self):
+        self.assertIsNone(self.router.db_for_write(CallRecord))
+        self.assertIsNone(self.router.db_for_read(CallRecord))
+        request_started.send(sender=self.__class__)
+        self.assertEqual(self.router.db_for_read(CallRecord), 'replica')
+
+    def test_reads_in_a_transaction_go_to_the_primary(self):
+        with mock.patch.object(
+                connections['default'], 'in_atomic_block', True):
+            self.assertIsNone(self.router.db_for_read(CallRecord))
+
+    @override_settings(DATABASE_REPLICAS=['replica', 'lagging', 'down'],
+                       DATABASE_REPLICA_MAX_LAG=30)
+    def test_lagging_and_unreachable_replicas_are_left_out(self):
+        lags = {'replica': 30.0, 'lagging': 30.5, 'down': None}
+        self.known_lag.side_effect = lags.get
+        for _ in range(10):
+            self.assertEqual(
+                self.router.db_for_read(CallRecord), 'replica')
+        lags['replica'] = 31.0
+        self.assertIsNone(self.router.db_for_read(CallRecord))
+
+    def test_replicas_are_not_migrated(self):
+        self.assertFalse(self.router.allow_migrate('replica', 'calls'))
+        self.assertIsNone(self.router.allow_migrate('default', 'calls'))
+
+    def test_relations_between_primary_and_replica(self):
+        record = CallRecord()
+        record._state.db = 'replica'
+        call = Call()
+        call._state.db = 'default'
+        self.assertTrue(self.router.allow_relation(record, call))
+        call._state.db = 'other'
+        self.assertIsNone(self.router.allow_relation(record, call))
+
+
+@override_settings(DATABASE_REPLICA_LAG_CHECK_INTERVAL=5)
+class ReplicaLagTestCase(SimpleTestCase):
+
+    def setUp(self):
+        router._lags.clear()
+        self.addCleanup(router._lags.clear)
+
+    def test_lag_is_checked_once_per_interval(self):
+        with mock.patch.object(router, 'replica_lag',
+                               side_effect=[1.5, 2.5]) as replica_lag, \
+                mock.patch.object(router, 'monotonic',
+                                  side_effect=[100, 104, 105]):
+            self.assertEqual(router.known_lag('replica'), 1.5)
+            self.assertEqual(router.known_lag('replica'), 1.5)
+            self.assertEqual(router.known_lag('replica'), 2.5)
+        self.assertEqual(replica_lag.call_count, 2)
+
+    def test_sqlite_does_not_lag(self):
+        self.assertEqual(router.replica_lag('default'), 0.0)
+
+    @override_settings(DATABASE_REPLICAS=['replica', 'down'],
+                       DATABASE_REPLICA_MAX_LAG=30)
+    def test_lag_metrics(self):
+        lags = {'replica': 1.5, 'down': None}
+        with mock.patch.object(router, 'known_lag', side_effect=lags.get):
+            content = instrumentation.registry.render()
+        self.assertIn(
+            'billcalls_db_replica_lag_seconds{alias="replica"} 1.5\n',
+            content)
+        self.assertNotIn(
+            'billcalls_db_replica_lag_seconds{alias="down"}', content)
+        self.assertIn(
+            'billcalls_db_replica_available{alias="replica"} 1\n', content)
+        self.assertIn(
+            'billcalls_db_replica_available{alias="down"} 0\n', content)
+
+
+class RecentlyWrittenTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        patcher = mock.patch.object(
+            invoice_cache.transaction, 'on_commit',
+            side_effect=lambda func: func())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @override_settings(DATABASE_REPLICAS=['replica'],
+                       DATABASE_REPLICA_PIN_SECONDS=60)
+    def test_written_bills_are_pinned(self):
+        invoice_cache.invalidate(iter([(START['source'], MONTH)]))
+        self.assertTrue(
+            invoice_cache.recently_written(START['source'], MONTH))
+        self.assertFalse(
+            invoice_cache.recently_written('11987654321', MONTH))
+
+    @override_settings(DATABASE_REPLICAS=[])
+    def test_without_replicas(self):
+        invoice_cache.invalidate([(START['source'], MONTH)])
+        with override_settings(DATABASE_REPLICAS=['replica']):
+            self.assertFalse(
+                invoice_cache.recently_written(START['source'], MONTH))
+
+
+class InvoiceReadsTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        ingest_call_logs([START, END])
+        self.url = '/call-invoice/{source}?date=022016'.format(
+            source=START['source'])
+
+    def get(self, url):
+        with mock.patch.object(
+                views, 'use_primary', wraps=use_primary) as primary:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return primary.called
+
+    @override_settings(DATABASE_REPLICAS=['replica'])
+    def test_recently_written_bills_are_read_from_the_primary(self):
+        with mock.patch.object(invoice_cache, 'recently_written',
+                               return_value=True) as recently_written:
+            self.assertTrue(self.get(self.url))
+            self.assertTrue(self.get(self.url + '&page_size=10'))
+            self.assertTrue(self.get(self.url + '&stream=ndjson'))
+        recently_written.assert_called_with(START['source'], MONTH)
+        self.assertFalse(self.get(self.url + '&page_size=10'))
+
+
+@unittest.skipUnless(
+    'replica' in settings.DATABASES,
+    "Needs a 'replica' database, see 'Read replicas' in the README")
+@override_settings(DATABASE_REPLICAS=['replica'])
+class ReplicaReadsTestCase(TransactionTestCase):
+    # the replica reads through its own connection, only committed rows are
+    # visible to it
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        cache.clear()
+        ingest_call_logs([START, END])
+        self.url = '/call-invoice/{source}?date=022016'.format(
+            source=START['source'])
+
+    def get(self, url):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections['replica']) as replica:
+            response = self.client.get(url)
+            if response.streaming:
+                b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        return len(primary), len(replica)
+
+    def test_invoice_is_read_from_the_replica(self):
+        cache.clear()
+        # the page and the totals of the bill
+        self.assertEqual(self.get(self.url + '&page_size=10'), (0, 2))
+        self.assertEqual(self.get(self.url + '&stream=ndjson'), (0, 2))
+
+    def test_invoice_is_read_from_the_primary_after_ingestion(self):
+        # the pin is set on commit of the ingestion in setUp
+        primary, replica = self.get(self.url + '&stream=ndjson')
+        self.assertEqual(replica, 0)
+        cache.clear()
+        primary, replica = self.get(self.url + '&stream=ndjson')
+        self.assertEqual(primary, 0)
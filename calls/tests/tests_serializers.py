@@ -0,0 +1,40 @@
+import json
+from django.test import TestCase
+from rest_framework.utils.encoders import JSONEncoder
+from calls.models import CallLog, CallRecord
+from calls.serializers import CallLogRowSerializer, CallLogSerializer, \
+    CallRecordRowSerializer, CallRecordSerializer
+from calls.tests.tests_commands import create_call
+
+
+def rendered(data):
+    return json.loads(json.dumps(data, cls=JSONEncoder))
+
+
+class RowSerializerTestCase(TestCase):
+    def setUp(self):
+        create_call('2017-12-13T21:57:13Z', '2017-12-14T22:10:56Z')
+        create_call('2017-12-11T15:07:13Z', '2017-12-11T15:14:56Z')
+        create_call('2016-02-29T12:00:00Z', '2016-03-11T14:00:05Z',
+                    destination='11998986565')
+
+    def test_same_output_as_call_log_serializer(self):
+        logs = CallLog.objects.order_by('id')
+        self.assertEqual(
+            rendered(CallLogRowSerializer(
+                logs.values(*CallLogRowSerializer.fields)).data),
+            rendered(CallLogSerializer(logs, many=True).data)
+        )
+        self.assertEqual(
+            rendered(CallLogRowSerializer.to_representation(
+                CallLogRowSerializer.row(logs[0]))),
+            rendered(CallLogSerializer(logs[0]).data)
+        )
+
+    def test_same_output_as_call_record_serializer(self):
+        records = CallRecord.objects.order_by('ended_at', 'call_id')
+        self.assertEqual(
+            rendered(CallRecordRowSerializer(
+                records.values(*CallRecordRowSerializer.fields)).data),
+            rendered(CallRecordSerializer(records, many=True).data)
+        )
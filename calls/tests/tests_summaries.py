@@ -0,0 +1,169 @@
+import json
+from datetime import date
+from decimal import Decimal
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+from rest_framework.utils.encoders import JSONEncoder
+from calls.models import CallInvoice, CallRecord, InvoiceSummary
+from calls.serializers import CallRecordSerializer
+from calls.summaries import rebuild_month, shard_bounds
+from calls.tests.tests_commands import create_call, parse_date
+
+
+class InvoiceSummaryTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.source = '41987654321'
+        create_call('2017-12-13T21:57:13Z', '2017-12-14T22:10:56Z')
+        create_call('2017-12-11T15:07:13Z', '2017-12-11T15:14:56Z')
+        create_call('2018-01-11T15:07:13Z', '2018-01-11T15:14:56Z')
+
+    def expected_items(self, month):
+        records = CallRecord.objects.filter(
+            source=self.source, billing_month=month
+        ).order_by('ended_at', 'call_id')
+        data = CallRecordSerializer(records, many=True).data
+        return json.loads(json.dumps(data, cls=JSONEncoder))
+
+    def test_summary_is_updated_for_each_call(self):
+        summary = InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2017, 12, 1))
+        self.assertEqual(summary.call_count, 2)
+        self.assertEqual(summary.total, Decimal('87.93'))
+        self.assertEqual(summary.total_duration_seconds, 87223 + 463)
+        self.assertEqual(summary.normal_minutes, 962 + 7)
+        self.assertEqual(summary.reduced_minutes, 491 + 0)
+        # the late call is listed before the one billed first
+        self.assertEqual(
+            summary.line_items(),
+            self.expected_items(date(2017, 12, 1))
+        )
+        self.assertEqual(InvoiceSummary.objects.count(), 2)
+
+    def test_call_billed_again_replaces_its_line(self):
+        invoice = CallInvoice.objects.order_by('id').first()
+        invoice.save()
+        summary = InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2017, 12, 1))
+        self.assertEqual(summary.call_count, 2)
+        self.assertEqual(len(summary.line_items()), 2)
+        self.assertEqual(summary.total, Decimal('87.93'))
+        self.assertEqual(summary.normal_minutes, 962 + 7)
+        self.assertEqual(summary.reduced_minutes, 491)
+
+    def test_call_billed_again_in_another_month_leaves_its_bill(self):
+        invoice = CallInvoice.objects.order_by('id').first()
+        invoice.call_id.logs.filter(type='end').update(
+            timestamp=parse_date('2018-01-01T00:10:56Z'))
+        invoice.save()
+        december = InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2017, 12, 1))
+        self.assertEqual(december.call_count, 1)
+        self.assertEqual(december.total, Decimal('0.99'))
+        self.assertEqual(
+            december.line_items(), self.expected_items(date(2017, 12, 1)))
+        january = InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2018, 1, 1))
+        self.assertEqual(january.call_count, 2)
+        self.assertEqual(
+            january.line_items(), self.expected_items(date(2018, 1, 1)))
+
+    def test_bill_without_summary_is_built_from_its_call_records(self):
+        # calls billed before the bills were stored
+        InvoiceSummary.objects.all().delete()
+        create_call('2017-12-20T15:07:13Z', '2017-12-20T15:08:13Z')
+        summary = InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2017, 12, 1))
+        self.assertEqual(summary.call_count, 3)
+        self.assertEqual(summary.total, Decimal('88.38'))
+        self.assertEqual(
+            summary.line_items(),
+            self.expected_items(date(2017, 12, 1))
+        )
+        response = APIClient().get(
+            '/call-invoice/{source}?date=122017'.format(source=self.source))
+        self.assertEqual(len(response.json()), 3)
+
+    def test_bill_inserted_by_a_concurrent_call_is_built(self):
+        # the other call inserted the bill and has not added its line yet
+        InvoiceSummary.objects.all().delete()
+        InvoiceSummary.objects.create(
+            source=self.source, billing_month=date(2017, 12, 1))
+        create_call('2017-12-20T15:07:13Z', '2017-12-20T15:08:13Z')
+        summary = InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2017, 12, 1))
+        self.assertEqual(summary.call_count, 3)
+        self.assertEqual(summary.total, Decimal('88.38'))
+        self.assertEqual(
+            summary.line_items(), self.expected_items(date(2017, 12, 1)))
+
+    def test_rebuild_month(self):
+        incremental = InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2017, 12, 1))
+        items = incremental.line_items()
+        self.assertEqual(rebuild_month(date(2017, 12, 1)), 1)
+        rebuilt = InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2017, 12, 1))
+        self.assertEqual(rebuilt.line_items(), items)
+        self.assertEqual(
+            rebuilt.normal_minutes, incremental.normal_minutes)
+        self.assertEqual(rebuilt.total, incremental.total)
+
+    def test_rebuild_queries_do_not_grow_with_bills(self):
+        month = date(2017, 12, 1)
+        with CaptureQueriesContext(connection) as one_bill:
+            rebuild_month(month)
+        for source in ('11987654321', '21987654321', '31987654321'):
+            create_call('2017-12-11T15:07:13Z', '2017-12-11T15:14:56Z',
+                        source=source)
+        # a bill stored empty by a call billed at the same time
+        InvoiceSummary.objects.filter(source='11987654321').update(
+            call_count=0, total=0)
+        with CaptureQueriesContext(connection) as four_bills:
+            self.assertEqual(rebuild_month(month), 4)
+        self.assertEqual(len(four_bills), len(one_bill))
+        self.assertEqual(
+            InvoiceSummary.objects.get(source='11987654321').total,
+            Decimal('0.99'))
+
+    def test_rebuild_range_of_sources(self):
+        create_call('2017-12-11T15:07:13Z', '2017-12-11T15:14:56Z',
+                    source='11987654321')
+        InvoiceSummary.objects.update(total=0)
+        self.assertEqual(rebuild_month(
+            date(2017, 12, 1), last_source='41987654321'), 1)
+        self.assertEqual(
+            InvoiceSummary.objects.get(source='11987654321').total,
+            Decimal('0.99'))
+        self.assertEqual(InvoiceSummary.objects.get(
+            source=self.source, billing_month=date(2017, 12, 1)).total, 0)
+
+    def test_shard_bounds(self):
+        for source in ('11987654321', '21987654321', '31987654321'):
+            create_call('2017-12-11T15:07:13Z', '2017-12-11T15:14:56Z',
+                        source=source)
+        self.assertEqual(shard_bounds(date(2017, 12, 1), 2), [
+            (None, '31987654321'), ('31987654321', None)])
+        self.assertEqual(
+            shard_bounds(date(2017, 12, 1), 10),
+            [(None, '21987654321'), ('21987654321', '31987654321'),
+             ('31987654321', '41987654321'), ('41987654321', None)])
+        self.assertEqual(shard_bounds(date(2016, 12, 1), 2), [(None, None)])
+
+    def test_closed_month_is_served_from_summary(self):
+        client = APIClient()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(
+                '/call-invoice/{source}?date=122017'.format(
+                    source=self.source))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 2)
+        self.assertIn('calls_invoicesummary', queries[0]['sql'])
+        self.assertIn('calls_invoiceline', queries[1]['sql'])
+        self.assertEqual(
+            response.json(),
+            self.expected_items(date(2017, 12, 1))
+        )
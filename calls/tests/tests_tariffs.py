@@ -0,0 +1,266 @@
+import unittest
+from datetime import date, datetime, time, timedelta
+from decimal import Decimal
+from io import StringIO
+from hypothesis import given, strategies as st
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from calls import tariffs
+from calls.billing import bill_calls
+from calls.models import Call, CallInvoice, CallRecord, Holiday, \
+    PlanSubscription, ReducedWindow, TariffPlan, TariffRate, TariffVersion
+from calls.tariffs import PrefixIndex, Rate, TariffIndex
+from calls.tests.tests_commands import create_call, parse_date
+
+
+def day_by_day_minutes(rate, start, end, holidays):
+    minutes = 0
+    day = datetime.combine(start.date(), time())
+    while day < end:
+        minutes += rate.partial_day_minutes(day, start, end, holidays)
+        day += timedelta(days=1)
+    return minutes
+
+
+class TestRate(unittest.TestCase):
+    def test_reduced_window_across_midnight(self):
+        rate = Rate(Decimal('0.36'), Decimal('0.09'), [(22, 6, 'all')])
+        # Wednesday 21:00 to Thursday 07:00
+        minutes = rate.charged_minutes(
+            datetime(2018, 2, 28, 21, 0), datetime(2018, 3, 1, 7, 0, 59))
+        self.assertEqual(minutes, 60 + 60)
+
+    def test_several_windows(self):
+        rate = Rate(Decimal('0'), Decimal('0.10'),
+                    [(22, 6, 'all'), (12, 14, 'weekday')])
+        minutes = rate.charged_minutes(
+            datetime(2018, 2, 28, 11, 0), datetime(2018, 2, 28, 15, 0))
+        self.assertEqual(minutes, 60 + 60)
+
+    def test_weekends_and_holidays(self):
+        rate = Rate(Decimal('0'), Decimal('0.10'),
+                    [(22, 6, 'all'), (0, 0, 'weekend')])
+        # Friday 21:00 to Monday 07:00
+        start = datetime(2018, 3, 2, 21, 0)
+        end = datetime(2018, 3, 5, 7, 0)
+        self.assertEqual(rate.charged_minutes(start, end), 60 + 60)
+        self.assertEqual(
+            rate.charged_minutes(start, end, frozenset([date(2018, 3, 5)])),
+            60
+        )
+
+    @given(start=st.datetimes(min_value=datetime(2018, 1, 1),
+                              max_value=datetime(2018, 12, 31)),
+           duration=st.timedeltas(min_value=timedelta(0),
+                                  max_value=timedelta(days=60)),
+           holidays=st.frozensets(st.dates(min_value=date(2018, 1, 1),
+                                           max_value=date(2019, 3, 1)),
+                                  max_size=10))
+    def test_same_minutes_as_day_by_day(self, start, duration, holidays):
+        rate = Rate(Decimal('0'), Decimal('0.10'),
+                    [(22, 6, 'all'), (12, 14, 'weekday'), (8, 20, 'weekend')])
+        end = start + duration
+        self.assertEqual(rate.charged_minutes(start, end, holidays),
+                         day_by_day_minutes(rate, start, end, holidays))
+
+    def test_prices_must_fit_in_cents(self):
+        self.assertRaises(ValueError, Rate, Decimal('0.36'), Decimal('0.095'))
+
+
+def longest_prefix(prefixes, key):
+    matches = [prefix for prefix in prefixes if key.startswith(prefix)]
+    return max(matches, key=len, default=None)
+
+
+digits = st.text(alphabet='0123456789', max_size=6)
+
+
+class TestPrefixIndex(unittest.TestCase):
+    def test_longest_prefix(self):
+        index = PrefixIndex([
+            ('', 'any'), ('4', 'south'), ('41', 'curitiba'),
+            ('419', 'mobile'), ('4198', 'other'), ('11', 'sao paulo')
+        ])
+        self.assertEqual(index.get('41987654321'), 'other')
+        self.assertEqual(index.get('41912345678'), 'mobile')
+        self.assertEqual(index.get('4133334444'), 'curitiba')
+        self.assertEqual(index.get('2133334444'), 'any')
+        self.assertEqual(
+            [index.prefixes[position] for position in
+             index.lookup('41987654321')],
+            ['4198', '419', '41', '4', '']
+        )
+
+    @given(prefixes=st.lists(digits, max_size=50),
+           keys=st.lists(st.text(alphabet='0123456789', max_size=11),
+                         max_size=50))
+    def test_same_match_as_linear_scan(self, prefixes, keys):
+        index = PrefixIndex((prefix, prefix) for prefix in prefixes)
+        expected = [longest_prefix(prefixes, key) for key in keys]
+        self.assertEqual([index.get(key) for key in keys], expected)
+        positions = index.lookup_many(keys).tolist()
+        self.assertEqual(
+            [index.prefixes[position] if position >= 0 else None
+             for position in positions],
+            expected
+        )
+
+
+class TestTariffIndex(unittest.TestCase):
+    def setUp(self):
+        self.landline = Rate(Decimal('0.36'), Decimal('0.09'))
+        self.mobile = Rate(Decimal('0.50'), Decimal('0.20'))
+        self.new_mobile = Rate(Decimal('0.50'), Decimal('0.25'))
+        self.index = TariffIndex(
+            subscriptions=[('41987654321', datetime(2018, 1, 1), 1)],
+            rates=[
+                (1, '', datetime(2018, 1, 1), self.landline),
+                (1, '419', datetime(2018, 1, 1), self.mobile),
+                (1, '419', datetime(2018, 3, 15), self.new_mobile),
+            ]
+        )
+
+    def test_longest_prefix(self):
+        at = datetime(2018, 3, 1)
+        self.assertIs(
+            self.index.rate('41987654321', '41987654321', at), self.mobile)
+        self.assertIs(
+            self.index.rate('41987654321', '1196385274', at), self.landline)
+
+    def test_effective_dates(self):
+        self.assertIs(
+            self.index.rate('41987654321', '41999999999',
+                            datetime(2018, 3, 20)),
+            self.new_mobile
+        )
+        self.assertIsNone(
+            self.index.rate('41987654321', '41999999999',
+                            datetime(2017, 12, 31)))
+
+    def test_rates_of_a_batch(self):
+        self.assertEqual(
+            self.index.rates_many(
+                ['41987654321', '41987654321', '11987654321'],
+                ['41999999999', '1196385274', '41999999999'],
+                [datetime(2018, 3, 1), datetime(2018, 3, 1),
+                 datetime(2018, 3, 1)]
+            ),
+            [self.mobile, self.landline, None]
+        )
+
+    def test_standard_tariff_without_plan(self):
+        self.assertIsNone(
+            self.index.charge('11987654321', '41999999999',
+                              datetime(2018, 3, 1, 12),
+                              datetime(2018, 3, 1, 13)))
+        prices = self.index.charges_in_cents(
+            ['11987654321', '41987654321'], ['1196385274', '41999999999'],
+            [datetime(2016, 2, 29, 12), datetime(2018, 3, 1, 12)],
+            [datetime(2016, 2, 29, 14), datetime(2018, 3, 1, 13)]
+        )[0]
+        self.assertEqual(prices.tolist(), [1116, 50 + 60 * 20])
+
+    def test_charged_minutes_of_a_batch(self):
+        self.assertEqual(
+            self.index.charge('41987654321', '41999999999',
+                              datetime(2018, 3, 1, 12),
+                              datetime(2018, 3, 1, 13)),
+            (Decimal('12.50'), 60)
+        )
+        prices, minutes = self.index.charges_in_cents(
+            ['11987654321', '41987654321'], ['1196385274', '41999999999'],
+            [datetime(2016, 2, 29, 12), datetime(2018, 3, 1, 12)],
+            [datetime(2016, 2, 29, 14), datetime(2018, 3, 1, 13)]
+        )
+        self.assertEqual(prices.tolist(), [1116, 50 + 60 * 20])
+        self.assertEqual(minutes.tolist(), [120, 60])
+
+
+class TariffPlanTestCase(TestCase):
+    def setUp(self):
+        self.addCleanup(tariffs.invalidate)
+        plan = TariffPlan.objects.create(name='Mobile')
+        PlanSubscription.objects.create(
+            source='41987654321', plan=plan,
+            valid_from=parse_date('2018-01-01T00:00:00Z'))
+        rate = TariffRate.objects.create(
+            plan=plan, destination_prefix='',
+            effective_from=parse_date('2018-01-01T00:00:00Z'),
+            standing_price=Decimal('0.50'), minute_price=Decimal('0.10'))
+        ReducedWindow.objects.create(rate=rate, start_hour=22, end_hour=6)
+        ReducedWindow.objects.create(
+            rate=rate, start_hour=0, end_hour=0, day_type='weekend')
+        Holiday.objects.create(date=date(2018, 2, 13), name='Carnival')
+
+    def test_calls_are_billed_with_the_plan(self):
+        # Tuesday, a holiday and a Saturday
+        create_call('2018-02-06T12:00:00Z', '2018-02-06T13:00:00Z')
+        create_call('2018-02-13T12:00:00Z', '2018-02-13T13:00:00Z')
+        create_call('2018-02-10T12:00:00Z', '2018-02-10T13:00:00Z')
+        # subscriber without a plan
+        create_call('2018-02-06T12:00:00Z', '2018-02-06T13:00:00Z',
+                    source='11987654321')
+        prices = CallInvoice.objects.order_by('id').values_list(
+            'price', flat=True)
+        self.assertEqual(list(prices), [
+            Decimal('6.50'), Decimal('0.50'), Decimal('0.50'),
+            Decimal('5.76')
+        ])
+
+    def test_batch_is_billed_with_the_plan(self):
+        bills = [
+            (Call.objects.create(
+                id=call_id, source=source, destination='1196385274'),
+             parse_date(start), parse_date(end))
+            for call_id, source, start, end in (
+                (1, '41987654321', '2018-02-06T12:00:00Z',
+                 '2018-02-06T13:00:00Z'),
+                (2, '41987654321', '2018-02-13T12:00:00Z',
+                 '2018-02-13T13:00:00Z'),
+                (3, '11987654321', '2018-02-06T12:00:00Z',
+                 '2018-02-06T13:00:00Z'),
+            )
+        ]
+        bill_calls(bills)
+        self.assertEqual(list(CallRecord.objects.order_by(
+            'call_id').values_list('price', 'normal_minutes')), [
+            (Decimal('6.50'), 60), (Decimal('0.50'), 0),
+            (Decimal('5.76'), 60)
+        ])
+
+    def test_index_is_not_loaded_per_call(self):
+        tariffs.get_index()
+        with self.assertNumQueries(0):
+            tariffs.get_index()
+        Holiday.objects.create(date=date(2018, 2, 6))
+        # the version, then the tariffs
+        with self.assertNumQueries(5):
+            tariffs.get_index()
+
+    def test_rerate_with_the_plan(self):
+        create_call('2018-02-06T12:00:00Z', '2018-02-06T13:00:00Z')
+        CallInvoice.objects.update(price=0)
+        call_command('rerate', month='022018', stdout=StringIO())
+        self.assertEqual(CallInvoice.objects.get().price, Decimal('6.50'))
+
+
+class TariffReloadTestCase(TestCase):
+    def setUp(self):
+        self.addCleanup(tariffs.invalidate)
+        TariffVersion.objects.all().delete()
+        tariffs.invalidate()
+
+    def test_reload_when_another_process_changes_the_rates(self):
+        index = tariffs.get_index()
+        tariffs.publish_version()
+        with override_settings(TARIFF_RELOAD_INTERVAL=3600):
+            with self.assertNumQueries(0):
+                self.assertIs(tariffs.get_index(), index)
+        with override_settings(TARIFF_RELOAD_INTERVAL=0):
+            with self.assertNumQueries(5):
+                reloaded = tariffs.get_index()
+            self.assertIsNot(reloaded, index)
+            # only the version is read while it does not change
+            with self.assertNumQueries(1):
+                self.assertIs(tariffs.get_index(), reloaded)
+        self.assertEqual(TariffVersion.objects.count(), 1)
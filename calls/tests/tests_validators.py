@@ -1,5 +1,5 @@
 import unittest
-from calls.validators import validate_phone_number
+from calls.validators import check_phone_numbers, validate_phone_number
 from django.core.exceptions import ValidationError
 
 
@@ -12,3 +12,30 @@ class TestValidatePhoneNumber(unittest.TestCase):
     def test_invalid_phone_number(self):
         self.assertRaises(ValidationError, validate_phone_number, 'abcdefghi')
         self.assertRaises(ValidationError, validate_phone_number, '123456')
+
+    def test_unknown_area_code(self):
+        self.assertRaises(
+            ValidationError, validate_phone_number, '20987654321')
+        self.assertRaises(ValidationError, validate_phone_number, '0187654321')
+
+    def test_non_ascii_digits(self):
+        self.assertRaises(
+            ValidationError, validate_phone_number, '41\u066987654321')
+
+    def test_error_message(self):
+        with self.assertRaises(ValidationError) as context:
+            validate_phone_number('123456')
+        self.assertEqual(
+            context.exception.messages,
+            ['123456 is not a valid phone number. Use AAXXXXXXXXX or '
+             'AAXXXXXXXX, eg: 41998765432']
+        )
+
+
+class TestCheckPhoneNumbers(unittest.TestCase):
+    def test_check_column(self):
+        self.assertEqual(
+            check_phone_numbers(
+                ['41987654321', '123456', '41987654321', '1196385274']),
+            [True, False, True, True]
+        )
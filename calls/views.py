@@ -1,15 +1,35 @@
 import datetime
-from django.db.models import Q
+from decimal import Decimal
+from contextlib import nullcontext
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Sum
+from django.http import Http404, HttpResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from billcalls.db.router import use_primary
+from calls import instrumentation, invoice_cache
 from calls.serializers import \
-    CallLogSerializer, CallInvoiceSerializer, \
-    CallSerializer, AbstractCallLogSerializer
-from calls.models import CallInvoice
+    CallLogSerializer, CallInvoiceSerializer, CallLogRowSerializer, \
+    CallRecordRowSerializer, CallSerializer, AbstractCallLogSerializer, \
+    InvoiceTotalsSerializer
+from calls.ingestion import ingest_call_logs, record_response
+from calls.models import CallInvoice, CallRecord, InvoiceSummary, \
+    billing_month
+from calls.pagination import InvoiceCursorPagination
+from calls.parsers import NDJSONParser
+from calls.pending import park_end
+from rest_framework.decorators import action
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework import mixins, viewsets, status
 
 
 class CallLogViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
     serializer_class = AbstractCallLogSerializer
+    batch_max_size = 10000
 
     def create(self, request, *args, **kwargs):
         abstract_serializer = AbstractCallLogSerializer(data=request.data)
@@ -18,6 +38,7 @@ class CallLogViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
                 abstract_serializer.errors,
                 status=status.HTTP_400_BAD_REQUEST
             )
+        call = None
         if request.data.get('type') == 'start':
             call_data = {
                 'id': request.data.get('call_id'),
@@ -30,24 +51,113 @@ class CallLogViewSet(mixins.CreateModelMixin, viewsets.GenericViewSet):
                     call_serializer.errors,
                     status=status.HTTP_400_BAD_REQUEST
                 )
-            call_serializer.save()
-        serializer = CallLogSerializer(data=request.data)
+            call = call_serializer.save()
+        serializer = CallLogSerializer(
+            data=request.data, context={'call': call})
         if serializer.is_valid():
-            serializer.save()
+            try:
+                # the end of a call is stored along with its invoice, call
+                # record and bill line, or not at all
+                with transaction.atomic():
+                    log = serializer.save()
+            except IntegrityError:
+                # the same record of the call stored by a concurrent request,
+                # on PostgreSQL only the call record or billing job keys
+                # tell, the log keys include the partition key
+                msg = "The fields type, call_id must make a unique set."
+                return Response(
+                    {'non_field_errors': [msg]},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
             return Response(
-                serializer.data,
+                CallLogRowSerializer.to_representation(
+                    CallLogRowSerializer.row(log)),
                 status=status.HTTP_201_CREATED,
             )
+        if self.is_unmatched_end(abstract_serializer, serializer):
+            return self.park_end(abstract_serializer)
         return Response(
             serializer.errors,
             status=status.HTTP_400_BAD_REQUEST
         )
 
+    @staticmethod
+    def is_unmatched_end(abstract_serializer, serializer):
+        # end of a call whose only error is the call not having started yet
+        data = abstract_serializer.validated_data
+        if data['type'] != 'end' or data['call_id'] is None:
+            return False
+        codes = set(
+            error.code
+            for errors in serializer.errors.values()
+            for error in errors
+        )
+        return codes <= {'does_not_exist', 'no_start'}
+
+    @staticmethod
+    def park_end(abstract_serializer):
+        """
+        Keep an end record received before the start of its call, the call
+        is billed when the start arrives.
+        """
+        data = abstract_serializer.validated_data
+        if not park_end(data['call_id'], data['timestamp']):
+            msg = "The fields type, call_id must make a unique set."
+            return Response(
+                {'non_field_errors': [msg]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(
+            abstract_serializer.data,
+            status=status.HTTP_202_ACCEPTED
+        )
+
+    @action(detail=False, methods=['post'],
+            parser_classes=[JSONParser, NDJSONParser])
+    def batch(self, request, *args, **kwargs):
+        """
+        Store a list of call log records, sent as a JSON array or as
+        newline delimited JSON, and return the result of each record.
+        """
+        records = request.data
+        if not isinstance(records, list):
+            msg = "The request body must be a list of call log records."
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+        if len(records) > self.batch_max_size:
+            msg = "A batch cannot contain more than {max_size} " \
+                  "records.".format(max_size=self.batch_max_size)
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+        results = ingest_call_logs(records)
+        if all(result['status'] != 'error' for result in results):
+            return Response(results, status=status.HTTP_201_CREATED)
+        return Response(results, status=status.HTTP_207_MULTI_STATUS)
+
+    @action(detail=False, methods=['post'], parser_classes=[JSONParser])
+    def ingest(self, request, *args, **kwargs):
+        """
+        Store a single call log record as the batch endpoint does and return
+        its result, the ASGI deployment answers it asynchronously.
+        """
+        record = request.data
+        if not isinstance(record, dict):
+            msg = "The request body must be a call log record."
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+        [result] = ingest_call_logs([record])
+        status_code, data = record_response(result)
+        return Response(data, status=status_code)
+
 
 class CallInvoiceViewSet(viewsets.ViewSet, viewsets.GenericViewSet):
     queryset = CallInvoice.objects.all()
     serializer_class = CallInvoiceSerializer
+    pagination_class = InvoiceCursorPagination
     lookup_field = 'source'
+    stream_formats = {
+        'ndjson': 'application/x-ndjson',
+        'json': 'application/json',
+    }
+    stream_chunk_size = 2000
+    totals_query_param = 'totals'
 
     def retrieve(self, request, source=None):
         date = self.request.GET.get('date', None)
@@ -64,15 +174,152 @@ class CallInvoiceViewSet(viewsets.ViewSet, viewsets.GenericViewSet):
                 msg = "You cannot request an invoice for a " \
                       "month that is not yet completed."
                 return Response(msg, status=status.HTTP_400_BAD_REQUEST)
-        call_invoices = CallInvoice.objects.filter(
-            Q(call_id__source=source),
-            Q(timestamp_end__year=date_ref.year),
-            Q(timestamp_end__month=date_ref.month)
-        )
-        ctx = {'request': request}
-        serializer = CallInvoiceSerializer(
-            call_invoices, context=ctx, many=True)
-        if serializer.data:
-            return Response(serializer.data)
-        else:
+        month = billing_month(date_ref)
+        with self.reading(source, month):
+            return self.invoice(request, source, month)
+
+    @staticmethod
+    def reading(source, month):
+        """
+        :return: context manager of the reads of the bill, from the primary
+        database while the read replicas may not have its last calls
+        """
+        if invoice_cache.recently_written(source, month):
+            return use_primary()
+        return nullcontext()
+
+    def invoice(self, request, source, month):
+        stream = request.query_params.get('stream')
+        if stream is not None:
+            return self.stream_invoice(source, month, stream)
+        if self.paginator.is_requested(request):
+            return self.paginated_invoice(source, month)
+        cached = invoice_cache.get(source, month)
+        if cached is None:
+            data, last_modified, totals, version = self.load_invoice(
+                source, month)
+            if not data:
+                return Response(status=status.HTTP_404_NOT_FOUND)
+            cached = invoice_cache.set(
+                source, month, data, last_modified, totals, version)
+        return self.cached_response(request, cached)
+
+    def call_records(self, source, month):
+        return CallRecord.objects.filter(
+            source=source,
+            billing_month=month
+        ).order_by('ended_at', 'call_id').values(
+            *CallRecordRowSerializer.fields)
+
+    def paginated_invoice(self, source, month):
+        page = self.paginate_queryset(self.call_records(source, month))
+        if not page:
             return Response(status=status.HTTP_404_NOT_FOUND)
+        response = self.get_paginated_response(
+            CallRecordRowSerializer(page).data)
+        response.data['totals'] = self.invoice_totals(source, month)
+        return response
+
+    def stream_invoice(self, source, month, stream):
+        if stream not in self.stream_formats:
+            msg = "The stream format must be one of: {formats}.".format(
+                formats=', '.join(sorted(self.stream_formats)))
+            return Response(msg, status=status.HTTP_400_BAD_REQUEST)
+        call_records = self.call_records(source, month)
+        # rows are read after the view returns, from the database chosen now
+        call_records = call_records.using(call_records.db)
+        if not call_records.exists():
+            return Response(status=status.HTTP_404_NOT_FOUND)
+        rows = call_records.iterator(chunk_size=self.stream_chunk_size)
+        to_representation = CallRecordRowSerializer.to_representation
+        renderer = JSONRenderer()
+        items = (renderer.render(to_representation(row)) for row in rows)
+        if stream == 'ndjson':
+            content = (item + b'\n' for item in items)
+        else:
+            content = self.json_array(items)
+        return StreamingHttpResponse(
+            content, content_type=self.stream_formats[stream])
+
+    @staticmethod
+    def json_array(items):
+        yield b'['
+        for index, item in enumerate(items):
+            yield item if index == 0 else b',' + item
+        yield b']'
+
+    def load_invoice(self, source, month):
+        summary = InvoiceSummary.objects.filter(
+            source=source, billing_month=month).first()
+        if summary is not None:
+            # only closed months are served, their bill is already built
+            return summary.line_items(), summary.updated_at, \
+                InvoiceTotalsSerializer.to_representation({
+                    field: getattr(summary, field)
+                    for field in InvoiceTotalsSerializer.fields
+                }), summary.updated_at
+        serializer = CallRecordRowSerializer(self.call_records(source, month))
+        data = serializer.data
+        return data, timezone.now(), \
+            self.aggregate_totals(source, month) if data else None, None
+
+    def invoice_totals(self, source, month):
+        """
+        :return: totals of the bill, from the sums kept in its summary
+        """
+        row = InvoiceSummary.objects.filter(
+            source=source, billing_month=month
+        ).values(*InvoiceTotalsSerializer.fields).first()
+        if row is None:
+            return self.aggregate_totals(source, month)
+        return InvoiceTotalsSerializer.to_representation(row)
+
+    def aggregate_totals(self, source, month):
+        """
+        :return: totals of the bill, with a single aggregate over the call
+        records
+        """
+        row = CallRecord.objects.filter(
+            source=source, billing_month=month
+        ).aggregate(
+            total=Sum('price'),
+            call_count=Count('pk'),
+            normal_minutes=Sum('normal_minutes'),
+            reduced_minutes=Sum('reduced_minutes')
+        )
+        # SQLite adds the prices up as floating point numbers
+        row['total'] = row['total'].quantize(Decimal('0.01'))
+        return InvoiceTotalsSerializer.to_representation(row)
+
+    def wants_totals(self, request):
+        value = request.query_params.get(self.totals_query_param, '')
+        return value.lower() in ('1', 'true')
+
+    def cached_response(self, request, cached):
+        last_modified = cached['last_modified']
+        totals = self.wants_totals(request)
+        etag = cached['totals_etag'] if totals else cached['etag']
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified)
+        if response is None and totals:
+            response = Response({
+                'totals': cached['totals'],
+                'items': cached['data']
+            })
+        elif response is None:
+            response = Response(cached['data'])
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        patch_cache_control(response, no_cache=True)
+        return response
+
+
+def metrics(request):
+    """
+    Request metrics of this process in the Prometheus text format.
+    """
+    if not settings.INSTRUMENTATION_ENABLED:
+        raise Http404
+    return HttpResponse(
+        instrumentation.registry.render(),
+        content_type=instrumentation.CONTENT_TYPE)